@@ -0,0 +1,54 @@
+"""
+Generate the module src/whereisip/countries.py with the short country names per ISO2
+code
+
+The names are taken from country_converter, such that the table gives the same names as
+``coco.convert(code, to="name_short")``. Run this script again after updating
+country_converter::
+
+    python scripts/make_countries.py
+"""
+from pathlib import Path
+
+import country_converter as coco
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+MODULE = Path(__file__).parent.parent / "src" / "whereisip" / "countries.py"
+
+HEADER = '''"""
+Short country names per ISO2 country code
+
+This module is generated by scripts/make_countries.py from country_converter {version}.
+Do not edit it by hand.
+"""
+
+COUNTRY_NAMES = {{
+'''
+
+
+def iso2_codes(iso2):
+    """
+    Some ISO2 entries of country_converter are a regex with alternatives, e.g. ^GB$|^UK$
+    """
+    return [code.strip("^$") for code in iso2.split("|")]
+
+
+def main():
+    converter = coco.CountryConverter()
+    names = dict()
+    for iso2, name in zip(converter.data["ISO2"], converter.data["name_short"]):
+        for code in iso2_codes(iso2):
+            names[code] = name
+    with open(MODULE, "w", encoding="utf-8") as stream:
+        stream.write(HEADER.format(version=coco.__version__))
+        for code in sorted(names):
+            stream.write(f"    {code!r}: {names[code]!r},\n")
+        stream.write("}\n")
+    print(f"Written {len(names)} countries to {MODULE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+asyncio versions of the lookup functions of whereisip
+
+The lookups of :mod:`whereisip.getgeolocation` block on the cache and on the network.
+The functions in this module run those blocking parts in the default executor of the
+event loop, so they can be used from an asyncio application without blocking the event
+loop, e.g.::
+
+    from whereisip.aiogeolocation import get_geo_location_ip
+
+    geo_info = await get_geo_location_ip("8.8.8.8")
+
+A :class:`AsyncGeoLocator` limits the number of simultaneous upstream requests and
+coalesces concurrent requests for the same address into one upstream request.
+"""
+
+import asyncio
+import functools
+import logging
+import weakref
+
+from whereisip.getgeolocation import (DEFAULT_WORKERS,
+                                      IpErrorNoLocationFound,
+                                      fetch_geo_info_ip,
+                                      fetch_geo_location_device,
+                                      find_device_in_gazetteer,
+                                      get_device_cache_key,
+                                      get_lookup_key,
+                                      make_failure_entry,
+                                      open_cache,
+                                      read_cache_entry,
+                                      share_geo_info)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# one default locator per event loop, as a semaphore can not be shared between event
+# loops
+_default_locators = weakref.WeakKeyDictionary()
+
+
+async def _run_blocking(function, *args, **kwargs):
+    """ Run a blocking function in the default executor of the running event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None,
+                                      functools.partial(function, *args, **kwargs))
+
+
+class AsyncGeoLocator:
+    """
+    Look up geo locations from an asyncio event loop
+
+    Args:
+        max_concurrency: int
+            Maximum number of upstream requests running at the same time
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_WORKERS, reset_cache=False,
+                 write_cache=True, cache=None):
+        self.max_concurrency = max_concurrency
+        self.reset_cache = reset_cache
+        self.write_cache = write_cache
+        self.cache = cache
+        self._semaphore = None
+        self._in_flight = {}
+
+    @property
+    def semaphore(self):
+        """
+        The semaphore is created on first use such that it belongs to the running loop
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        return self._semaphore
+
+    async def _lookup(self, key, fetch, fetch_argument, cache_failures=False):
+        """
+        Read the cache and only call *fetch* in case the key is not cached yet
+
+        With *cache_failures*, the failed lookups are cached as well, see
+        :func:`whereisip.getgeolocation.make_failure_entry`
+        """
+        cache = self.cache
+        if cache is None:
+            cache = await _run_blocking(open_cache, reset_cache=self.reset_cache,
+                                        write_cache=self.write_cache)
+
+        info = None
+        if not self.reset_cache:
+            info = await _run_blocking(cache.get, key)
+            if cache_failures:
+                info = read_cache_entry(info)
+
+        if info is None:
+            async with self.semaphore:
+                try:
+                    info = await _run_blocking(fetch, fetch_argument)
+                except IpErrorNoLocationFound as err:
+                    entry = make_failure_entry(err) if cache_failures else None
+                    if self.write_cache and entry is not None:
+                        await _run_blocking(cache.set, key, entry)
+                    raise
+            if self.write_cache:
+                _logger.debug(f"Writing {key} to cache")
+                await _run_blocking(cache.set, key, info)
+
+        return info
+
+    async def _coalesced(self, key, fetch, fetch_argument, cache_failures=False):
+        """
+        Let all concurrent requests for the same key wait on one single lookup
+
+        The key is the cache key, so requests sharing a cache entry share a lookup
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(key, fetch, fetch_argument,
+                                                      cache_failures=cache_failures))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            _logger.debug(f"Joining the lookup of {key} which is already running")
+        # shield the shared task such that a cancelled caller does not cancel it for the
+        # others
+        return await asyncio.shield(task)
+
+    async def get_geo_location_ip(self, ipaddress=None):
+        """
+        Get the location of the local machine of the ip address if given
+
+        Args:
+            ipaddress: str
+                Ip address
+
+        Returns: dict
+            The geo information as returned by geocoder
+        """
+        key = get_lookup_key(ipaddress)
+        geo_info = await self._coalesced(key, fetch_geo_info_ip, ipaddress,
+                                         cache_failures=True)
+        return dict(share_geo_info(geo_info, ipaddress))
+
+    async def get_geo_location_device(self, my_location=None):
+        """
+        Get the latitude/longitude from your location given by my_location
+
+        Args:
+            my_location:  str
+                Name of your device location, e.g 'Ottawa, ON'
+
+        Returns: dict
+            Location of the device with the keys *my_location*, *my_lat* and *my_lng*
+        """
+        location = find_device_in_gazetteer(my_location)
+        if location is not None:
+            return location
+        key = get_device_cache_key(my_location)
+        location = await self._coalesced(key, fetch_geo_location_device, my_location)
+        return dict(location)
+
+
+def _get_locator(reset_cache, write_cache):
+    """
+    Get the default locator with the given cache settings of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    locators = _default_locators.setdefault(loop, {})
+    settings = (reset_cache, write_cache)
+    if settings not in locators:
+        locators[settings] = AsyncGeoLocator(reset_cache=reset_cache,
+                                             write_cache=write_cache)
+    return locators[settings]
+
+
+async def get_geo_location_ip(ipaddress=None, reset_cache=False, write_cache=True):
+    """
+    asyncio version of :func:`whereisip.getgeolocation.get_geo_location_ip`
+
+    Args:
+        ipaddress: str
+            Ip address
+        reset_cache: bool
+            Reset the cache
+        write_cache:
+            Write the cache
+
+    Returns: dict
+        The geo information as returned by geocoder
+    """
+    locator = _get_locator(reset_cache=reset_cache, write_cache=write_cache)
+    return await locator.get_geo_location_ip(ipaddress)
+
+
+async def get_geo_location_device(my_location, reset_cache=False, write_cache=True):
+    """
+    asyncio version of :func:`whereisip.getgeolocation.get_geo_location_device`
+
+    Args:
+        my_location:  str
+            Name of your device location, e.g 'Ottawa, ON'
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the locations to cache file
+
+    Returns: dict
+        Location of the device with the keys *my_location*, *my_lat* and *my_lng*
+    """
+    locator = _get_locator(reset_cache=reset_cache, write_cache=write_cache)
+    return await locator.get_geo_location_device(my_location)
@@ -0,0 +1,309 @@
+"""
+Benchmarks of the lookup, cache, formatting and distance paths of whereisip
+
+The benchmarks run offline: the requests to geocoder are answered by a local stub
+provider, which makes up a location for each ip address and can wait a fixed time per
+request to mimic the network. The cache is written to a temporary directory, so the
+cache of the user is not touched.
+
+Run all benchmarks with::
+
+    python -m whereisip.benchmark
+
+For each benchmark the throughput and the latency percentiles of a single call are
+reported.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+import whereisip.getgeolocation as getgeolocation
+from whereisip.cache import CACHE_BACKENDS, DEFAULT_CACHE_BACKEND, make_cache
+from whereisip.getgeolocation import (OUTPUT_FORMATS,
+                                      LocationReport,
+                                      add_device_location,
+                                      get_geo_location_ip)
+from whereisip.utils import (get_distance_to_server,
+                             make_human_location,
+                             make_sexagesimal_location)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_N_CALLS = 1000
+PERCENTILES = (50, 90, 99)
+
+# country and city of the made up locations, one for each continent
+STUB_PLACES = [("US", "Mountain View"), ("NL", "Amsterdam"), ("AU", "Brisbane"),
+               ("BR", "Sao Paulo"), ("ZA", "Cape Town"), ("JP", "Tokyo"),
+               ("DE", "Berlin"), ("GB", "London")]
+STUB_DEVICE = {"my_location": None, "my_lat": 52.3740, "my_lng": 4.8897}
+
+BenchmarkResult = namedtuple("BenchmarkResult",
+                             ["name", "n_calls", "total", "percentiles"])
+BenchmarkResult.__doc__ = """
+Timings of one benchmark
+
+Args:
+    name: str
+        Name of the benchmark
+    n_calls: int
+        Number of timed calls
+    total: float
+        Total time of all calls in seconds
+    percentiles: dict
+        Latency of a single call in seconds per percentile
+"""
+
+
+class StubGeocode:
+    """ Mimics the result of geocoder.ip for a made up location of the ip address """
+
+    def __init__(self, ipaddress):
+        index = sum(int(part) for part in ipaddress.split(".") if part.isdigit())
+        country, city = STUB_PLACES[index % len(STUB_PLACES)]
+        self.ok = True
+        properties = {"ip": ipaddress, "status": "OK", "country": country, "city": city,
+                      "lat": -60 + (index * 7.31) % 120,
+                      "lng": -180 + (index * 13.17) % 360}
+        self.geojson = {"features": [{"properties": properties}]}
+
+
+class StubGeocoder:
+    """
+    Local replacement of the geocoder module
+
+    Args:
+        latency: float
+            Time in seconds each request waits to mimic the network
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.n_requests = 0
+
+    def ip(self, ipaddress, **kwargs):
+        self.n_requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if ipaddress == "me":
+            ipaddress = "37.97.253.1"
+        return StubGeocode(ipaddress)
+
+
+@contextmanager
+def stub_provider(latency=0.0):
+    """
+    Let whereisip use the stub provider instead of geocoder
+
+    Args:
+        latency: float
+            Time in seconds each request waits to mimic the network
+
+    Yields: StubGeocoder
+        The stub provider
+    """
+    geocoder = getgeolocation.geocoder
+    getgeolocation.geocoder = StubGeocoder(latency=latency)
+    try:
+        yield getgeolocation.geocoder
+    finally:
+        getgeolocation.geocoder = geocoder
+
+
+def make_ip_addresses(n_addresses, offset=0):
+    """ Make a list of n_addresses distinct global IPv4 addresses """
+    return [f"45.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            for i in range(offset, offset + n_addresses)]
+
+
+def make_geo_info(ipaddress):
+    """
+    Make the geo information of an ip address including the device location and distance
+    """
+    geo_info = dict(StubGeocode(ipaddress).geojson["features"][0]["properties"])
+    return add_device_location(geo_info, my_location=None, my_device_latlon=STUB_DEVICE)
+
+
+def get_percentile(sorted_values, percentile):
+    """ Get the percentile of a sorted list with the nearest rank method """
+    if not sorted_values:
+        return float("nan")
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def time_calls(name, function, arguments):
+    """
+    Time a function for each of the arguments
+
+    Args:
+        name: str
+            Name of the benchmark
+        function: callable
+            Function to time, called with one argument
+        arguments: list
+            The arguments for each call
+
+    Returns: BenchmarkResult
+        The timings
+    """
+    timings = []
+    clock = time.perf_counter
+    for argument in arguments:
+        start = clock()
+        function(argument)
+        timings.append(clock() - start)
+    total = sum(timings)
+    timings.sort()
+    percentiles = {percentile: get_percentile(timings, percentile)
+                   for percentile in PERCENTILES}
+    return BenchmarkResult(name=name, n_calls=len(timings), total=total,
+                           percentiles=percentiles)
+
+
+def run_benchmarks(n_calls=DEFAULT_N_CALLS, latency=0.0,
+                   cache_backend=DEFAULT_CACHE_BACKEND, selection=None):
+    """
+    Run the benchmarks
+
+    Args:
+        n_calls: int
+            Number of timed calls per benchmark
+        latency: float
+            Time in seconds each request of the stub provider waits to mimic the network
+        cache_backend: str
+            Name of the cache backend to use, one of CACHE_BACKENDS
+        selection: list of str
+            Only run the benchmarks of which the name starts with one of these. All if
+            None
+
+    Yields: BenchmarkResult
+        The timings per benchmark
+    """
+
+    def selected(name):
+        return selection is None or any(name.startswith(prefix) for prefix in selection)
+
+    ip_addresses = make_ip_addresses(n_calls)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, stub_provider(latency=latency):
+        # not a shared cache, as the directory is removed afterwards
+        cache = make_cache(cache_backend, Path(tmp_dir), memory_entries=0)
+        try:
+            yield from _run_benchmarks(cache, ip_addresses, selected)
+        finally:
+            cache.close()
+
+
+def _run_benchmarks(cache, ip_addresses, selected):
+    """ Time the functions selected by *selected* using *cache* for the lookups """
+
+    def lookup(ipaddress):
+        return get_geo_location_ip(ipaddress, cache=cache)
+
+    # the cold lookups fill the cache, so the warm lookups always need them
+    if selected("lookup"):
+        yield time_calls("lookup_cold", lookup, ip_addresses)
+        yield time_calls("lookup_warm", lookup, ip_addresses)
+
+    geo_infos = [make_geo_info(ipaddress) for ipaddress in ip_addresses]
+
+    if selected("report"):
+        yield time_calls("report_init", LocationReport, geo_infos)
+    for output_format in sorted(OUTPUT_FORMATS):
+        name = f"render_{output_format}"
+        if selected(name):
+            # a new report per call, as a report keeps the notations it has made
+            yield time_calls(name, lambda geo_info: LocationReport(geo_info).render(
+                output_format=output_format), geo_infos)
+
+    if selected("make_sexagesimal_location"):
+        yield time_calls("make_sexagesimal_location",
+                         lambda geo_info: make_sexagesimal_location(geo_info["lat"],
+                                                                    geo_info["lng"]),
+                         geo_infos)
+    if selected("make_human_location"):
+        yield time_calls("make_human_location",
+                         lambda geo_info: make_human_location(geo_info["country"],
+                                                              geo_info["city"]),
+                         geo_infos)
+    if selected("get_distance_to_server"):
+        yield time_calls("get_distance_to_server", get_distance_to_server, geo_infos)
+
+
+def format_results(results):
+    """
+    Make a table of the benchmark results
+
+    Args:
+        results: iterable of BenchmarkResult
+            The timings
+
+    Returns: str
+        The table with the throughput in calls per second and the latencies in
+        microseconds
+    """
+    header = (f"{'benchmark':<28}{'calls':>8}{'calls/s':>12}"
+              + "".join(f"{f'p{percentile} [us]':>12}" for percentile in PERCENTILES))
+    lines = [header, "-" * len(header)]
+    for result in results:
+        throughput = result.n_calls / result.total if result.total > 0 else float("inf")
+        latencies = "".join(f"{result.percentiles[percentile] * 1e6:>12.1f}"
+                            for percentile in PERCENTILES)
+        lines.append(f"{result.name:<28}{result.n_calls:>8d}{throughput:>12.0f}"
+                     f"{latencies}")
+    return "\n".join(lines)
+
+
+def parse_args(args):
+    """Parse the command line parameters of the benchmark
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark whereisip offline")
+    parser.add_argument("-n", "--n_calls", type=int, default=DEFAULT_N_CALLS,
+                        help="Number of timed calls per benchmark")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Time in milliseconds each request of the stub provider "
+                             "waits")
+    parser.add_argument("--cache_backend", choices=CACHE_BACKENDS,
+                        default=DEFAULT_CACHE_BACKEND,
+                        help="Cache backend to benchmark")
+    parser.add_argument("--json", action="store_true",
+                        help="Write the results as json instead of a table")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Only run the benchmarks of which the name starts with "
+                             "one of these")
+    return parser.parse_args(args)
+
+
+def main(args):
+    """ Run the benchmarks and write the results to stdout """
+    args = parse_args(args)
+    results = list(run_benchmarks(n_calls=args.n_calls, latency=args.latency / 1000,
+                                  cache_backend=args.cache_backend,
+                                  selection=args.benchmarks or None))
+    if args.json:
+        json.dump([result._asdict() for result in results], sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print(format_results(results))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,943 @@
+"""
+Cache backends used by whereisip to store the results of the lookups
+
+Two backends are available:
+
+    sqlite: all entries are stored in one indexed SQLite database file (default)
+    json:   each entry is stored in its own *resp_<key>.json* file
+
+Both backends store the entries in the user cache directory of whereisip. The cache
+files of the json backend which are found by the sqlite backend are migrated into the
+database automatically.
+
+Each entry keeps the time it was stored and the time it was last used. Entries older
+than the time-to-live (ttl) of the cache are treated as missing, so they are looked up
+again. In case the cache holds more than *max_entries* entries, the least recently used
+entries are evicted.
+
+The cache returned by :func:`get_cache` keeps the most recently used entries in memory
+as well, so repeated lookups in a long running process do not access the file system.
+
+Failed lookups can be cached as well, as a negative entry made by
+:func:`make_negative_entry`. A negative entry expires after its own, shorter
+time-to-live.
+
+Several processes can share the cache. A json cache file is replaced in one go once it
+is written, so a reader never sees a partially written entry, and an entry which can not
+be read is treated as missing. With :meth:`CacheBackend.lock` the threads and processes
+which miss the same key wait for the one which looks it up, instead of all making the
+same request.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # there are no lock files on Windows, so only the threads of one process share a
+    # lookup
+    fcntl = None
+
+from whereisip.utils import (get_cache_dir,
+                             get_cache_file,
+                             read_cache_file,
+                             write_cache_file)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+CACHE_BACKENDS = {"sqlite", "json"}
+DEFAULT_CACHE_BACKEND = "sqlite"
+
+# entries are refreshed after 30 days
+DEFAULT_CACHE_TTL = 30 * 24 * 3600
+DEFAULT_CACHE_MAX_ENTRIES = 100000
+
+# failed lookups are tried again after one day, as the address may have a location by
+# then
+DEFAULT_NEGATIVE_CACHE_TTL = 24 * 3600
+NEGATIVE_ENTRY_KEY = "not_found"
+NEGATIVE_EXPIRES_KEY = "not_found_expires"
+
+# number of entries kept in memory in front of the cache on disk
+DEFAULT_MEMORY_ENTRIES = 4096
+
+SQLITE_CACHE_FILE = "whereisip.sqlite"
+SQLITE_SCHEMA_VERSION = 2
+# the last use of an sqlite entry is only written again once it is older than this
+# number of seconds, such that a cache hit usually does not write to the database
+SQLITE_ACCESS_INTERVAL = 3600
+
+# the json backend counts its files only once per this number of writes
+JSON_EVICT_INTERVAL = 100
+
+# one cache object per backend, directory and settings, shared by all threads of the
+# process
+_caches = {}
+_caches_lock = threading.Lock()
+
+# the lock files shared between processes are kept in this subdirectory of the cache.
+# The keys are spread over a fixed number of lock files, so the number of files stays
+# bounded
+LOCK_DIR = "locks"
+N_LOCK_FILES = 256
+
+# the locks of the keys which are being looked up by the threads of this process, with
+# the number of threads using each lock
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _lock_file(key, lock_dir):
+    """ Hold the lock file of the key, such that other processes wait for it """
+    if lock_dir is None or fcntl is None:
+        yield
+        return
+    lock_dir = Path(lock_dir)
+    lock_dir.mkdir(exist_ok=True, parents=True)
+    lock_file = lock_dir / f"lock_{zlib.crc32(key.encode()) % N_LOCK_FILES:03d}"
+    with open(lock_file, "a") as stream:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def lock_key(key, lock_dir=None):
+    """
+    Lock a cache key, such that only one thread or process at a time looks it up
+
+    Args:
+        key: str
+            The cache key
+        lock_dir: Path
+            Directory of the lock files shared with other processes. If None, only the
+            threads of this process are locked out
+    """
+    with _key_locks_lock:
+        key_lock = _key_locks.setdefault(key, [threading.Lock(), 0])
+        key_lock[1] += 1
+    try:
+        with key_lock[0], _lock_file(key, lock_dir):
+            yield
+    finally:
+        with _key_locks_lock:
+            key_lock[1] -= 1
+            if key_lock[1] == 0:
+                del _key_locks[key]
+
+
+def make_negative_entry(message, ttl=DEFAULT_NEGATIVE_CACHE_TTL, now=None):
+    """
+    Make the cache entry of a failed lookup
+
+    Args:
+        message: str
+            The reason of the failure
+        ttl: float
+            Time-to-live of the entry in seconds
+        now: float
+            The current time. Defaults to time.time()
+
+    Returns: dict
+        The entry
+    """
+    if now is None:
+        now = time.time()
+    return {NEGATIVE_ENTRY_KEY: message, NEGATIVE_EXPIRES_KEY: now + ttl}
+
+
+def is_negative_entry(info):
+    """ Check if a cache entry is the entry of a failed lookup """
+    return NEGATIVE_ENTRY_KEY in info
+
+
+def is_negative_entry_expired(info, now=None):
+    """
+    Check if the entry of a failed lookup has passed its time-to-live
+
+    Args:
+        info: dict
+            The negative entry
+        now: float
+            The current time. Defaults to time.time()
+
+    Returns: bool
+        True if the lookup should be tried again
+    """
+    if now is None:
+        now = time.time()
+    return now > info.get(NEGATIVE_EXPIRES_KEY, 0)
+
+
+class CacheBackend:
+    """
+    Base class of the cache backends. The entries are dictionaries stored under a string
+    key
+
+    Args:
+        ttl: float
+            Time-to-live of the entries in seconds. None means that the entries never
+            expire
+        max_entries: int
+            Maximum number of entries. None means that the size of the cache is not
+            bounded
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def is_expired(self, created, now=None):
+        """
+        Check if an entry stored at time *created* is expired
+
+        Args:
+            created: float
+                Time stamp at which the entry was stored
+            now: float
+                Current time stamp. Defaults to time.time()
+
+        Returns: bool
+            True if the entry is older than the time-to-live
+        """
+        if self.ttl is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - created > self.ttl
+
+    def get(self, key):
+        """
+        Get an entry from the cache
+
+        Args:
+            key: str
+                Key of the entry
+
+        Returns: dict
+            The cached entry or None if the key is not in the cache or is expired
+        """
+        raise NotImplementedError
+
+    def set(self, key, info):
+        """
+        Store an entry in the cache
+
+        Args:
+            key: str
+                Key of the entry
+            info: dict
+                The entry to store
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Remove the entry *key* from the cache if it exists """
+        raise NotImplementedError
+
+    def keys(self):
+        """ Get a list of all keys in the cache, including the expired ones """
+        raise NotImplementedError
+
+    def scan(self):
+        """
+        Iterate over the entries which are not expired, without marking them as recently
+        used, e.g. to report on the contents of the cache
+
+        Yields: tuple
+            The key and the entry
+        """
+        raise NotImplementedError
+
+    def prune(self):
+        """
+        Remove the expired entries and evict the least recently used entries above
+        *max_entries*
+
+        Returns: int
+            Number of removed entries
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """
+        Get many entries from the cache at once
+
+        Args:
+            keys: iterable of str
+                Keys of the entries
+
+        Returns: dict
+            The cached entries per key. Keys which are not in the cache are left out
+        """
+        entries = dict()
+        for key in keys:
+            info = self.get(key)
+            if info is not None:
+                entries[key] = info
+        return entries
+
+    def get_many_with_created(self, keys):
+        """
+        Get many entries from the cache at once together with the time they were stored
+
+        Backends which do not keep the time an entry was stored give the current time
+
+        Args:
+            keys: iterable of str
+                Keys of the entries
+
+        Returns: dict
+            Tuples (entry, created) per key. Keys which are not in the cache are left
+            out
+        """
+        now = time.time()
+        return {key: (info, now) for key, info in self.get_many(keys).items()}
+
+    def set_many(self, entries):
+        """
+        Store many entries in the cache at once
+
+        Args:
+            entries: dict
+                The entries to store per key
+        """
+        for key, info in entries.items():
+            self.set(key, info)
+
+    def lock(self, key):
+        """
+        Lock a key while it is looked up, such that other threads and processes missing
+        the same key wait for the result instead of looking it up as well
+
+        Use it as ``with cache.lock(key): ...`` and read the cache again once the lock
+        is held
+
+        Args:
+            key: str
+                Key of the entry
+
+        Returns:
+            The context manager holding the lock
+        """
+        return lock_key(key)
+
+    def close(self):
+        """ Release the resources held by the cache """
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class JsonFileCache(CacheBackend):
+    """
+    Cache storing each entry in a separate *resp_<key>.json* file
+
+    The modification time of a file is the time the entry was stored, the access time is
+    set explicitly each time the entry is read.
+
+    Args:
+        cache_dir: Path
+            Directory of the cache files
+        ttl: float
+            Time-to-live of the entries in seconds. None means that the entries never
+            expire
+        max_entries: int
+            Maximum number of entries. None means that the size of the cache is not
+            bounded
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_CACHE_TTL,
+                 max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self.cache_dir = Path(cache_dir)
+        self._n_writes = 0
+
+    def _get_with_created(self, key):
+        """ Get an entry and its modification time, None if it is missing or expired """
+        cache_file = get_cache_file(key, cache_dir=self.cache_dir)
+        try:
+            modification_time = cache_file.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if self.is_expired(modification_time, now=now):
+            _logger.debug(f"Cache entry {key} is expired")
+            return None
+        info = read_cache_file(cache_file)
+        if info is None:
+            return None
+        # keep the modification time as the time the entry was stored
+        try:
+            os.utime(cache_file, (now, modification_time))
+        except FileNotFoundError:
+            pass
+        return info, modification_time
+
+    def get(self, key):
+        entry = self._get_with_created(key)
+        return None if entry is None else entry[0]
+
+    def get_many_with_created(self, keys):
+        entries = dict()
+        for key in keys:
+            entry = self._get_with_created(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def lock(self, key):
+        return lock_key(key, lock_dir=self.cache_dir / LOCK_DIR)
+
+    def _write(self, key, info):
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        write_cache_file(get_cache_file(key, cache_dir=self.cache_dir), info)
+        self._n_writes += 1
+
+    def set(self, key, info):
+        self._write(key, info)
+        if self.max_entries is not None and self._n_writes % JSON_EVICT_INTERVAL == 0:
+            self.prune()
+
+    def set_many(self, entries):
+        for key, info in entries.items():
+            self._write(key, info)
+        if self.max_entries is not None and entries:
+            self.prune()
+
+    def delete(self, key):
+        cache_file = get_cache_file(key, cache_dir=self.cache_dir)
+        try:
+            cache_file.unlink()
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        return [cache_file.stem[len("resp_"):]
+                for cache_file in self.cache_dir.glob("resp_*.json")]
+
+    def scan(self):
+        now = time.time()
+        for cache_file in self.cache_dir.glob("resp_*.json"):
+            try:
+                stat = cache_file.stat()
+            except FileNotFoundError:
+                continue
+            if self.is_expired(stat.st_mtime, now=now):
+                continue
+            info = read_cache_file(cache_file)
+            if info is None:
+                continue
+            # the file system may have set the access time, which is the last use of the
+            # entry
+            try:
+                os.utime(cache_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            except FileNotFoundError:
+                pass
+            yield cache_file.stem[len("resp_"):], info
+
+    def prune(self):
+        now = time.time()
+        entries = []
+        n_removed = 0
+        for cache_file in self.cache_dir.glob("resp_*.json"):
+            try:
+                stat = cache_file.stat()
+                if self.is_expired(stat.st_mtime, now=now):
+                    cache_file.unlink()
+                    n_removed += 1
+                else:
+                    entries.append((stat.st_atime, cache_file))
+            except FileNotFoundError:
+                continue
+        if self.max_entries is not None and len(entries) > self.max_entries:
+            entries.sort()
+            for _, cache_file in entries[:len(entries) - self.max_entries]:
+                try:
+                    cache_file.unlink()
+                    n_removed += 1
+                except FileNotFoundError:
+                    continue
+        return n_removed
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache storing all entries in one SQLite database
+
+    The keys are the primary key of the table, so a lookup is an index search instead of
+    a file system access. The connection is shared by all threads of the process. The
+    database is in write-ahead log mode, so the processes reading the cache do not wait
+    for the one writing it.
+
+    Args:
+        cache_file: Path
+            The database file
+        ttl: float
+            Time-to-live of the entries in seconds. None means that the entries never
+            expire
+        max_entries: int
+            Maximum number of entries. None means that the size of the cache is not
+            bounded
+        migrate: bool
+            Move the *resp_<key>.json* files of the json backend found next to the
+            database file into the database
+        access_interval: float
+            Seconds after which the last use of an entry is updated when it is read. A
+            coarse interval keeps the least recently used order for eviction while most
+            reads do not write to the database
+    """
+
+    def __init__(self, cache_file, ttl=DEFAULT_CACHE_TTL,
+                 max_entries=DEFAULT_CACHE_MAX_ENTRIES, migrate=True,
+                 access_interval=SQLITE_ACCESS_INTERVAL):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self.access_interval = access_interval
+        self.cache_file = Path(cache_file)
+        self.cache_file.parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(str(self.cache_file), timeout=30,
+                                           check_same_thread=False)
+        self._create_tables()
+        if migrate:
+            self.migrate_json_files(self.cache_file.parent)
+
+    def _create_tables(self):
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            columns = [row[1] for row
+                       in self._connection.execute("PRAGMA table_info(entries)")]
+            for column in ("created", "accessed"):
+                if column not in columns:
+                    # the first schema version did not keep time stamps: treat the
+                    # entries as new
+                    self._connection.execute(f"ALTER TABLE entries ADD COLUMN {column} "
+                                             f"REAL NOT NULL DEFAULT {time.time()}")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._connection.execute(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+
+    def _oldest_valid(self, now):
+        """ Time stamp of the oldest entry which is not expired """
+        if self.ttl is None:
+            return float("-inf")
+        return now - self.ttl
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        return {key: info
+                for key, (info, _) in self.get_many_with_created(keys).items()}
+
+    def get_many_with_created(self, keys):
+        keys = list(keys)
+        entries = dict()
+        used = []
+        now = time.time()
+        oldest_valid = self._oldest_valid(now)
+        # stay below the maximum number of host parameters of sqlite
+        chunk_size = 500
+        with self._lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT key, value, created, accessed FROM entries "
+                    f"WHERE key IN ({placeholders}) AND created >= ?",
+                    chunk + [oldest_valid])
+                for key, value, created, accessed in rows:
+                    try:
+                        info = json.loads(value)
+                    except ValueError:
+                        info = None
+                    if isinstance(info, dict):
+                        entries[key] = (info, created)
+                        if now - accessed > self.access_interval:
+                            used.append(key)
+                    else:
+                        # a corrupt entry is looked up again and overwritten
+                        _logger.warning(f"Ignoring corrupt cache entry {key}")
+            if used:
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE entries SET accessed = ? WHERE key = ?",
+                        [(now, key) for key in used])
+        return entries
+
+    def set(self, key, info):
+        self.set_many({key: info})
+
+    def set_many(self, entries):
+        """ Store all entries in one single transaction """
+        now = time.time()
+        self._insert([(key, json.dumps(info), now, now)
+                      for key, info in entries.items()])
+
+    def _insert(self, rows):
+        """ Insert rows of (key, value, created, accessed) in one transaction """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)", rows)
+            if self.max_entries is not None:
+                self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used entries above max_entries """
+        n_entries, = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        n_evict = n_entries - self.max_entries
+        if n_evict <= 0:
+            return 0
+        _logger.debug(f"Evicting {n_evict} least recently used cache entries")
+        self._connection.execute(
+            "DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY accessed LIMIT ?)", (n_evict,))
+        return n_evict
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def lock(self, key):
+        return lock_key(key, lock_dir=self.cache_file.parent / LOCK_DIR)
+
+    def keys(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT key FROM entries")
+            return [row[0] for row in rows]
+
+    def scan(self):
+        oldest_valid = self._oldest_valid(time.time())
+        # read in chunks, such that the lock is not held while the caller handles the
+        # entries
+        chunk_size = 500
+        last_key = ""
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key, value FROM entries WHERE key > ? AND created >= ? "
+                    "ORDER BY key LIMIT ?",
+                    (last_key, oldest_valid, chunk_size)).fetchall()
+            for key, value in rows:
+                try:
+                    info = json.loads(value)
+                except ValueError:
+                    continue
+                if isinstance(info, dict):
+                    yield key, info
+            if len(rows) < chunk_size:
+                break
+            last_key = rows[-1][0]
+
+    def prune(self):
+        oldest_valid = self._oldest_valid(time.time())
+        with self._lock, self._connection:
+            n_removed = self._connection.execute(
+                "DELETE FROM entries WHERE created < ?", (oldest_valid,)).rowcount
+            if self.max_entries is not None:
+                n_removed += self._evict()
+        return n_removed
+
+    def __len__(self):
+        with self._lock:
+            n_entries, = self._connection.execute(
+                "SELECT COUNT(*) FROM entries").fetchone()
+            return n_entries
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def migrate_json_files(self, cache_dir):
+        """
+        Move the cache files of the json backend into the database
+
+        Args:
+            cache_dir: Path
+                Directory with the *resp_<key>.json* files. The files are removed once
+                they are stored in the database
+
+        Returns: int
+            Number of migrated cache files
+        """
+        json_cache = JsonFileCache(cache_dir, ttl=None, max_entries=None)
+        keys = json_cache.keys()
+        if not keys:
+            return 0
+
+        _logger.info(f"Migrating {len(keys)} cache files from {cache_dir} into "
+                     f"{self.cache_file}")
+        # do not overwrite newer entries which are already in the database
+        existing = self.get_many(keys)
+        rows = []
+        for key in keys:
+            if key in existing:
+                continue
+            cache_file = get_cache_file(key, cache_dir=cache_dir)
+            try:
+                # another process may migrate or remove the file at the same time
+                created = cache_file.stat().st_mtime
+                info = read_cache_file(cache_file)
+            except OSError as err:
+                _logger.debug(f"Skipping cache file for {key}: {err}")
+                continue
+            if info is None:
+                _logger.warning(f"Skipping unreadable cache file for {key}")
+                continue
+            rows.append((key, json.dumps(info), created, created))
+        self._insert(rows)
+
+        for key in keys:
+            json_cache.delete(key)
+        return len(rows)
+
+
+class MemoryCache(CacheBackend):
+    """
+    Bounded least recently used cache in memory in front of another cache
+
+    Entries found in memory are returned without accessing the cache behind it. New
+    entries are written to both. The memory is shared by all threads of the process.
+
+    Args:
+        backend: CacheBackend
+            The cache behind the memory cache, usually a cache on disk
+        max_entries: int
+            Maximum number of entries kept in memory
+
+    Attributes:
+        hits: int
+            Number of entries found in memory
+        backend_hits: int
+            Number of entries not found in memory, but found in the backend
+        misses: int
+            Number of entries found nowhere
+    """
+
+    def __init__(self, backend, max_entries=DEFAULT_MEMORY_ENTRIES):
+        # the time-to-live is taken from the backend
+        self.backend = backend
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        """ The time-to-live is the one of the backend """
+        return self.backend.ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self.backend.ttl = ttl
+
+    @property
+    def hit_ratio(self):
+        """
+        Fraction of the requested entries which were found in memory or in the backend
+        """
+        n_requests = self.hits + self.backend_hits + self.misses
+        if n_requests == 0:
+            return 0.0
+        return (self.hits + self.backend_hits) / n_requests
+
+    def _remember(self, key, info, created):
+        """ Store an entry in memory. Must be called with the lock held """
+        self._entries[key] = (dict(info), created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _recall(self, key, now):
+        """ Get an entry from memory. Must be called with the lock held """
+        try:
+            info, created = self._entries[key]
+        except KeyError:
+            return None
+        if self.is_expired(created, now=now):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        # return a copy, as the callers are allowed to modify the entry
+        return dict(info)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        now = time.time()
+        entries = dict()
+        missing = []
+        with self._lock:
+            for key in keys:
+                info = self._recall(key, now)
+                if info is None:
+                    missing.append(key)
+                else:
+                    entries[key] = info
+            self.hits += len(entries)
+        if not missing:
+            return entries
+
+        # keep the time the entry was stored in the backend, such that it expires in
+        # memory at the same time as in the backend
+        found = self.backend.get_many_with_created(missing)
+        with self._lock:
+            self.backend_hits += len(found)
+            self.misses += len(missing) - len(found)
+            for key, (info, created) in found.items():
+                self._remember(key, info, created=created)
+        entries.update((key, dict(info)) for key, (info, _) in found.items())
+        return entries
+
+    def set(self, key, info):
+        self.set_many({key: info})
+
+    def set_many(self, entries):
+        self.backend.set_many(entries)
+        now = time.time()
+        with self._lock:
+            for key, info in entries.items():
+                self._remember(key, info, created=now)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self.backend.delete(key)
+
+    def keys(self):
+        return self.backend.keys()
+
+    def scan(self):
+        return self.backend.scan()
+
+    def lock(self, key):
+        return self.backend.lock(key)
+
+    def prune(self):
+        with self._lock:
+            self._entries.clear()
+        return self.backend.prune()
+
+    def clear_memory(self):
+        """ Forget the entries kept in memory and reset the counters """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.backend_hits = self.misses = 0
+
+    def close(self):
+        self.backend.close()
+
+    def __len__(self):
+        return len(self.backend)
+
+
+def make_cache(backend, cache_dir, ttl=DEFAULT_CACHE_TTL,
+               max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+               memory_entries=DEFAULT_MEMORY_ENTRIES):
+    """
+    Open a new cache object of a backend, which is not shared. Close it once it is not
+    needed
+
+    Args:
+        backend: str
+            Name of the backend, one of CACHE_BACKENDS
+        cache_dir: Path
+            Directory of the cache
+        ttl: float
+            Time-to-live of the entries in seconds. None means that the entries never
+            expire
+        max_entries: int
+            Maximum number of entries. None means that the size of the cache is not
+            bounded
+        memory_entries: int
+            Number of entries kept in memory in front of the backend. Use 0 to always
+            access the backend
+
+    Returns: CacheBackend
+        The cache object
+    """
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Cache backend {backend} not recognised. "
+                         f"Choose from {CACHE_BACKENDS}")
+    if backend == "sqlite":
+        cache = SQLiteCache(Path(cache_dir) / SQLITE_CACHE_FILE, ttl=ttl,
+                            max_entries=max_entries)
+    else:
+        cache = JsonFileCache(cache_dir, ttl=ttl, max_entries=max_entries)
+    if memory_entries:
+        cache = MemoryCache(cache, max_entries=memory_entries)
+    return cache
+
+
+def get_cache(backend=None, cache_dir=None, ttl=DEFAULT_CACHE_TTL,
+              max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+              memory_entries=DEFAULT_MEMORY_ENTRIES):
+    """
+    Get the cache object of a backend
+
+    The cache objects are shared, so calling this function many times opens the cache
+    only once
+
+    Args:
+        backend: str
+            Name of the backend, one of CACHE_BACKENDS. Defaults to
+            DEFAULT_CACHE_BACKEND
+        cache_dir: Path
+            Directory of the cache. Defaults to the user cache directory of whereisip
+        ttl: float
+            Time-to-live of the entries in seconds. None means that the entries never
+            expire
+        max_entries: int
+            Maximum number of entries. None means that the size of the cache is not
+            bounded
+        memory_entries: int
+            Number of entries kept in memory in front of the backend. Use 0 to always
+            access the backend
+
+    Returns: CacheBackend
+        The cache object
+    """
+    if backend is None:
+        backend = DEFAULT_CACHE_BACKEND
+    if backend not in CACHE_BACKENDS:
+        raise ValueError(f"Cache backend {backend} not recognised. "
+                         f"Choose from {CACHE_BACKENDS}")
+    if cache_dir is None:
+        # the backends create the directory once they write to it
+        cache_dir = get_cache_dir(write_cache=False)
+
+    cache_id = (backend, str(cache_dir), ttl, max_entries, memory_entries)
+    with _caches_lock:
+        cache = _caches.get(cache_id)
+        if cache is None:
+            cache = make_cache(backend, cache_dir, ttl=ttl, max_entries=max_entries,
+                               memory_entries=memory_entries)
+            _caches[cache_id] = cache
+    return cache
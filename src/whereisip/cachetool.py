@@ -0,0 +1,265 @@
+"""
+Maintenance of the cache: filling it in advance, reporting its contents and cleaning it
+
+``whereisip cache warm`` looks up a list of known addresses before they are needed, e.g.
+the edges of a CDN or the egress addresses of customers, such that the lookups during a
+traffic peak are all cache hits::
+
+    whereisip cache warm 8.8.8.8 192.0.2.0/24 edges.txt --rate_limit 20
+
+The addresses can be given as ip addresses, CIDR blocks or files with one address or
+block per line. Addresses which are in the cache already are skipped. ``whereisip cache
+stats`` reports the number and size of the entries and ``whereisip cache prune`` removes
+the expired ones.
+"""
+
+import ipaddress as ipaddr
+import logging
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from whereisip.cache import is_negative_entry, is_negative_entry_expired
+from whereisip.getgeolocation import (DEFAULT_WORKERS,
+                                      IpErrorNoLocationFound,
+                                      get_geo_location_ip,
+                                      get_lookup_key)
+from whereisip.providers import TokenBucket
+from whereisip.utils import read_ip_addresses
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# requests per second of a warm up, unless a rate limit is given
+DEFAULT_WARM_RATE = 10.0
+# largest CIDR block which is expanded, to prevent an IPv6 block from filling the memory
+MAX_BLOCK_SIZE = 65536
+
+WarmResult = namedtuple("WarmResult",
+                        ["n_addresses", "n_fresh", "n_fetched", "n_failed"])
+WarmResult.__doc__ = """
+Counts of a warm up of the cache by :func:`warm_cache`
+
+Args:
+    n_addresses: int
+        Number of distinct addresses, or of distinct networks with prefix aggregation
+    n_fresh: int
+        Number of addresses which were in the cache already
+    n_fetched: int
+        Number of addresses looked up and stored in the cache
+    n_failed: int
+        Number of addresses for which the lookup failed
+"""
+
+
+def expand_target(target, max_block_size=MAX_BLOCK_SIZE):
+    """
+    Get the ip addresses of an ip address or a CIDR block
+
+    Args:
+        target: str
+            An ip address, e.g. '8.8.8.8', or a CIDR block, e.g. '192.0.2.0/24'
+        max_block_size: int
+            Maximum number of addresses of a block
+
+    Yields: str
+        The addresses. For a block, the network and broadcast addresses are left out
+
+    Raises:
+        ValueError: in case the target is not an address or block or the block is too
+            large
+    """
+    if "/" not in target:
+        yield str(ipaddr.ip_address(target))
+        return
+    network = ipaddr.ip_network(target, strict=False)
+    if network.num_addresses > max_block_size:
+        raise ValueError(f"Block {target} has {network.num_addresses} addresses, which "
+                         f"is more than the maximum of {max_block_size}")
+    if network.num_addresses == 1:
+        yield str(network.network_address)
+    else:
+        for address in network.hosts():
+            yield str(address)
+
+
+def expand_targets(targets, max_block_size=MAX_BLOCK_SIZE):
+    """
+    Get the ip addresses of the targets of a warm up
+
+    Args:
+        targets: iterable of str
+            Ip addresses, CIDR blocks or files with one address or block per line. Use
+            '-' to read the addresses from stdin
+        max_block_size: int
+            Maximum number of addresses of a block
+
+    Yields: str
+        The addresses
+
+    Raises:
+        ValueError: in case a target is not an address, block or file
+    """
+    for target in targets:
+        if target == "-":
+            for line in read_ip_addresses(sys.stdin):
+                yield from expand_target(line, max_block_size=max_block_size)
+        elif Path(target).is_file():
+            with open(target, "r") as stream:
+                for line in read_ip_addresses(stream):
+                    yield from expand_target(line, max_block_size=max_block_size)
+        else:
+            yield from expand_target(target, max_block_size=max_block_size)
+
+
+def is_fresh(entry):
+    """ Check if a cache entry does not need to be looked up again """
+    return entry is not None and not (is_negative_entry(entry)
+                                      and is_negative_entry_expired(entry))
+
+
+def warm_cache(ipaddresses, cache, rate_limit=DEFAULT_WARM_RATE,
+               workers=DEFAULT_WORKERS, progress=None):
+    """
+    Look up the addresses which are not in the cache yet, such that they are cached
+
+    Args:
+        ipaddresses: iterable of str
+            The addresses to warm up. Duplicates and, with prefix aggregation, addresses
+            in the same network are looked up once
+        cache: CacheBackend
+            The cache to fill
+        rate_limit: float
+            Maximum number of lookups per second. None for no limit
+        workers: int
+            Maximum number of lookups running at the same time
+        progress: file
+            Stream to write the progress to, e.g. sys.stderr. None for no progress
+
+    Returns: WarmResult
+        The counts of the warm up
+    """
+    # one address per cache entry
+    keys = dict()
+    for ipaddress in ipaddresses:
+        keys.setdefault(get_lookup_key(ipaddress), ipaddress)
+    entries = cache.get_many(keys)
+    ipaddresses = list(keys.values())
+    missing = [ipaddress for key, ipaddress in keys.items()
+               if not is_fresh(entries.get(key))]
+    n_fresh = len(ipaddresses) - len(missing)
+    _logger.info(f"{n_fresh} of {len(ipaddresses)} addresses are in the cache already")
+
+    rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+    lock = threading.Lock()
+    counts = {"done": 0, "failed": 0}
+    last_report = [0.0]
+
+    def report_progress(final=False):
+        now = time.monotonic()
+        if progress is None or (not final and now - last_report[0] < 0.5):
+            return
+        last_report[0] = now
+        progress.write(f"\rwarmed {counts['done']}/{len(missing)} addresses "
+                       f"({counts['failed']} failed)" + ("\n" if final else ""))
+        progress.flush()
+
+    def fetch(ipaddress):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            get_geo_location_ip(ipaddress, cache=cache)
+            failed = False
+        except IpErrorNoLocationFound as err:
+            _logger.debug(f"Failed to warm up {ipaddress}: {err}")
+            failed = True
+        with lock:
+            counts["done"] += 1
+            counts["failed"] += failed
+            report_progress()
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # consume the results to raise the unexpected errors of the lookups
+            list(executor.map(fetch, missing))
+        report_progress(final=True)
+
+    return WarmResult(n_addresses=len(ipaddresses), n_fresh=n_fresh,
+                      n_fetched=len(missing) - counts["failed"],
+                      n_failed=counts["failed"])
+
+
+def get_cache_stats(cache, cache_dir):
+    """
+    Count the entries in the cache
+
+    Args:
+        cache: CacheBackend
+            The cache
+        cache_dir: Path
+            The directory of the cache files
+
+    Returns: dict
+        The number of *entries*, the number of *fresh*, *expired* and *negative*
+        entries, the *size* of the cache directory in bytes and the *directory* itself
+    """
+    # scan the entries, so the least recently used order of the cache is kept
+    n_entries = len(cache)
+    n_valid = n_negative = 0
+    for _, entry in cache.scan():
+        n_valid += 1
+        n_negative += is_negative_entry(entry)
+    cache_dir = Path(cache_dir)
+    size = sum(path.stat().st_size for path in cache_dir.glob("*") if path.is_file())
+    return {"directory": str(cache_dir),
+            "entries": n_entries,
+            "fresh": n_valid - n_negative,
+            "negative": n_negative,
+            "expired": max(0, n_entries - n_valid),
+            "size": size}
+
+
+def format_cache_stats(stats):
+    """
+    Make a table of the cache stats
+
+    Args:
+        stats: dict
+            The stats as returned by :func:`get_cache_stats`
+
+    Returns: str
+        One line per item
+    """
+    lines = [f"{'directory':<12}: {stats['directory']}"]
+    for name in ("entries", "fresh", "negative", "expired"):
+        lines.append(f"{name:<12}: {stats[name]}")
+    lines.append(f"{'size':<12}: {stats['size'] / 1024:.1f} kB")
+    return "\n".join(lines)
+
+
+def prune_cache(cache):
+    """
+    Remove the expired entries from the cache, including the failed lookups which may be
+    tried again
+
+    Args:
+        cache: CacheBackend
+            The cache
+
+    Returns: int
+        Number of removed entries
+    """
+    n_removed = cache.prune()
+    # collect the keys first, as the entries can not be deleted while the cache is
+    # scanned
+    expired = [key for key, entry in cache.scan()
+               if is_negative_entry(entry) and is_negative_entry_expired(entry)]
+    for key in expired:
+        cache.delete(key)
+    return n_removed + len(expired)
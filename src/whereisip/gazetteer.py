@@ -0,0 +1,307 @@
+"""
+Offline gazetteer of major cities, used to locate the device without a request to
+geocoder
+
+A place such as "Amsterdam, NL" or "amsterdam,the netherlands" is normalized by
+:func:`normalize_place` to a key *city,country code*, e.g. "amsterdam,nl", which is
+looked up in the table of cities at the end of this module. The table is sorted on the
+key, so a place is found with a binary search and all places starting with a prefix are
+next to each other::
+
+    >>> lookup_place("Amsterdam, The Netherlands").country
+    'NL'
+    >>> [place.city for place in search_places("san")]
+    ['San Antonio', 'San Diego', 'San Francisco', 'San Jose', 'Santiago']
+"""
+
+import logging
+import unicodedata
+from bisect import bisect_left
+from collections import namedtuple
+
+from whereisip.countries import COUNTRY_NAMES
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# other names of countries used in place names, next to the names in COUNTRY_NAMES
+COUNTRY_ALIASES = {"usa": "US", "united states of america": "US", "america": "US",
+                   "uk": "GB", "great britain": "GB", "england": "GB", "scotland": "GB",
+                   "holland": "NL", "deutschland": "DE", "nederland": "NL",
+                   "korea": "KR", "russian federation": "RU", "czech republic": "CZ"}
+
+Place = namedtuple("Place", ["city", "country", "lat", "lng"])
+Place.__doc__ = """
+A city of the gazetteer
+
+Args:
+    city: str
+        Name of the city
+    country: str
+        Two letter code of the country
+    lat: float
+        Latitude of the city center
+    lng: float
+        Longitude of the city center
+"""
+
+# the country codes per normalized country name, made on first use
+_country_codes = None
+
+
+def _fold(text):
+    """ Lower case the text without accents and with single spaces """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(character for character in text
+                   if not unicodedata.combining(character))
+    return " ".join(text.casefold().split())
+
+
+def get_country_code(name):
+    """
+    Get the country code of a country name
+
+    Args:
+        name: str
+            Name or two letter code of a country, e.g. 'The Netherlands', 'usa' or 'NL'
+
+    Returns: str
+        The two letter code in upper case, None if the country is not known
+    """
+    global _country_codes
+    if _country_codes is None:
+        codes = {_fold(code): code for code in COUNTRY_NAMES}
+        codes.update((_fold(country), code) for code, country in COUNTRY_NAMES.items())
+        codes.update(COUNTRY_ALIASES)
+        _country_codes = codes
+    name = _fold(name)
+    if name.startswith("the "):
+        name = name[len("the "):]
+    return _country_codes.get(name)
+
+
+def normalize_place(place):
+    """
+    Normalize the name of a place, such that different spellings give the same key
+
+    The name is lower cased without accents and superfluous spaces, and a country at the
+    end is replaced by its two letter code, so "Amsterdam, The Netherlands" gives
+    "amsterdam,nl"
+
+    Args:
+        place: str
+            Name of the place, e.g. 'city, country'
+
+    Returns: str
+        The normalized name
+    """
+    parts = [_fold(part) for part in place.split(",")]
+    parts = [part for part in parts if part]
+    if len(parts) > 1:
+        code = get_country_code(parts[-1])
+        if code is not None:
+            parts[-1] = code.lower()
+    return ",".join(parts)
+
+
+def search_places(prefix, limit=10):
+    """
+    Get the places of which the normalized name starts with a prefix
+
+    Args:
+        prefix: str
+            Start of the place name, e.g. 'san' or 'london,'
+        limit: int
+            Maximum number of places returned
+
+    Returns: list of Place
+        The places in order of their normalized name
+    """
+    prefix = _fold(prefix)
+    places = []
+    for index in range(bisect_left(PLACE_KEYS, prefix), len(PLACE_KEYS)):
+        if len(places) == limit or not PLACE_KEYS[index].startswith(prefix):
+            break
+        places.append(Place(*GAZETTEER[index][1:]))
+    return places
+
+
+def lookup_place(place):
+    """
+    Find a place in the gazetteer
+
+    A place is found by its city and country, e.g. 'Sydney, Australia'. A place given by
+    its city only is found if there is one city with that name in the gazetteer. A
+    region in between the city and the country, e.g. 'Mountain View, CA, USA', is
+    ignored
+
+    Args:
+        place: str
+            Name of the place
+
+    Returns: Place
+        The place, None if it is not in the gazetteer
+    """
+    parts = normalize_place(place).split(",")
+    if len(parts) == 1:
+        matches = search_places(parts[0] + ",", limit=2)
+        return matches[0] if len(matches) == 1 else None
+
+    key = f"{parts[0]},{parts[-1]}"
+    index = bisect_left(PLACE_KEYS, key)
+    if index < len(PLACE_KEYS) and PLACE_KEYS[index] == key:
+        return Place(*GAZETTEER[index][1:])
+    return None
+
+
+# the normalized name, city, country, latitude and longitude of the major cities, sorted
+# on the normalized name. Keep the table sorted when adding a city
+GAZETTEER = (
+    ("accra,gh", "Accra", "GH", 5.6037, -0.1870),
+    ("addis ababa,et", "Addis Ababa", "ET", 9.0300, 38.7400),
+    ("algiers,dz", "Algiers", "DZ", 36.7538, 3.0588),
+    ("amsterdam,nl", "Amsterdam", "NL", 52.3727598, 4.8936041),
+    ("ankara,tr", "Ankara", "TR", 39.9334, 32.8597),
+    ("antwerp,be", "Antwerp", "BE", 51.2194, 4.4025),
+    ("athens,gr", "Athens", "GR", 37.9838, 23.7275),
+    ("atlanta,us", "Atlanta", "US", 33.7490, -84.3880),
+    ("auckland,nz", "Auckland", "NZ", -36.8485, 174.7633),
+    ("austin,us", "Austin", "US", 30.2672, -97.7431),
+    ("baghdad,iq", "Baghdad", "IQ", 33.3152, 44.3661),
+    ("bangalore,in", "Bangalore", "IN", 12.9716, 77.5946),
+    ("bangkok,th", "Bangkok", "TH", 13.7563, 100.5018),
+    ("barcelona,es", "Barcelona", "ES", 41.3874, 2.1686),
+    ("beijing,cn", "Beijing", "CN", 39.9042, 116.4074),
+    ("belgrade,rs", "Belgrade", "RS", 44.7866, 20.4489),
+    ("berlin,de", "Berlin", "DE", 52.5200, 13.4050),
+    ("bern,ch", "Bern", "CH", 46.9480, 7.4474),
+    ("birmingham,gb", "Birmingham", "GB", 52.4862, -1.8904),
+    ("bogota,co", "Bogota", "CO", 4.7110, -74.0721),
+    ("boston,us", "Boston", "US", 42.3601, -71.0589),
+    ("brasilia,br", "Brasilia", "BR", -15.7975, -47.8919),
+    ("brisbane,au", "Brisbane", "AU", -27.4698, 153.0251),
+    ("brussels,be", "Brussels", "BE", 50.8503, 4.3517),
+    ("bucharest,ro", "Bucharest", "RO", 44.4268, 26.1025),
+    ("budapest,hu", "Budapest", "HU", 47.4979, 19.0402),
+    ("buenos aires,ar", "Buenos Aires", "AR", -34.6037, -58.3816),
+    ("cairo,eg", "Cairo", "EG", 30.0444, 31.2357),
+    ("calgary,ca", "Calgary", "CA", 51.0447, -114.0719),
+    ("cape town,za", "Cape Town", "ZA", -33.9249, 18.4241),
+    ("caracas,ve", "Caracas", "VE", 10.4806, -66.9036),
+    ("casablanca,ma", "Casablanca", "MA", 33.5731, -7.5898),
+    ("chennai,in", "Chennai", "IN", 13.0827, 80.2707),
+    ("chicago,us", "Chicago", "US", 41.8781, -87.6298),
+    ("cologne,de", "Cologne", "DE", 50.9375, 6.9603),
+    ("copenhagen,dk", "Copenhagen", "DK", 55.6761, 12.5683),
+    ("dakar,sn", "Dakar", "SN", 14.7167, -17.4677),
+    ("dallas,us", "Dallas", "US", 32.7767, -96.7970),
+    ("delhi,in", "Delhi", "IN", 28.7041, 77.1025),
+    ("denver,us", "Denver", "US", 39.7392, -104.9903),
+    ("dhaka,bd", "Dhaka", "BD", 23.8103, 90.4125),
+    ("dubai,ae", "Dubai", "AE", 25.2048, 55.2708),
+    ("dublin,ie", "Dublin", "IE", 53.3498, -6.2603),
+    ("edinburgh,gb", "Edinburgh", "GB", 55.9533, -3.1883),
+    ("eindhoven,nl", "Eindhoven", "NL", 51.4416, 5.4697),
+    ("frankfurt,de", "Frankfurt", "DE", 50.1109, 8.6821),
+    ("geneva,ch", "Geneva", "CH", 46.2044, 6.1432),
+    ("gothenburg,se", "Gothenburg", "SE", 57.7089, 11.9746),
+    ("guadalajara,mx", "Guadalajara", "MX", 20.6597, -103.3496),
+    ("guangzhou,cn", "Guangzhou", "CN", 23.1291, 113.2644),
+    ("hamburg,de", "Hamburg", "DE", 53.5511, 9.9937),
+    ("hanoi,vn", "Hanoi", "VN", 21.0278, 105.8342),
+    ("havana,cu", "Havana", "CU", 23.1136, -82.3666),
+    ("helsinki,fi", "Helsinki", "FI", 60.1699, 24.9384),
+    ("ho chi minh city,vn", "Ho Chi Minh City", "VN", 10.8231, 106.6297),
+    ("hong kong,hk", "Hong Kong", "HK", 22.3193, 114.1694),
+    ("houston,us", "Houston", "US", 29.7604, -95.3698),
+    ("hyderabad,in", "Hyderabad", "IN", 17.3850, 78.4867),
+    ("istanbul,tr", "Istanbul", "TR", 41.0082, 28.9784),
+    ("jakarta,id", "Jakarta", "ID", -6.2088, 106.8456),
+    ("jerusalem,il", "Jerusalem", "IL", 31.7683, 35.2137),
+    ("johannesburg,za", "Johannesburg", "ZA", -26.2041, 28.0473),
+    ("karachi,pk", "Karachi", "PK", 24.8607, 67.0011),
+    ("kinshasa,cd", "Kinshasa", "CD", -4.4419, 15.2663),
+    ("kolkata,in", "Kolkata", "IN", 22.5726, 88.3639),
+    ("krakow,pl", "Krakow", "PL", 50.0647, 19.9450),
+    ("kuala lumpur,my", "Kuala Lumpur", "MY", 3.1390, 101.6869),
+    ("kyiv,ua", "Kyiv", "UA", 50.4501, 30.5234),
+    ("lagos,ng", "Lagos", "NG", 6.5244, 3.3792),
+    ("lahore,pk", "Lahore", "PK", 31.5204, 74.3587),
+    ("las vegas,us", "Las Vegas", "US", 36.1699, -115.1398),
+    ("lima,pe", "Lima", "PE", -12.0464, -77.0428),
+    ("lisbon,pt", "Lisbon", "PT", 38.7223, -9.1393),
+    ("london,gb", "London", "GB", 51.5074, -0.1278),
+    ("los angeles,us", "Los Angeles", "US", 34.0522, -118.2437),
+    ("luxembourg,lu", "Luxembourg", "LU", 49.6116, 6.1319),
+    ("lyon,fr", "Lyon", "FR", 45.7640, 4.8357),
+    ("madrid,es", "Madrid", "ES", 40.4168, -3.7038),
+    ("manchester,gb", "Manchester", "GB", 53.4808, -2.2426),
+    ("manila,ph", "Manila", "PH", 14.5995, 120.9842),
+    ("marseille,fr", "Marseille", "FR", 43.2965, 5.3698),
+    ("melbourne,au", "Melbourne", "AU", -37.8136, 144.9631),
+    ("mexico city,mx", "Mexico City", "MX", 19.4326, -99.1332),
+    ("miami,us", "Miami", "US", 25.7617, -80.1918),
+    ("milan,it", "Milan", "IT", 45.4642, 9.1900),
+    ("montevideo,uy", "Montevideo", "UY", -34.9011, -56.1645),
+    ("montreal,ca", "Montreal", "CA", 45.5017, -73.5673),
+    ("moscow,ru", "Moscow", "RU", 55.7558, 37.6173),
+    ("mountain view,us", "Mountain View", "US", 37.3861, -122.0839),
+    ("mumbai,in", "Mumbai", "IN", 19.0760, 72.8777),
+    ("munich,de", "Munich", "DE", 48.1351, 11.5820),
+    ("nairobi,ke", "Nairobi", "KE", -1.2921, 36.8219),
+    ("naples,it", "Naples", "IT", 40.8518, 14.2681),
+    ("new york,us", "New York", "US", 40.7128, -74.0060),
+    ("osaka,jp", "Osaka", "JP", 34.6937, 135.5023),
+    ("oslo,no", "Oslo", "NO", 59.9139, 10.7522),
+    ("ottawa,ca", "Ottawa", "CA", 45.4215, -75.6972),
+    ("paris,fr", "Paris", "FR", 48.8566, 2.3522),
+    ("perth,au", "Perth", "AU", -31.9505, 115.8605),
+    ("philadelphia,us", "Philadelphia", "US", 39.9526, -75.1652),
+    ("phoenix,us", "Phoenix", "US", 33.4484, -112.0740),
+    ("porto,pt", "Porto", "PT", 41.1579, -8.6291),
+    ("prague,cz", "Prague", "CZ", 50.0755, 14.4378),
+    ("quito,ec", "Quito", "EC", -0.1807, -78.4678),
+    ("reykjavik,is", "Reykjavik", "IS", 64.1466, -21.9426),
+    ("riga,lv", "Riga", "LV", 56.9496, 24.1052),
+    ("rio de janeiro,br", "Rio de Janeiro", "BR", -22.9068, -43.1729),
+    ("riyadh,sa", "Riyadh", "SA", 24.7136, 46.6753),
+    ("rome,it", "Rome", "IT", 41.9028, 12.4964),
+    ("rotterdam,nl", "Rotterdam", "NL", 51.9225, 4.4792),
+    ("saint petersburg,ru", "Saint Petersburg", "RU", 59.9343, 30.3351),
+    ("san antonio,us", "San Antonio", "US", 29.4241, -98.4936),
+    ("san diego,us", "San Diego", "US", 32.7157, -117.1611),
+    ("san francisco,us", "San Francisco", "US", 37.7749, -122.4194),
+    ("san jose,us", "San Jose", "US", 37.3382, -121.8863),
+    ("santiago,cl", "Santiago", "CL", -33.4489, -70.6693),
+    ("sao paulo,br", "Sao Paulo", "BR", -23.5505, -46.6333),
+    ("seattle,us", "Seattle", "US", 47.6062, -122.3321),
+    ("seoul,kr", "Seoul", "KR", 37.5665, 126.9780),
+    ("shanghai,cn", "Shanghai", "CN", 31.2304, 121.4737),
+    ("shenzhen,cn", "Shenzhen", "CN", 22.5431, 114.0579),
+    ("singapore,sg", "Singapore", "SG", 1.3521, 103.8198),
+    ("sofia,bg", "Sofia", "BG", 42.6977, 23.3219),
+    ("stockholm,se", "Stockholm", "SE", 59.3293, 18.0686),
+    ("sydney,au", "Sydney", "AU", -33.8688, 151.2093),
+    ("taipei,tw", "Taipei", "TW", 25.0330, 121.5654),
+    ("tallinn,ee", "Tallinn", "EE", 59.4370, 24.7536),
+    ("tehran,ir", "Tehran", "IR", 35.6892, 51.3890),
+    ("tel aviv,il", "Tel Aviv", "IL", 32.0853, 34.7818),
+    ("the hague,nl", "The Hague", "NL", 52.0705, 4.3007),
+    ("tokyo,jp", "Tokyo", "JP", 35.6762, 139.6503),
+    ("toronto,ca", "Toronto", "CA", 43.6532, -79.3832),
+    ("tunis,tn", "Tunis", "TN", 36.8065, 10.1815),
+    ("utrecht,nl", "Utrecht", "NL", 52.0907, 5.1214),
+    ("vancouver,ca", "Vancouver", "CA", 49.2827, -123.1207),
+    ("vienna,at", "Vienna", "AT", 48.2082, 16.3738),
+    ("vilnius,lt", "Vilnius", "LT", 54.6872, 25.2797),
+    ("warsaw,pl", "Warsaw", "PL", 52.2297, 21.0122),
+    ("washington,us", "Washington", "US", 38.9072, -77.0369),
+    ("wellington,nz", "Wellington", "NZ", -41.2865, 174.7762),
+    ("zagreb,hr", "Zagreb", "HR", 45.8150, 15.9819),
+    ("zurich,ch", "Zurich", "CH", 47.3769, 8.5417),
+)
+
+PLACE_KEYS = tuple(entry[0] for entry in GAZETTEER)
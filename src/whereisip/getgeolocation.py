@@ -3,20 +3,63 @@ This script gets the location of the current server
 """
 
 import argparse
+import contextlib
+import csv
+import functools
+import io
 import json
 import logging
-import pprint
+import math
+import re
 import sys
-
-import geocoder
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from whereisip import __version__
-from whereisip.utils import (make_sexagesimal_location,
+from whereisip.cache import (CACHE_BACKENDS,
+                             DEFAULT_CACHE_BACKEND,
+                             DEFAULT_CACHE_MAX_ENTRIES,
+                             DEFAULT_CACHE_TTL,
+                             DEFAULT_NEGATIVE_CACHE_TTL,
+                             NEGATIVE_ENTRY_KEY,
+                             get_cache,
+                             is_negative_entry,
+                             is_negative_entry_expired,
+                             make_negative_entry)
+from whereisip.localdb import load_database
+from whereisip.providers import (DATABASE_PROVIDER,
+                                 DEFAULT_BACKOFF,
+                                 DEFAULT_RETRIES,
+                                 GEOCODER_IP_PROVIDERS,
+                                 DatabaseProvider,
+                                 GeocoderProvider,
+                                 IpErrorNoLocationFound,
+                                 IpErrorPrivateAddress,
+                                 IpErrorProviderFailed,
+                                 ProviderChain)
+from whereisip.gazetteer import lookup_place, normalize_place
+from whereisip.session import (DEFAULT_CONNECT_TIMEOUT,
+                               DEFAULT_POOL_SIZE,
+                               DEFAULT_READ_TIMEOUT,
+                               configure_session,
+                               get_session,
+                               get_timeout)
+from whereisip.stats import get_stats
+from whereisip.utils import (convert_country_codes,
+                             make_sexagesimal_location,
                              make_decimal_location,
                              make_human_location,
-                             get_cache_file,
+                             get_cache_dir,
+                             get_cache_key,
+                             get_prefix_cache_key,
+                             get_prefix_network,
+                             normalize_ip_address,
                              get_distance_to_server,
-                             geoinfo2location)
+                             get_distances,
+                             geoinfo2location,
+                             read_ip_addresses,
+                             LazyModule)
 
 __author__ = "Eelco van Vliet"
 __copyright__ = "Eelco van Vliet"
@@ -24,11 +67,133 @@ __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
-OUTPUT_FORMATS = {"raw", "human", "decimal", "sexagesimal", "full", "short"}
+# geocoder imports requests and more, which is only needed once a location is not in the
+# cache
+geocoder = LazyModule("geocoder")
+pprint = LazyModule("pprint")
+cProfile = LazyModule("cProfile")
+pstats = LazyModule("pstats")
+
+# timings of the stages, only measured when enabled with --stats
+_stats = get_stats()
+
+# the providers used to look up ip addresses which are not in the cache, see
+# get_providers
+_providers = None
+
+# seconds a failed lookup is cached, see set_negative_cache_ttl
+_negative_cache_ttl = DEFAULT_NEGATIVE_CACHE_TTL
+
+# look up the device location in the bundled gazetteer first, see set_use_gazetteer
+_use_gazetteer = True
+
+# the prefix lengths of the IPv4 and IPv6 networks which share a cache entry, None to
+# cache each address separately, see set_prefix_aggregation
+DEFAULT_IPV4_PREFIX = 24
+DEFAULT_IPV6_PREFIX = 48
+_prefix_lengths = None
+# fields of the geo information which belong to the address looked up, not to its
+# network
+ADDRESS_FIELDS = ("hostname", "raw")
+
+OUTPUT_FORMATS = {"raw", "human", "decimal", "sexagesimal", "full", "short", "json",
+                  "jsonl", "csv"}
+
+# subcommands given as the first argument of the command line
+COMMANDS = ("serve", "cache")
+CACHE_ACTIONS = ("warm", "stats", "prune")
+
+# formats which show the distance between the server and the device. The raw format only
+# shows it when the device location is given with --my_location
+DISTANCE_FORMATS = {"full", "short", "json", "jsonl", "csv"}
+
+# the columns of the csv format, which are the keys of LocationReport.to_dict
+CSV_FIELDS = ["ip", "lat", "lng", "city", "country", "decimal", "sexagesimal", "human",
+              "my_location", "distance"]
+
+# number of simultaneous lookups in batch mode
+DEFAULT_WORKERS = 8
+
+# geocoder provider of the place names of --my_location, the default of
+# geocoder.location, and the numbers of a place given by its coordinates
+PLACE_PROVIDER = "osm"
+COORDINATES_PATTERN = r"[-]?\d+[.]?[-]?[\d]+"
+
+# number of recently seen addresses remembered when enriching a log file and the
+# notations of the locations appended to the lines
+DEFAULT_DEDUP_WINDOW = 10000
+ANNOTATION_FORMATS = ("human", "decimal", "sexagesimal", "jsonl")
+
+LookupPlan = namedtuple("LookupPlan", ["lookup_device", "device_is_server"])
+LookupPlan.__doc__ = """
+The lookups needed for a report on the command line, see :func:`plan_lookups`
+
+Args:
+    lookup_device: bool
+        The location of the device has to be looked up
+    device_is_server: bool
+        The device is the server, so its location is taken from the lookup of the server
+"""
+
+LookupResult = namedtuple("LookupResult", ["ipaddress", "geo_info", "error"])
+LookupResult.__doc__ = """
+Result of the lookup of one ip address by :func:`resolve_geo_locations`
+
+Args:
+    ipaddress: str
+        The ip address which was looked up
+    geo_info: dict
+        The geo information of the address, None if the lookup failed
+    error: Exception
+        The error raised by the lookup, None if the lookup succeeded
+"""
+
+
+class GeoRecord(namedtuple("GeoRecord", ["ip", "lat", "lng", "country", "city", "raw"],
+                           defaults=(None,))):
+    """
+    Location of an ip address with only the fields used by the reports
+
+    A record is immutable and has no instance dictionary, so it takes a fraction of the
+    memory of the geo information dictionary of geocoder when many locations are kept.
 
+    Args:
+        ip: str
+            The ip address
+        lat: float
+            Latitude of the location
+        lng: float
+            Longitude of the location
+        country: str
+            Two letter code of the country
+        city: str
+            Name of the city
+        raw: dict
+            The full geo information of geocoder, None if it is not kept
+    """
 
-class IpErrorNoLocationFound(Exception):
-    pass
+    __slots__ = ()
+
+    @classmethod
+    def from_geo_info(cls, geo_info, keep_raw=True):
+        """
+        Make a record of the geo information of geocoder
+
+        Args:
+            geo_info: dict
+                Output of geocoder
+            keep_raw: bool
+                Keep the full geo information, which is only needed by the raw report
+
+        Returns: GeoRecord
+            The record
+        """
+        return cls(ip=geo_info["ip"],
+                   lat=float(geo_info["lat"]),
+                   lng=float(geo_info["lng"]),
+                   country=geo_info.get("country"),
+                   city=geo_info.get("city"),
+                   raw=geo_info if keep_raw else None)
 
 
 class LocationReport:
@@ -36,43 +201,130 @@ class LocationReport:
     Object to report the location of the server
 
     Args:
-        geo_info: dict
-            Output of geocoder
+        geo_info: GeoRecord or dict
+            The location of the server. A dictionary is the output of geocoder, which
+            may contain the device location and distance added by
+            :func:`add_device_location`
         n_digits_seconds: int
             Number of digits to use for the seconds in the d-m-s notation of the location
+        my_location: str
+            Name of the device location. Taken from the geo_info dictionary if not given
+        my_lat: float
+            Latitude of the device. Taken from the geo_info dictionary if not given
+        my_lng: float
+            Longitude of the device. Taken from the geo_info dictionary if not given
+        distance: float
+            Distance between the server and the device in km. Taken from the geo_info
+            dictionary if not given
     """
 
-    def __init__(self, geo_info, n_digits_seconds=1):
-
-        self.geo_info = geo_info
-
-        self.ip_address = geo_info["ip"]
-
-        latitude = float(geo_info["lat"])
-        longitude = float(geo_info["lng"])
-
-        self.my_location = geo_info.get("my_location")
-        self.distance = geo_info.get("distance")
+    __slots__ = ("record", "n_digits_seconds", "my_location", "my_lat", "my_lng",
+                 "distance", "_location_sexagesimal", "_location_decimal",
+                 "_location_human", "_location_me")
 
-        self.location_sexagesimal = make_sexagesimal_location(latitude=latitude,
-                                                              longitude=longitude,
-                                                              n_digits_seconds=n_digits_seconds)
-        self.location_decimal = make_decimal_location(latitude=latitude,
-                                                      longitude=longitude,
-                                                      n_decimals=n_digits_seconds + 1)
-        self.location_human = make_human_location(country_code=geo_info["country"],
-                                                  city=geo_info["city"])
+    def __init__(self, geo_info, n_digits_seconds=1, my_location=None, my_lat=None,
+                 my_lng=None, distance=None):
 
+        with _stats.span("report"):
+            if isinstance(geo_info, GeoRecord):
+                self.record = geo_info
+            else:
+                self.record = GeoRecord.from_geo_info(geo_info)
+                if my_location is None:
+                    my_location = geo_info.get("my_location")
+                if my_lat is None:
+                    my_lat = geo_info.get("my_lat")
+                if my_lng is None:
+                    my_lng = geo_info.get("my_lng")
+                if distance is None:
+                    distance = geo_info.get("distance")
+            self.n_digits_seconds = n_digits_seconds
+            self.my_location = my_location
+            self.my_lat = my_lat
+            self.my_lng = my_lng
+            self.distance = distance
+
+        # the notations are only made when they are used by the report, as making them
+        # requires the country tables and the coordinate conversions
+        self._location_sexagesimal = None
+        self._location_decimal = None
+        self._location_human = None
+        self._location_me = None
+
+    @property
+    def ip_address(self):
+        """ The ip address of the server """
+        return self.record.ip
+
+    @property
+    def latitude(self):
+        """ The latitude of the server """
+        return self.record.lat
+
+    @property
+    def longitude(self):
+        """ The longitude of the server """
+        return self.record.lng
+
+    @property
+    def geo_info(self):
+        """
+        The geo information of geocoder, including the device location and distance
+        """
+        if self.record.raw is not None:
+            geo_info = dict(self.record.raw)
+        else:
+            geo_info = self.record._asdict()
+            del geo_info["raw"]
+        if self.my_lat is not None:
+            geo_info.update(my_location=self.my_location, my_lat=self.my_lat,
+                            my_lng=self.my_lng)
         if self.distance is not None:
-            my_lat = geo_info["my_lat"]
-            my_lng = geo_info["my_lng"]
-            self.location_me = make_sexagesimal_location(latitude=my_lat,
-                                                         longitude=my_lng,
-                                                         n_digits_seconds=n_digits_seconds)
+            geo_info["distance"] = self.distance
+        return geo_info
+
+    @property
+    def location_sexagesimal(self):
+        """ The location as a sexagesimal string """
+        if self._location_sexagesimal is None:
+            self._location_sexagesimal = make_sexagesimal_location(
+                latitude=self.latitude,
+                longitude=self.longitude,
+                n_digits_seconds=self.n_digits_seconds)
+        return self._location_sexagesimal
+
+    @property
+    def location_decimal(self):
+        """ The location as a decimal string """
+        if self._location_decimal is None:
+            self._location_decimal = make_decimal_location(
+                latitude=self.latitude, longitude=self.longitude,
+                n_decimals=self.n_digits_seconds + 1)
+        return self._location_decimal
+
+    @property
+    def location_human(self):
+        """ The location as a City/Country string """
+        if self._location_human is None:
+            with _stats.span("country_conversion"):
+                self._location_human = make_human_location(
+                    country_code=self.record.country, city=self.record.city)
+        return self._location_human
+
+    @property
+    def location_me(self):
+        """
+        The location of the device as a sexagesimal string, None without a distance
+        """
+        if self._location_me is None and self.distance is not None:
+            self._location_me = make_sexagesimal_location(
+                latitude=self.my_lat, longitude=self.my_lng,
+                n_digits_seconds=self.n_digits_seconds)
+        return self._location_me
 
     def make_report(self, output_format: str = "sexagesimal"):
         """
-        Make a report of the location
+        Make a report of the location and print it
 
         Args:
             output_format: str
@@ -83,55 +335,178 @@ class LocationReport:
                     human:          human representation of location
                     raw:            raw output of geolocation
                     full:           full report with all information
+                    short:          compact report with the human and sexagesimal
+                                    location
+                    json:           all information as an indented json object
+                    jsonl:          all information as a json object on one line
+                    csv:            all information as a csv header and row
+        """
+        print(self.render(output_format=output_format))
+
+    def render(self, output_format: str = "sexagesimal") -> str:
         """
+        Make a report of the location
+
+        Args:
+            output_format: str
+                Type of report to make, see :meth:`make_report`
+
+        Returns: str
+            The report, without a trailing newline
+        """
+        with _stats.span("format"):
+            return self._render(output_format)
+
+    def _render(self, output_format):
+        """ Make the report of :meth:`render` """
         if output_format == "decimal":
-            self.report_location_decimal()
+            return self.render_location_decimal()
         elif output_format == "sexagesimal":
-            self.report_location_sexagesimal()
+            return self.render_location_sexagesimal()
         elif output_format == "human":
-            self.report_location_human()
+            return self.render_location_human()
         elif output_format == "raw":
-            self.report_location_raw()
+            return self.render_location_raw()
         elif output_format == "full":
-            self.report_full()
+            return self.render_full()
         elif output_format == "short":
-            self.report_short()
+            return self.render_short()
+        elif output_format == "json":
+            return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        elif output_format == "jsonl":
+            return json.dumps(self.to_dict(), ensure_ascii=False)
+        elif output_format == "csv":
+            stream = io.StringIO()
+            writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS, lineterminator="\n")
+            writer.writeheader()
+            writer.writerow(self.to_dict())
+            return stream.getvalue().rstrip("\n")
         else:
             raise ValueError(f"Option {output_format} not recognised")
 
+    def to_dict(self) -> dict:
+        """
+        Get all the information of the report as a flat dictionary
+
+        Returns: dict
+            The location of the server in all notations and the distance to the device.
+            The keys are the ones of CSV_FIELDS
+        """
+        return {"ip": self.ip_address,
+                "lat": self.latitude,
+                "lng": self.longitude,
+                "city": self.record.city,
+                "country": self.record.country,
+                "decimal": self.location_decimal,
+                "sexagesimal": self.location_sexagesimal,
+                "human": self.location_human,
+                "my_location": self.my_location,
+                "distance": self.distance}
+
+    def render_location_decimal(self):
+        """ The location as a decimal representation """
+        return self.location_decimal
+
+    def render_location_sexagesimal(self):
+        """ The location as a sexagesimal representation """
+        return self.location_sexagesimal
+
+    def render_location_human(self):
+        """ The location as City/Country representation """
+        return self.location_human
+
+    def render_location_raw(self):
+        """ The raw output of the geocoder module  """
+        return pprint.pformat(self.geo_info)
+
+    def render_full(self):
+        """ A full report of the location """
+        formatter = "{:20} : {}"
+        lines = [f"Location of server {self.ip_address}:",
+                 formatter.format("  decimal", self.location_decimal),
+                 formatter.format("  sexagesimal", self.location_sexagesimal),
+                 formatter.format("  human", self.location_human)]
+        if self.distance is not None and self.distance > 0:
+            lines.append(f"Distance from device @ {self.my_location}: "
+                         f"{self.distance:.0f} km")
+        return "\n".join(lines)
+
+    def render_short(self):
+        """ A one line short location """
+        msg = f"Server {self.ip_address} @ {self.location_human} has coordinates ({self.location_sexagesimal})"
+        if self.distance is not None and self.distance > 0:
+            distance = int(round(self.distance, 0))
+            msg += f"\nDistance from {self.my_location} ({self.location_me}):  {distance}km."
+        return msg
+
     def report_location_decimal(self):
         """ Print the location as a decimal representation """
-        print(self.location_decimal)
+        print(self.render_location_decimal())
 
     def report_location_sexagesimal(self):
         """ Print the location as a sexagesimal representation """
-        print(self.location_sexagesimal)
+        print(self.render_location_sexagesimal())
 
     def report_location_human(self):
         """ Print the location as City/Country representation """
-        print(self.location_human)
+        print(self.render_location_human())
 
     def report_location_raw(self):
         """ Show the raw output of the geocoder module  """
-        pprint.pprint(self.geo_info)
+        print(self.render_location_raw())
 
     def report_full(self):
         """ Give a full report of the location """
-        print(f"Location of server {self.ip_address}:")
-        formatter = "{:20} : {}"
-        print(formatter.format("  decimal", self.location_decimal))
-        print(formatter.format("  sexagesimal", self.location_sexagesimal))
-        print(formatter.format("  human", self.location_human))
-        if self.distance is not None and self.distance > 0:
-            print(f"Distance from device @ {self.my_location}: {self.distance:.0f} km")
+        print(self.render_full())
 
     def report_short(self):
         """ Give a one line short location """
-        msg = f"Server {self.ip_address} @ {self.location_human} has coordinates ({self.location_sexagesimal})"
-        if self.distance is not None and self.distance > 0:
-            distance = int(round(self.distance, 0))
-            msg += f"\nDistance from {self.my_location} ({self.location_me}):  {distance}km."
-        print(msg)
+        print(self.render_short())
+
+
+def write_reports(reports, output_format="short", stream=None):
+    """
+    Write many reports to one stream
+
+    The reports are written as they come in, so also a long stream of reports can be
+    written without keeping them in memory. The csv header is written once and the json
+    reports are written as one json list.
+
+    Args:
+        reports: iterable of LocationReport
+            The reports to write
+        output_format: str
+            Type of report to make, see :meth:`LocationReport.make_report`
+        stream: file object
+            Stream to write to. Defaults to stdout
+
+    Returns: int
+        Number of written reports
+    """
+    if stream is None:
+        stream = sys.stdout
+
+    n_reports = 0
+    if output_format == "csv":
+        writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for report in reports:
+            writer.writerow(report.to_dict())
+            n_reports += 1
+    elif output_format == "json":
+        stream.write("[")
+        for report in reports:
+            separator = "," if n_reports else ""
+            stream.write(separator + "\n"
+                         + json.dumps(report.to_dict(), ensure_ascii=False))
+            n_reports += 1
+        stream.write("\n]\n")
+    else:
+        for report in reports:
+            stream.write(report.render(output_format=output_format) + "\n")
+            n_reports += 1
+    stream.flush()
+    return n_reports
 
 
 # ---- Python API ----
@@ -141,7 +516,390 @@ class LocationReport:
 # when using this Python module as a library.
 
 
-def get_geo_location_device(my_location, reset_cache=False, write_cache=True):
+def request_ip(ipaddress, provider="ipinfo"):
+    """
+    Request the location of an ip address from geocoder over the shared http session
+
+    Args:
+        ipaddress: str
+            Ip address, or 'me' for the local machine
+        provider: str
+            Name of the geocoder provider, one of GEOCODER_IP_PROVIDERS
+
+    Returns:
+        The geocoder result
+    """
+    if provider == "ipinfo":
+        return geocoder.ip(ipaddress, session=get_session(), timeout=get_timeout())
+    return geocoder.get(ipaddress, provider=provider, session=get_session(),
+                        timeout=get_timeout())
+
+
+def request_place(place):
+    """
+    Request the coordinates of a place from geocoder over the shared http session
+
+    geocoder.location does not pass a session to the request it makes for a place name,
+    so the place is requested here and geocoder.location only reads the coordinates of
+    the result. Coordinates such as '52.37, 4.89' are read without a request
+
+    Args:
+        place: str
+            Name of the place, e.g. 'Ottawa, ON', or its coordinates
+
+    Returns:
+        The geocoder location with the attributes *lat* and *lng*
+
+    Raises:
+        ValueError: in case the place is not found
+    """
+    if len(re.findall(COORDINATES_PATTERN, place)) == 2:
+        return geocoder.location(place)
+    result = geocoder.get(place, provider=PLACE_PROVIDER, session=get_session(),
+                          timeout=get_timeout())
+    if not result.ok:
+        raise ValueError(f"Unknown location {place}")
+    return geocoder.location(result)
+
+
+def make_providers(names=("ipinfo",), database=None, rate_limit=None,
+                   retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    Make a chain of providers
+
+    Args:
+        names: list of str
+            The names of the providers in order of preference: 'database' for the local
+            database or one of GEOCODER_IP_PROVIDERS
+        database: BaseIpRangeIndex
+            The local database, required if 'database' is one of the names
+        rate_limit: float
+            Maximum number of requests per second per provider. None for no limit
+        retries: int
+            Number of times a failed request is repeated
+        backoff: float
+            Seconds to wait before the first retry, doubling for each next retry
+
+    Returns: ProviderChain
+        The providers
+    """
+    settings = dict(rate_limit=rate_limit, retries=retries, backoff=backoff)
+    providers = []
+    for name in names:
+        if name == DATABASE_PROVIDER:
+            if database is None:
+                raise ValueError("The database provider requires a database")
+            # a local lookup does not need a rate limit and does not fail temporarily
+            providers.append(DatabaseProvider(database))
+        elif name in GEOCODER_IP_PROVIDERS:
+            request = functools.partial(request_ip, provider=name)
+            providers.append(GeocoderProvider(name, request=request, **settings))
+        else:
+            raise ValueError(f"Provider {name} not recognised. Choose from "
+                             f"{(DATABASE_PROVIDER,) + GEOCODER_IP_PROVIDERS}")
+    return ProviderChain(providers)
+
+
+def get_providers():
+    """
+    Get the providers used for the ip addresses which are not in the cache
+
+    Returns: ProviderChain
+        The providers set with :func:`set_providers`, by default ipinfo only
+    """
+    global _providers
+    if _providers is None:
+        _providers = make_providers()
+    return _providers
+
+
+def set_providers(providers):
+    """
+    Set the providers used for the ip addresses which are not in the cache
+
+    Args:
+        providers: ProviderChain
+            The providers. None to go back to the default providers
+    """
+    global _providers
+    _providers = providers
+
+
+def fetch_geo_location_device(my_location=None):
+    """
+    Request the latitude/longitude of your location from geocoder without using the
+    cache
+
+    Args:
+        my_location:  str
+            Name of your device location, e.g 'Ottawa, ON', or an ip address. If None,
+            the location of the local machine is requested
+
+    Returns: dict
+        Location of the device with the keys *my_location*, *my_lat* and *my_lng*
+    """
+    if my_location is None:
+        geo_info = get_providers().lookup(None)
+
+        location = geoinfo2location(geo_info)
+    else:
+        try:
+            latlon = request_place(my_location)
+        except ValueError:
+            _logger.debug(f"{my_location} failed. Try if it is an ip")
+            geo_info = get_providers().lookup(my_location)
+            location = geoinfo2location(geo_info)
+        else:
+            location = {
+                "my_location": my_location,
+                "my_lat": latlon.lat,
+                "my_lng": latlon.lng}
+    return location
+
+
+def fetch_geo_info_ip(ipaddress=None):
+    """
+    Request the location of the ip address from the providers without using the cache
+
+    Args:
+        ipaddress: str
+            Ip address. If None, the location of the local machine is requested
+
+    Returns: dict
+        The geo information as returned by geocoder
+
+    Raises:
+        IpErrorNoLocationFound: in case no location was found for the ip address
+    """
+    return get_providers().lookup(normalize_ip_address(ipaddress))
+
+
+def set_negative_cache_ttl(ttl):
+    """
+    Set how long a failed lookup is cached
+
+    Args:
+        ttl: float
+            Time-to-live of the failed lookups in seconds. None or 0 to not cache failed
+            lookups
+    """
+    global _negative_cache_ttl
+    _negative_cache_ttl = ttl
+
+
+def read_cache_entry(info):
+    """
+    Get the geo information from a cache entry
+
+    Args:
+        info: dict
+            The cache entry, None if the address is not in the cache
+
+    Returns: dict
+        The geo information, or None if the address is not in the cache or its cached
+        failure has expired
+
+    Raises:
+        IpErrorNoLocationFound: in case the entry is a failed lookup which has not
+            expired yet
+    """
+    if info is None or not is_negative_entry(info):
+        return info
+    if is_negative_entry_expired(info):
+        return None
+    raise IpErrorNoLocationFound(info[NEGATIVE_ENTRY_KEY])
+
+
+def make_failure_entry(error):
+    """
+    Make the cache entry of a failed lookup
+
+    Only the failures of which the providers said that they do not know the address are
+    cached. Private addresses are recognised without a request and temporary failures
+    should be tried again, so they are not cached.
+
+    Args:
+        error: Exception
+            The error of the lookup
+
+    Returns: dict
+        The cache entry, or None if the failure is not cached
+    """
+    if not _negative_cache_ttl or not isinstance(error, IpErrorNoLocationFound):
+        return None
+    if isinstance(error, (IpErrorPrivateAddress, IpErrorProviderFailed)):
+        return None
+    return make_negative_entry(str(error), ttl=_negative_cache_ttl)
+
+
+def open_cache(cache=None, reset_cache=False, write_cache=True):
+    """
+    Get the cache to use for a lookup
+
+    Args:
+        cache: CacheBackend
+            The cache to use. If None, the default cache is opened
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+
+    Returns: CacheBackend
+        The cache, or None if the cache is neither read nor written
+    """
+    if cache is None and (write_cache or not reset_cache):
+        cache = get_cache()
+    return cache
+
+
+def lock_cache_key(cache, cache_key):
+    """
+    Lock a cache key while it is looked up, see
+    :meth:`whereisip.cache.CacheBackend.lock`
+
+    Args:
+        cache: CacheBackend
+            The cache, None if the cache is not used
+        cache_key: str
+            The key to lock
+
+    Returns:
+        The context manager holding the lock, which does nothing without a cache
+    """
+    if cache is None:
+        return contextlib.nullcontext()
+    return cache.lock(cache_key)
+
+
+def set_prefix_aggregation(enabled, ipv4_prefix=DEFAULT_IPV4_PREFIX,
+                           ipv6_prefix=DEFAULT_IPV6_PREFIX):
+    """
+    Set whether the addresses of one network share their location
+
+    With prefix aggregation, the location of an address is cached per network, so the
+    neighbours of an address which was looked up before are answered from the cache
+    without a request
+
+    Args:
+        enabled: bool
+            Cache and look up the locations per network instead of per address
+        ipv4_prefix: int
+            Prefix length of the networks of the IPv4 addresses
+        ipv6_prefix: int
+            Prefix length of the networks of the IPv6 addresses
+    """
+    global _prefix_lengths
+    if not 0 <= ipv4_prefix <= 32:
+        raise ValueError(f"The IPv4 prefix length must be between 0 and 32. "
+                         f"Got {ipv4_prefix}")
+    if not 0 <= ipv6_prefix <= 128:
+        raise ValueError(f"The IPv6 prefix length must be between 0 and 128. "
+                         f"Got {ipv6_prefix}")
+    _prefix_lengths = (ipv4_prefix, ipv6_prefix) if enabled else None
+
+
+def get_lookup_key(ipaddress):
+    """
+    Get the cache key of an ip address, which is the key of its network with prefix
+    aggregation. An IPv4-mapped IPv6 address has the key of its IPv4 address
+
+    Args:
+        ipaddress: str
+            Ip address. None refers to the local machine
+
+    Returns: str
+        The cache key
+    """
+    ipaddress = normalize_ip_address(ipaddress)
+    if _prefix_lengths is None:
+        return get_cache_key(ipaddress)
+    return get_prefix_cache_key(ipaddress, *_prefix_lengths)
+
+
+def share_geo_info(geo_info, ipaddress):
+    """
+    Get the geo information of an address from the one of a neighbour in the same
+    network
+
+    Args:
+        geo_info: dict
+            Geo information of an address in the same network
+        ipaddress: str
+            The address to get the geo information of. None refers to the local machine
+
+    Returns: dict
+        The geo information with the ip address replaced. It is a copy in case the
+        address differs, so the cached geo information is not changed. The information
+        of a neighbour has no fields which only hold for the neighbour, such as its host
+        name, and gets the aggregated *network*
+    """
+    if ipaddress is None or geo_info.get("ip") == ipaddress:
+        return geo_info
+    if normalize_ip_address(ipaddress) == geo_info.get("ip"):
+        # another notation of the same address
+        return dict(geo_info, ip=ipaddress)
+    shared = {key: value for key, value in geo_info.items()
+              if key not in ADDRESS_FIELDS}
+    shared["ip"] = ipaddress
+    if _prefix_lengths is not None:
+        network = get_prefix_network(ipaddress, *_prefix_lengths)
+        if network is not None:
+            shared["network"] = str(network)
+    return shared
+
+
+def set_use_gazetteer(use_gazetteer):
+    """
+    Set whether the device location is looked up in the bundled gazetteer of major
+    cities
+
+    Args:
+        use_gazetteer: bool
+            Look up the places in the gazetteer before asking geocoder
+    """
+    global _use_gazetteer
+    _use_gazetteer = use_gazetteer
+
+
+def get_device_cache_key(my_location):
+    """
+    Get the key under which the location of the device is cached
+
+    Args:
+        my_location:  str
+            Name of your device location. None refers to the local machine
+
+    Returns: str
+        The cache key, which is the same for different spellings of the same place
+    """
+    if my_location is None:
+        return "me"
+    return normalize_place(my_location) or my_location
+
+
+def find_device_in_gazetteer(my_location):
+    """
+    Get the location of the device from the bundled gazetteer, without a request
+
+    Args:
+        my_location:  str
+            Name of your device location, e.g 'Amsterdam, NL'
+
+    Returns: dict
+        Location of the device with the keys *my_location*, *my_lat* and *my_lng*. None
+        if the place is not in the gazetteer or the gazetteer is not used
+    """
+    if my_location is None or not _use_gazetteer:
+        return None
+    place = lookup_place(my_location)
+    if place is None:
+        return None
+    _stats.count("gazetteer_hit")
+    return {"my_location": my_location, "my_lat": place.lat, "my_lng": place.lng}
+
+
+def get_geo_location_device(my_location, reset_cache=False, write_cache=True,
+                            cache=None):
     """
     Get the latitude/longitude from your location given by my_location
 
@@ -152,49 +910,70 @@ def get_geo_location_device(my_location, reset_cache=False, write_cache=True):
             Reset the cache
         write_cache: bool
             Write the locations to cache file
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
 
-    Returns: tuple
-        Latitude, longitude in decimal representation
+    Returns: dict
+        Location of the device with the keys *my_location*, *my_lat* and *my_lng*
     """
-    if my_location is None:
-        cache_suffix = "me"
-    else:
-        cache_suffix = my_location
-    cache_file = get_cache_file(ipaddress=cache_suffix, write_cache=write_cache)
+    location = find_device_in_gazetteer(my_location)
+    if location is not None:
+        return location
+
+    cache_key = get_device_cache_key(my_location)
+    cache = open_cache(cache, reset_cache=reset_cache, write_cache=write_cache)
+
+    location = None
+    if not reset_cache:
+        _logger.debug(f"Reading my location {cache_key} from cache")
+        with _stats.span("cache_read"):
+            location = cache.get(cache_key)
+        _stats.count("cache_miss" if location is None else "cache_hit")
+
+    if location is None:
+        with lock_cache_key(cache, cache_key):
+            if not reset_cache:
+                # another thread or process may have looked it up while waiting for the
+                # lock
+                location = cache.get(cache_key)
+                if location is not None:
+                    _stats.count("shared_lookup")
+            if location is None:
+                with _stats.span("fetch_device"):
+                    location = fetch_geo_location_device(my_location)
+                if write_cache:
+                    _logger.debug(f"Writing my location {cache_key} to cache")
+                    with _stats.span("cache_write"):
+                        cache.set(cache_key, location)
 
-    if not cache_file.exists() or reset_cache:
-        if my_location is None:
-            geocode = geocoder.ip("me")
-            geo_info = geocode.geojson['features'][0]['properties']
+    return location
 
-            location = geoinfo2location(geo_info)
-        else:
-            try:
-                latlon = geocoder.location(my_location)
-            except ValueError:
-                _logger.debug(f"{my_location} failed. Try if it is an ip")
-                geocode = geocoder.ip(my_location)
-                geo_info = geocode.geojson['features'][0]['properties']
-                location = geoinfo2location(geo_info)
-            else:
-                location = {
-                    "my_location": my_location,
-                    "my_lat": latlon.lat,
-                    "my_lng": latlon.lng}
 
-        _logger.debug(f"Writing my location to cache {cache_file}")
-        if write_cache:
-            with open(cache_file, "w") as stream:
-                json.dump(location, stream, indent=True)
-    else:
-        _logger.debug(f"Reading my location from cache {cache_file}")
-        with open(cache_file, "r") as stream:
-            location = json.load(stream)
+def lookup_database(database, ipaddress):
+    """
+    Get the location of the ip address from a local database
 
-    return location
+    Args:
+        database: BaseIpRangeIndex
+            The database as loaded by :func:`whereisip.localdb.load_database`
+        ipaddress: str
+            Ip address
 
+    Returns: dict
+        The geo information in the same format as geocoder
 
-def get_geo_location_ip(ipaddress=None, reset_cache=False, write_cache=True):
+    Raises:
+        IpErrorNoLocationFound: in case the ip address is not in the database
+    """
+    geo_info = database.lookup(normalize_ip_address(ipaddress))
+    if geo_info is None:
+        raise IpErrorNoLocationFound(f"IP address {ipaddress} not found in the "
+                                     f"local database")
+    return geo_info
+
+
+def get_geo_location_ip(ipaddress=None, reset_cache=False, write_cache=True, cache=None,
+                        database=None):
     """
     Get the location of the local machine of the ip address if given
 
@@ -205,34 +984,314 @@ def get_geo_location_ip(ipaddress=None, reset_cache=False, write_cache=True):
             Reset the cache
         write_cache:
             Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip address in instead of geocoder. The cache
+            is not used for addresses looked up in the database. The local machine is
+            always looked up with geocoder, as its public ip address is not known
+            beforehand
 
     """
-    cache_file = get_cache_file(ipaddress=ipaddress, write_cache=write_cache)
+    if database is not None and ipaddress is not None:
+        with _stats.span("database"):
+            return lookup_database(database, ipaddress)
+
+    cache_key = get_lookup_key(ipaddress)
+    cache = open_cache(cache, reset_cache=reset_cache, write_cache=write_cache)
+
+    geo_info = None
+    if not reset_cache:
+        _logger.debug(f"Reading geo_info of {cache_key} from cache")
+        with _stats.span("cache_read"):
+            entry = cache.get(cache_key)
+        try:
+            geo_info = read_cache_entry(entry)
+        except IpErrorNoLocationFound:
+            _stats.count("cache_negative_hit")
+            raise
+        _stats.count("cache_miss" if geo_info is None else "cache_hit")
+
+    if geo_info is None:
+        with lock_cache_key(cache, cache_key):
+            if not reset_cache:
+                # another thread or process may have looked it up while waiting for the
+                # lock
+                geo_info = read_cache_entry(cache.get(cache_key))
+                if geo_info is not None:
+                    _stats.count("shared_lookup")
+            if geo_info is None:
+                try:
+                    with _stats.span("fetch"):
+                        geo_info = fetch_geo_info_ip(ipaddress)
+                except IpErrorNoLocationFound as err:
+                    entry = make_failure_entry(err)
+                    if write_cache and entry is not None:
+                        _logger.debug(f"Writing failed lookup of {cache_key} to cache")
+                        cache.set(cache_key, entry)
+                    raise
+                if write_cache:
+                    _logger.debug(f"Writing geo_info of {cache_key} to cache")
+                    with _stats.span("cache_write"):
+                        cache.set(cache_key, geo_info)
+
+    return share_geo_info(geo_info, ipaddress)
+
+
+def add_device_location(geo_info, my_location, my_device_latlon, distance=None):
+    """
+    Add the location of the device and the distance to the server to the geo_info
+    dictionary
 
-    if not cache_file.exists() or reset_cache:
-        if ipaddress is None:
-            geocode = geocoder.ip("me")
-        else:
-            geocode = geocoder.ip(ipaddress)
-        if not geocode.ok:
-            raise IpErrorNoLocationFound(f"Failed to get a location for IP address {ipaddress}")
-
-        geo_info = geocode.geojson['features'][0]['properties']
-        if geo_info["status"] != "OK":
-            raise IpErrorNoLocationFound(f"Failed to get a location for IP address {ipaddress}")
-        _logger.debug(f"Storing geo_info to cache {cache_file}")
-        if write_cache:
-            _logger.debug(f"Writing geo_info to cache {cache_file}")
-            with open(cache_file, "w") as stream:
-                json.dump(geo_info, stream, indent=True)
+    Args:
+        geo_info: dict
+            Geo information of the server. Is updated in place
+        my_location: str
+            Name of the device location as given by the user
+        my_device_latlon: dict
+            Location of the device as returned by :func:`get_geo_location_device`
+        distance: float
+            The distance between the server and the device in km, if it is calculated
+            already. A nan distance means that the distance could not be calculated
+
+    Returns: dict
+        The updated geo_info dictionary
+    """
+    if my_device_latlon is None:
+        return geo_info
+
+    geo_info["my_location"] = my_location
+    for key, value in my_device_latlon.items():
+        geo_info[key] = value
+
+    if distance is None:
+        try:
+            with _stats.span("distance"):
+                distance = get_distance_to_server(geo_info)
+        except TypeError:
+            distance = math.nan
+
+    if math.isnan(distance):
+        _logger.warning(f"Failed to calculate distance to {my_device_latlon}\n\n")
     else:
-        _logger.debug(f"Reading geo_info from cache {cache_file}")
-        with open(cache_file, "r") as stream:
-            geo_info = json.load(stream)
+        geo_info["distance"] = distance
 
     return geo_info
 
 
+def _fetch_lookup_result(ipaddress, cache_key, cache, reset_cache, write_cache):
+    """
+    Request the location of one ip address which is not in the cache under the lock of
+    its key, such that other threads and processes missing the same key wait for this
+    lookup. The error is caught in case the lookup fails
+    """
+    with lock_cache_key(cache, cache_key):
+        if not reset_cache:
+            # another thread or process may have looked it up while waiting for the lock
+            try:
+                geo_info = read_cache_entry(cache.get(cache_key))
+            except IpErrorNoLocationFound as err:
+                return LookupResult(ipaddress=ipaddress, geo_info=None, error=err)
+            if geo_info is not None:
+                _stats.count("shared_lookup")
+                return LookupResult(ipaddress=ipaddress, geo_info=geo_info, error=None)
+        try:
+            geo_info = fetch_geo_info_ip(ipaddress)
+        except Exception as err:
+            _logger.debug(f"Lookup of {ipaddress} failed: {err}")
+            entry = make_failure_entry(err)
+            if write_cache and entry is not None:
+                cache.set(cache_key, entry)
+            return LookupResult(ipaddress=ipaddress, geo_info=None, error=err)
+        if write_cache:
+            # written before the lock is released, so the threads waiting for it find
+            # the entry
+            cache.set(cache_key, geo_info)
+        return LookupResult(ipaddress=ipaddress, geo_info=geo_info, error=None)
+
+
+def resolve_geo_locations(ipaddresses, workers=DEFAULT_WORKERS, reset_cache=False,
+                          write_cache=True, cache=None, database=None):
+    """
+    Get the location of a list of ip addresses using a pool of worker threads
+
+    The cached addresses are read from the cache in one go. The lookups which are not in
+    the cache are waiting for the network most of the time, so they are run in parallel,
+    which saves a lot of wall clock time. Each unique address is only looked up once,
+    under the lock of its cache key, such that concurrent batches and processes missing
+    the same address share the lookup.
+
+    Args:
+        ipaddresses: iterable of str
+            Ip addresses to locate
+        workers: int
+            Maximum number of lookups running at the same time
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
+
+    Returns: list of LookupResult
+        One result per ip address in the same order as the input. A failed lookup does
+        not stop the batch, but is reported in the *error* field of its result
+    """
+    ipaddresses = list(ipaddresses)
+    unique_addresses = list(dict.fromkeys(ipaddresses))
+
+    results = dict()
+    if database is not None:
+        for ipaddress in unique_addresses:
+            if ipaddress is None:
+                continue
+            try:
+                with _stats.span("database"):
+                    geo_info = lookup_database(database, ipaddress)
+            except IpErrorNoLocationFound as err:
+                results[ipaddress] = LookupResult(ipaddress=ipaddress, geo_info=None,
+                                                  error=err)
+            else:
+                results[ipaddress] = LookupResult(ipaddress=ipaddress,
+                                                  geo_info=geo_info, error=None)
+        unique_addresses = [ipaddress for ipaddress in unique_addresses
+                            if ipaddress not in results]
+        if not unique_addresses:
+            return [results[ipaddress] for ipaddress in ipaddresses]
+
+    cache = open_cache(cache, reset_cache=reset_cache, write_cache=write_cache)
+    keys = {ipaddress: get_lookup_key(ipaddress) for ipaddress in unique_addresses}
+    if not reset_cache:
+        with _stats.span("cache_read"):
+            cached = cache.get_many(set(keys.values()))
+        for ipaddress in unique_addresses:
+            try:
+                geo_info = read_cache_entry(cached.get(keys[ipaddress]))
+            except IpErrorNoLocationFound as err:
+                _stats.count("cache_negative_hit")
+                results[ipaddress] = LookupResult(ipaddress=ipaddress, geo_info=None,
+                                                  error=err)
+                continue
+            if geo_info is not None:
+                _stats.count("cache_hit")
+                results[ipaddress] = LookupResult(
+                    ipaddress=ipaddress, geo_info=share_geo_info(geo_info, ipaddress),
+                    error=None)
+            else:
+                _stats.count("cache_miss")
+
+    missing_addresses = [ipaddress for ipaddress in unique_addresses
+                         if ipaddress not in results]
+    if missing_addresses:
+        # with prefix aggregation, only one address per network is looked up
+        lookup_addresses = dict()
+        for ipaddress in missing_addresses:
+            lookup_addresses.setdefault(keys[ipaddress], ipaddress)
+        lookup_addresses = list(lookup_addresses.values())
+        _logger.debug(f"Looking up {len(lookup_addresses)} addresses with {workers} "
+                      f"workers")
+        with _stats.span("fetch"), \
+                ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            fetched = list(executor.map(
+                lambda ipaddress: _fetch_lookup_result(ipaddress, keys[ipaddress],
+                                                       cache, reset_cache, write_cache),
+                lookup_addresses))
+        fetched = {keys[result.ipaddress]: result for result in fetched}
+        for ipaddress in missing_addresses:
+            result = fetched[keys[ipaddress]]
+            if result.error is None:
+                geo_info = share_geo_info(result.geo_info, ipaddress)
+                result = LookupResult(ipaddress=ipaddress, geo_info=geo_info,
+                                      error=None)
+            else:
+                result = LookupResult(ipaddress=ipaddress, geo_info=None,
+                                      error=result.error)
+            results[ipaddress] = result
+
+    return [results[ipaddress] for ipaddress in ipaddresses]
+
+
+def get_geo_location_ips(ipaddresses, reset_cache=False, write_cache=True,
+                         n_digits_seconds=1, my_location=None, my_device_latlon=None,
+                         workers=DEFAULT_WORKERS, cache=None, database=None,
+                         keep_raw=True):
+    """
+    Get the location of many ip addresses in one go
+
+    The addresses are read in chunks which are resolved concurrently with
+    :func:`resolve_geo_locations`, so also a long stream of addresses can be processed.
+    Addresses for which the lookup fails are skipped with a warning.
+
+    Args:
+        ipaddresses: iterable of str
+            Ip addresses to locate. Can be any iterable, e.g. a list or an open file
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        n_digits_seconds: int
+            Number of digits to use for the seconds in the d-m-s notation of the location
+        my_location: str
+            Name of the device location, only used in the reports
+        my_device_latlon: dict
+            Location of the device as returned by :func:`get_geo_location_device`. If
+            given, the distance of each server to the device is added to the reports
+        workers: int
+            Maximum number of lookups running at the same time
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
+        keep_raw: bool
+            Keep the full geo information in the reports, which is only needed by the
+            raw format
+
+    Yields: LocationReport
+        One report per ip address, in the order of the input
+    """
+    ipaddresses = iter(ipaddresses)
+    chunk_size = 16 * max(1, workers)
+    while True:
+        chunk = list(islice(ipaddresses, chunk_size))
+        if not chunk:
+            break
+        results = resolve_geo_locations(chunk, workers=workers, reset_cache=reset_cache,
+                                        write_cache=write_cache, cache=cache,
+                                        database=database)
+        for result in results:
+            if result.error is not None:
+                _logger.warning(f"Failed to get a location for {result.ipaddress}: "
+                                f"{result.error}")
+        records = [GeoRecord.from_geo_info(result.geo_info, keep_raw=keep_raw)
+                   for result in results if result.error is None]
+        # look up the names of all countries in the chunk at once
+        with _stats.span("country_conversion"):
+            convert_country_codes(record.country for record in records)
+
+        if my_device_latlon is not None and records:
+            # calculate the distances of the whole chunk in one go
+            with _stats.span("distance"):
+                distances = get_distances([record.lat for record in records],
+                                          [record.lng for record in records],
+                                          my_device_latlon["my_lat"],
+                                          my_device_latlon["my_lng"])
+            my_lat, my_lng = my_device_latlon["my_lat"], my_device_latlon["my_lng"]
+        else:
+            distances = [math.nan] * len(records)
+            my_lat = my_lng = None
+
+        for record, distance in zip(records, distances):
+            distance = float(distance)
+            if my_lat is not None and math.isnan(distance):
+                _logger.warning(f"Failed to calculate distance to "
+                                f"{my_device_latlon}\n\n")
+            yield LocationReport(record, n_digits_seconds=n_digits_seconds,
+                                 my_location=my_location, my_lat=my_lat, my_lng=my_lng,
+                                 distance=None if math.isnan(distance) else distance)
+
+
 class SmartFormatter(argparse.ArgumentDefaultsHelpFormatter):
 
     def _split_lines(self, text, width):
@@ -242,12 +1301,14 @@ class SmartFormatter(argparse.ArgumentDefaultsHelpFormatter):
         return argparse.HelpFormatter._split_lines(self, text, width)
 
 
-def parse_args(args):
+def parse_args(args, command=None):
     """Parse command line parameters
 
     Args:
       args (List[str]): command line parameters as list of strings
           (for example  ``["--help"]``).
+      command (str): the subcommand given before the parameters, 'serve' or
+          'cache'. None for the lookups of the command line itself
 
     Returns:
       :obj:`argparse.Namespace`: command line parameters namespace
@@ -255,14 +1316,35 @@ def parse_args(args):
     parser = argparse.ArgumentParser(
         description="Get the location of your server (or any other server) and calculate the "
                     "distance to your own location",
+        epilog="Use 'whereisip serve [options]' to start a daemon which answers the "
+               "lookups of clients started with --server and 'whereisip cache "
+               "warm|stats|prune [targets] [options]' to fill, report or clean the "
+               "cache",
         formatter_class=SmartFormatter)
+    if command == "cache":
+        parser.prog = f"{parser.prog} cache"
+        parser.add_argument(
+            "cache_action",
+            choices=CACHE_ACTIONS,
+            help="R|What to do with the cache:\n"
+                 " - warm : look up the targets which are not in the cache yet\n"
+                 " - stats: report the number of entries and the size of the cache\n"
+                 " - prune: remove the expired entries\n"
+        )
+        parser.add_argument(
+            "targets",
+            nargs="*",
+            metavar="target",
+            help="Ip address, CIDR block or file with one address or block per line to "
+                 "warm up. Use '-' to read them from stdin"
+        )
     parser.add_argument(
         "--reset_cache",
         action="store_true",
         default=False,
-        help="Reset the cache files located in the .cache directory. Without reset, the information"
-             "is read from a cache file instead of making a new request to geocoder. "
-             "Each IP address of location gets its own cache file."
+        help="Reset the cache entries located in the .cache directory. Without reset, "
+             "the information is read from the cache instead of making a new request "
+             "to geocoder."
     )
     parser.add_argument(
         "--skip_cache",
@@ -270,6 +1352,62 @@ def parse_args(args):
         help="Do not read of write to the cache files",
         default=False,
     )
+    parser.add_argument(
+        "--cache_backend",
+        choices=CACHE_BACKENDS,
+        default=DEFAULT_CACHE_BACKEND,
+        help="R|How the cache is stored. Choices are:\n"
+             " - sqlite: all entries in one indexed database file. Existing json cache "
+             "files are migrated into the database\n"
+             " - json  : a separate json file per ip address or location\n"
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=DEFAULT_CACHE_TTL / (24 * 3600),
+        metavar="DAYS",
+        help="Number of days after which a cache entry expires and is looked up again. "
+             "Use 0 to keep the entries forever"
+    )
+    parser.add_argument(
+        "--negative_cache_ttl",
+        type=float,
+        default=DEFAULT_NEGATIVE_CACHE_TTL / 3600,
+        metavar="HOURS",
+        help="Number of hours a failed lookup is cached, such that addresses without a "
+             "location are not requested again on each run. Use 0 to not cache failed "
+             "lookups"
+    )
+    parser.add_argument(
+        "--aggregate_prefix",
+        action="store_true",
+        default=False,
+        help="Cache and look up the locations per network instead of per address, so "
+             "the neighbours of a known address are answered from the cache. The size "
+             "of the networks is set with --ipv4_prefix and --ipv6_prefix"
+    )
+    parser.add_argument(
+        "--ipv4_prefix",
+        type=int,
+        default=DEFAULT_IPV4_PREFIX,
+        help="Prefix length of the IPv4 networks which share a location with "
+             "--aggregate_prefix"
+    )
+    parser.add_argument(
+        "--ipv6_prefix",
+        type=int,
+        default=DEFAULT_IPV6_PREFIX,
+        help="Prefix length of the IPv6 networks which share a location with "
+             "--aggregate_prefix"
+    )
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=DEFAULT_CACHE_MAX_ENTRIES,
+        help="Maximum number of entries in the cache. If more entries are stored, the "
+             "least recently used ones are removed. Use 0 for a cache without a "
+             "maximum size"
+    )
     parser.add_argument("--n_digits_seconds", type=int, default=1,
                         help="Number of digits to use for the seconds notation. If a decimal "
                              "notation is used, the number of decimals will be n_digit_seconds + 1")
@@ -277,6 +1415,111 @@ def parse_args(args):
         "--ip_address",
         help="The ip address to get the geo location from. If not given, the local machine is used"
     )
+    parser.add_argument(
+        "--ip_file",
+        metavar="<File>",
+        help="File with ip addresses to get the geo location from, one address per "
+             "line. Use '-' to read the addresses from stdin. All addresses are "
+             "processed in one run and a report is given per address"
+    )
+    parser.add_argument(
+        "--log_file",
+        metavar="<File>",
+        help="Log file, e.g. an access log of a web server, to enrich with the "
+             "location of the ip addresses found in each line. Use '-' to read the log "
+             "from stdin. The lines are written to stdout with the locations appended "
+             "after a tab"
+    )
+    parser.add_argument(
+        "--ip_regex",
+        help="Regular expression matching the ip addresses in the lines of --log_file. "
+             "If it has groups, the first group is taken as the address. Default "
+             "matches all IPv4 and IPv6 addresses"
+    )
+    parser.add_argument(
+        "--dedup_window",
+        type=int,
+        default=DEFAULT_DEDUP_WINDOW,
+        help="Number of most recently seen ip addresses of which the location is "
+             "remembered when using --log_file, such that repeated addresses are "
+             "looked up only once"
+    )
+    parser.add_argument(
+        "--annotation",
+        choices=ANNOTATION_FORMATS,
+        default="human",
+        help="Notation of the locations appended to the lines of --log_file"
+    )
+    parser.add_argument(
+        "--database",
+        metavar="<File>",
+        help="Local database of ip ranges (a MaxMind .mmdb file or a .csv file) used "
+             "to look up the ip addresses offline instead of making requests to "
+             "geocoder"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of ip addresses looked up at the same time when using --ip_file"
+    )
+    parser.add_argument(
+        "--providers",
+        default="ipinfo",
+        help="Comma separated list of the providers used to look up the ip addresses, "
+             "which are tried in order until one finds the location. Choices are "
+             f"{DATABASE_PROVIDER} (the file given by --database) and "
+             f"{', '.join(GEOCODER_IP_PROVIDERS)}"
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        default=0,
+        help="Maximum number of requests per second to each provider. Use 0 for no "
+             "limit"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Number of times a request is repeated when the provider fails "
+             "temporarily, e.g. after a timeout or when the rate limit of the provider "
+             "is exceeded"
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=DEFAULT_BACKOFF,
+        help="Seconds to wait before the first retry. The wait doubles for each next "
+             "retry"
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="Number of connections to the provider which are kept open and shared by "
+             "all lookups. Should be at least the number of --workers"
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help="Seconds to wait for a connection to the provider"
+    )
+    parser.add_argument(
+        "--read_timeout",
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help="Seconds to wait for the response of the provider"
+    )
+    parser.add_argument(
+        "--server",
+        metavar="<Address>",
+        help="Address of the whereisip daemon, given as <host>:<port> or unix:<path>. "
+             "The lookups are sent to the daemon instead of being done by this "
+             "process. With 'whereisip serve', the daemon listens at this address "
+             "(default 127.0.0.1:8765)"
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -292,7 +1535,11 @@ def parse_args(args):
              " - human      : Human location City/Country\n"
              " - full       : Full report with all location notations\n"
              " - short      : A compact report with a sexagesimal and human nation + distance\n"
-             " - raw        : raw output from api\n",
+             " - raw        : raw output from api\n"
+             " - json       : All information as json "
+             "(a list of objects with --ip_file)\n"
+             " - jsonl      : All information as one json object per line\n"
+             " - csv        : All information as csv with a header line\n",
         choices=OUTPUT_FORMATS,
         default="short"
     )
@@ -312,6 +1559,21 @@ def parse_args(args):
         action="store_const",
         const=logging.DEBUG,
     )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Write the number of calls, the total time and the 95 percentile time of "
+             "each stage of the run and the cache hit ratio to stderr"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="<File>",
+        nargs="?",
+        const="-",
+        help="Profile the run with cProfile. The profile is written to the file, which "
+             "can be read with pstats. Without a file, the most expensive calls are "
+             "written to stderr"
+    )
     parser.add_argument(
         "--my_location",
         metavar="<Location or IP>",
@@ -322,7 +1584,33 @@ def parse_args(args):
              "In case no location is given and the *ip_address* option is used to specify an other"
              "server than your local server, my location is set to you local server's IP address"
     )
-    return parser.parse_args(args)
+    parser.add_argument(
+        "--skip_gazetteer",
+        action="store_true",
+        help="Always look up *my_location* with geocoder instead of the bundled table "
+             "of major cities",
+        default=False,
+    )
+    parsed_args = parser.parse_args(args)
+    parsed_args.providers = [name.strip() for name in parsed_args.providers.split(",")]
+    for name in parsed_args.providers:
+        if name != DATABASE_PROVIDER and name not in GEOCODER_IP_PROVIDERS:
+            parser.error(f"Provider {name} not recognised. Choose from "
+                         f"{DATABASE_PROVIDER}, {', '.join(GEOCODER_IP_PROVIDERS)}")
+    if DATABASE_PROVIDER in parsed_args.providers and parsed_args.database is None:
+        parser.error(f"The {DATABASE_PROVIDER} provider requires --database")
+    if parsed_args.retries < 0:
+        parser.error("The --retries can not be negative")
+    if not 0 <= parsed_args.ipv4_prefix <= 32:
+        parser.error("The --ipv4_prefix must be between 0 and 32")
+    if not 0 <= parsed_args.ipv6_prefix <= 128:
+        parser.error("The --ipv6_prefix must be between 0 and 128")
+    if command is None and parsed_args.server is not None:
+        # the daemon only reports the locations of the addresses sent to it
+        for option in ("log_file", "my_location"):
+            if getattr(parsed_args, option) is not None:
+                parser.error(f"The --{option} option can not be used with --server")
+    return parsed_args
 
 
 def setup_logging(loglevel):
@@ -332,49 +1620,370 @@ def setup_logging(loglevel):
       loglevel (int): minimum loglevel for emitting messages
     """
     logformat = "[%(asctime)s] %(levelname)s [%(lineno)4d]:%(name)s:%(message)s"
+    # log to stderr, such that the reports written to stdout can be read by other
+    # programs
     logging.basicConfig(
-        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+        level=loglevel, stream=sys.stderr, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
     )
 
 
-def main(args):
-    """Wrapper allowing :func:`fib` to be called with string arguments in a CLI fashion
+def report_ip_addresses(ipaddresses, args, my_device_latlon=None, reset_cache=False,
+                        write_cache=True, cache=None, database=None):
+    """
+    Report the location of all the ip addresses using the command line settings
 
-    Instead of returning the value from :func:`fib`, it prints the result to the
-    ``stdout`` in a nicely formatted message.
+    Args:
+        ipaddresses: iterable of str
+            The ip addresses to report
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+        my_device_latlon: dict
+            Location of the device as returned by :func:`get_geo_location_device`
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
+    """
+    reports = get_geo_location_ips(ipaddresses,
+                                   reset_cache=reset_cache,
+                                   write_cache=write_cache,
+                                   n_digits_seconds=args.n_digits_seconds,
+                                   my_location=args.my_location,
+                                   my_device_latlon=my_device_latlon,
+                                   workers=args.workers,
+                                   cache=cache,
+                                   database=database,
+                                   keep_raw=args.format == "raw")
+    write_reports(reports, output_format=args.format)
+
+
+def enrich_log(args, reset_cache=False, write_cache=True, cache=None, database=None):
+    """
+    Write the lines of the log file given on the command line with the locations
+    appended
 
     Args:
-      args (List[str]): command line parameters as list of strings
-          (for example  ``["--verbose", "42"]``).
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
     """
-    args = parse_args(args)
-    setup_logging(args.loglevel)
-    _logger.debug("Starting getting location...")
+    # imported here as logenrich builds on this module
+    from whereisip.logenrich import DEFAULT_FLUSH_INTERVAL, enrich_log_lines
+
+    settings = dict(ip_regex=args.ip_regex, dedup_window=args.dedup_window,
+                    annotation=args.annotation, n_digits_seconds=args.n_digits_seconds,
+                    workers=args.workers, reset_cache=reset_cache,
+                    write_cache=write_cache, cache=cache, database=database)
+    if args.log_file == "-":
+        # stdin may be a growing log, e.g. from tail -f: write each line as soon as it
+        # is enriched
+        stream = sys.stdin
+        settings["flush_interval"] = DEFAULT_FLUSH_INTERVAL
+    else:
+        stream = open(args.log_file, "r", errors="replace")
+    try:
+        for line in enrich_log_lines(stream, **settings):
+            sys.stdout.write(line + "\n")
+            if stream is sys.stdin:
+                sys.stdout.flush()
+        sys.stdout.flush()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def write_profile(profiler, profile_file):
+    """
+    Write the result of profiling the run
+
+    Args:
+        profiler: :obj:`cProfile.Profile`
+            The profiler
+        profile_file: str
+            File to dump the profile to. If '-', the most expensive calls are written to
+            stderr
+    """
+    if profile_file == "-":
+        profile = pstats.Stats(profiler, stream=sys.stderr)
+        profile.sort_stats("cumulative").print_stats(30)
+    else:
+        _logger.info(f"Writing profile to {profile_file}")
+        profiler.dump_stats(profile_file)
+
 
+def setup_lookups(args):
+    """
+    Configure the http session and the providers and open the cache and the database
+
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+
+    Returns: tuple
+        The reset_cache and write_cache flags, the cache and the database to pass to the
+        lookups
+    """
     write_cache = not args.skip_cache
 
     reset_cache = args.reset_cache | args.skip_cache
 
-    geo_info_ip = get_geo_location_ip(ipaddress=args.ip_address,
-                                      reset_cache=reset_cache,
-                                      write_cache=write_cache)
+    configure_session(pool_size=args.pool_size, connect_timeout=args.connect_timeout,
+                      read_timeout=args.read_timeout)
 
+    if args.skip_cache:
+        cache = None
+    else:
+        with _stats.span("open_cache"):
+            ttl = args.cache_ttl * 24 * 3600 if args.cache_ttl > 0 else None
+            cache = get_cache(backend=args.cache_backend, ttl=ttl,
+                              max_entries=args.cache_max_entries or None)
+
+    if args.database is None:
+        database = None
+    else:
+        with _stats.span("load_database"):
+            database = load_database(args.database)
+
+    set_negative_cache_ttl(args.negative_cache_ttl * 3600
+                           if args.negative_cache_ttl > 0 else None)
+    set_use_gazetteer(not args.skip_gazetteer)
+    set_prefix_aggregation(args.aggregate_prefix, ipv4_prefix=args.ipv4_prefix,
+                           ipv6_prefix=args.ipv6_prefix)
+    set_providers(make_providers(args.providers, database=database,
+                                 rate_limit=args.rate_limit or None,
+                                 retries=args.retries, backoff=args.backoff))
+    if DATABASE_PROVIDER in args.providers:
+        # the database is one of the providers, so its results are cached like the
+        # others
+        database = None
+
+    return reset_cache, write_cache, cache, database
+
+
+def plan_lookups(args):
+    """
+    Decide which lookups are needed to report the locations requested on the command
+    line
+
+    The device location is only needed for the formats which show the distance to the
+    server. Without an ip address and a device location, the server and the device are
+    both the local machine, which is then looked up only once.
+
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+
+    Returns: LookupPlan
+        The lookups to make
+    """
+    if args.format == "raw":
+        distance_needed = args.my_location is not None
+    else:
+        distance_needed = args.format in DISTANCE_FORMATS
+    if not distance_needed:
+        return LookupPlan(lookup_device=False, device_is_server=False)
+
+    device_is_server = (args.my_location is None and args.ip_address is None
+                        and args.ip_file is None)
+    return LookupPlan(lookup_device=not device_is_server,
+                      device_is_server=device_is_server)
+
+
+def find_locations(args):
+    """
+    Report the locations requested on the command line
+
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+    """
+    reset_cache, write_cache, cache, database = setup_lookups(args)
+
+    if args.log_file is not None:
+        enrich_log(args, reset_cache=reset_cache, write_cache=write_cache, cache=cache,
+                   database=database)
+        return
+
+    plan = plan_lookups(args)
+    my_device_latlon = None
+    if plan.lookup_device:
+        with _stats.span("device_lookup"):
+            my_device_latlon = get_geo_location_device(my_location=args.my_location,
+                                                       reset_cache=reset_cache,
+                                                       write_cache=write_cache,
+                                                       cache=cache)
+
+    report_settings = dict(args=args, my_device_latlon=my_device_latlon,
+                           reset_cache=reset_cache, write_cache=write_cache,
+                           cache=cache, database=database)
+    if args.ip_file is None:
+        with _stats.span("ip_lookup"):
+            geo_info_ip = get_geo_location_ip(ipaddress=args.ip_address,
+                                              reset_cache=reset_cache,
+                                              write_cache=write_cache,
+                                              cache=cache,
+                                              database=database)
+        distance = None
+        if plan.device_is_server:
+            my_device_latlon = geoinfo2location(geo_info_ip)
+            distance = 0.0
+        geo_info_ip = add_device_location(geo_info_ip, my_location=args.my_location,
+                                          my_device_latlon=my_device_latlon,
+                                          distance=distance)
+        server = LocationReport(geo_info=geo_info_ip,
+                                n_digits_seconds=args.n_digits_seconds)
+        server.make_report(output_format=args.format)
+    elif args.ip_file == "-":
+        report_ip_addresses(read_ip_addresses(sys.stdin), **report_settings)
+    else:
+        with open(args.ip_file, "r") as stream:
+            report_ip_addresses(read_ip_addresses(stream), **report_settings)
+
+
+def serve_lookups(args):
+    """
+    Run the daemon answering the lookups of the clients
+
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+    """
+    # imported here as the server builds on this module
+    from whereisip.server import (DEFAULT_SERVER_ADDRESS, LookupService, ServerError,
+                                  serve)
+
+    reset_cache, write_cache, cache, database = setup_lookups(args)
     my_device_latlon = get_geo_location_device(my_location=args.my_location,
                                                reset_cache=reset_cache,
-                                               write_cache=write_cache)
-    if my_device_latlon is not None:
-        geo_info_ip["my_location"] = args.my_location
-        for key, value in my_device_latlon.items():
-            geo_info_ip[key] = value
+                                               write_cache=write_cache,
+                                               cache=cache)
+    service = LookupService(my_device_latlon=my_device_latlon,
+                            my_location=args.my_location,
+                            n_digits_seconds=args.n_digits_seconds,
+                            workers=args.workers,
+                            reset_cache=reset_cache, write_cache=write_cache,
+                            cache=cache, database=database)
+    service.warm_up()
+    try:
+        serve(args.server or DEFAULT_SERVER_ADDRESS, service)
+    except ServerError as err:
+        raise SystemExit(f"error: {err}")
+
+
+def manage_cache(args):
+    """
+    Warm up, report or prune the cache as given on the command line
 
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+    """
+    # imported here as the cache tool builds on this module
+    from whereisip.cachetool import (DEFAULT_WARM_RATE, expand_targets,
+                                     format_cache_stats, get_cache_stats, prune_cache,
+                                     warm_cache)
+
+    if args.skip_cache:
+        raise SystemExit("error: the cache commands can not be used with --skip_cache")
+    _, _, cache, _ = setup_lookups(args)
+
+    if args.cache_action == "warm":
+        if not args.targets:
+            raise SystemExit("error: give the ip addresses, blocks or files to warm up")
         try:
-            geo_info_ip["distance"] = get_distance_to_server(geo_info_ip)
-        except TypeError:
-            _logger.warning(f"Failed to calculate distance to {my_device_latlon}\n\n")
+            ipaddresses = list(expand_targets(args.targets))
+        except ValueError as err:
+            raise SystemExit(f"error: {err}")
+        result = warm_cache(ipaddresses, cache=cache,
+                            rate_limit=args.rate_limit or DEFAULT_WARM_RATE,
+                            workers=args.workers, progress=sys.stderr)
+        print(f"{result.n_addresses} addresses: {result.n_fresh} in the cache already, "
+              f"{result.n_fetched} added, {result.n_failed} failed")
+    elif args.cache_action == "stats":
+        stats = get_cache_stats(cache, get_cache_dir(write_cache=False))
+        print(format_cache_stats(stats))
+    else:
+        print(f"Removed {prune_cache(cache)} cache entries")
+
+
+def query_server(args):
+    """
+    Let the daemon given on the command line report the locations
+
+    Args:
+        args: :obj:`argparse.Namespace`
+            The parsed command line parameters
+    """
+    from whereisip.server import ServerError, WhereisipClient
+
+    client = WhereisipClient(args.server)
+    try:
+        if args.ip_file is None:
+            report = client.report(ipaddress=args.ip_address, output_format=args.format)
+        elif args.ip_file == "-":
+            report = client.report(ipaddresses=read_ip_addresses(sys.stdin),
+                                   output_format=args.format)
+        else:
+            with open(args.ip_file, "r") as stream:
+                report = client.report(ipaddresses=read_ip_addresses(stream),
+                                       output_format=args.format)
+    except ServerError as err:
+        raise SystemExit(f"error: {err}")
+    sys.stdout.write(report)
+    sys.stdout.flush()
+
+
+def main(args):
+    """Wrapper allowing :func:`fib` to be called with string arguments in a CLI fashion
 
-    server = LocationReport(geo_info=geo_info_ip,
-                            n_digits_seconds=args.n_digits_seconds)
-    server.make_report(output_format=args.format)
+    Instead of returning the value from :func:`fib`, it prints the result to the
+    ``stdout`` in a nicely formatted message.
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["--verbose", "42"]``).
+    """
+    command = args[0] if len(args) > 0 and args[0] in COMMANDS else None
+    args = parse_args(args[1:] if command else args, command=command)
+    setup_logging(args.loglevel)
+    _logger.debug("Starting getting location...")
+
+    if args.stats:
+        _stats.reset()
+        _stats.enable()
+    profiler = cProfile.Profile() if args.profile is not None else None
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with _stats.span("total"):
+            if command == "serve":
+                serve_lookups(args)
+            elif command == "cache":
+                manage_cache(args)
+            elif args.server is not None:
+                query_server(args)
+            else:
+                find_locations(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            write_profile(profiler, args.profile)
+        if args.stats:
+            _stats.disable()
+            sys.stdout.flush()
+            sys.stderr.write(_stats.format_summary() + "\n")
 
     _logger.info("Script ends here")
 
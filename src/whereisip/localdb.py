@@ -0,0 +1,415 @@
+"""
+Offline geo location of ip addresses using a local database
+
+A database of ip ranges is loaded into an :class:`IpRangeIndex`: the start and end of
+the ranges are stored in sorted typed arrays and an ip address is located with a binary
+search, without any network request. The following database files can be loaded:
+
+    csv:  a table with a header line and one ip range per row. A range is given by a
+          *network* column in CIDR notation or by a *start_ip* and *end_ip* column. The
+          location is given by the *country*, *city*, *lat* and *lng* columns (the names
+          *country_code*, *country_iso_code*, *city_name*, *latitude* and *longitude*
+          are recognised as well)
+    mmdb: a MaxMind database, e.g. GeoLite2-City.mmdb. Requires the *maxminddb* package
+    wipidx: the binary index format of whereisip, written by :func:`write_binary_index`
+
+A binary index is not loaded into memory, but read with mmap. All processes using the
+same index file share one copy of it in the page cache and opening it takes no time, as
+nothing needs to be parsed. Convert a database to a binary index once with::
+
+    write_binary_index(load_database("GeoLite2-City.mmdb"), "GeoLite2-City.wipidx")
+
+The result of a lookup has the same shape as the geo_info of geocoder, so it can be
+passed to :class:`whereisip.getgeolocation.LocationReport` directly.
+"""
+
+import csv
+import ipaddress as ipaddr
+import logging
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+BINARY_INDEX_SUFFIX = ".wipidx"
+
+# Layout of the binary index. All numbers are big endian
+#   header:    magic, number of IPv4 ranges, IPv6 ranges, locations and strings
+#   ipv4:      start, end and location id of each IPv4 range
+#   ipv6:      start and end (each as two 64 bits halves) and location id of each IPv6
+#              range
+#   locations: country string id, city string id, latitude and longitude of each
+#              location
+#   strings:   offsets of the strings in the blob (one more than the number of strings)
+#   blob:      the utf-8 encoded strings
+BINARY_INDEX_MAGIC = b"WIPIDX01"
+HEADER = struct.Struct(">8sIIII")
+IPV4_RECORD = struct.Struct(">III")
+IPV6_RECORD = struct.Struct(">QQQQI")
+LOCATION_RECORD = struct.Struct(">IIdd")
+STRING_OFFSET = struct.Struct(">I")
+NO_STRING = 0xFFFFFFFF
+
+COLUMN_ALIASES = {
+    "country": ("country", "country_code", "country_iso_code"),
+    "city": ("city", "city_name"),
+    "lat": ("lat", "latitude"),
+    "lng": ("lng", "lon", "longitude"),
+}
+
+
+class BaseIpRangeIndex:
+    """
+    Base class of the ip range indices, which implement :meth:`find`
+    """
+
+    def find(self, address):
+        """
+        Find the location of an ip address
+
+        Args:
+            address: str
+                The ip address
+
+        Returns: tuple
+            The location as a (country, city, lat, lng) tuple, or None if the address is
+            not in any range
+        """
+        raise NotImplementedError
+
+    def lookup(self, address):
+        """
+        Get the geo information of an ip address
+
+        Args:
+            address: str
+                The ip address
+
+        Returns: dict
+            The geo information with the keys *ip*, *lat*, *lng*, *country*, *city* and
+            *status*, or None if the address is not in the database
+        """
+        location = self.find(address)
+        if location is None:
+            return None
+        country, city, lat, lng = location
+        return {"ip": address,
+                "lat": lat,
+                "lng": lng,
+                "country": country,
+                "city": city,
+                "status": "OK"}
+
+
+class IpRangeIndex(BaseIpRangeIndex):
+    """
+    Sorted index of non-overlapping ip ranges with their location
+
+    IPv4 ranges are stored in arrays of 32 bits integers. IPv6 ranges do not fit in a
+    typed array and are stored in sorted lists of integers. Each range refers to a
+    location in a table of unique locations, so ranges sharing a location share the
+    strings as well.
+
+    Args:
+        ranges: iterable of tuple
+            The ranges as (first_address, last_address, location) tuples, where the
+            addresses are :mod:`ipaddress` address objects and location is a (country,
+            city, lat, lng) tuple
+    """
+
+    def __init__(self, ranges=()):
+        self.locations = []
+        location_ids = dict()
+
+        per_version = {4: [], 6: []}
+        for first, last, location in ranges:
+            location_id = location_ids.get(location)
+            if location_id is None:
+                location_id = len(self.locations)
+                location_ids[location] = location_id
+                self.locations.append(location)
+            per_version[first.version].append((int(first), int(last), location_id))
+
+        self._starts = {4: array("I"), 6: []}
+        self._ends = {4: array("I"), 6: []}
+        self._location_ids = {4: array("I"), 6: array("I")}
+        for version, version_ranges in per_version.items():
+            version_ranges.sort()
+            for start, end, location_id in version_ranges:
+                self._starts[version].append(start)
+                self._ends[version].append(end)
+                self._location_ids[version].append(location_id)
+
+    def __len__(self):
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def find(self, address):
+        try:
+            address = ipaddr.ip_address(address)
+        except ValueError:
+            return None
+        version = address.version
+        number = int(address)
+        position = bisect_right(self._starts[version], number) - 1
+        if position < 0 or number > self._ends[version][position]:
+            return None
+        return self.locations[self._location_ids[version][position]]
+
+    def ranges(self, version):
+        """
+        Get the ranges of one ip version in sorted order
+
+        Args:
+            version: int
+                The ip version, 4 or 6
+
+        Returns: iterator
+            The (start, end, location_id) tuples of the ranges, with the addresses as
+            integers
+        """
+        return zip(self._starts[version], self._ends[version],
+                   self._location_ids[version])
+
+
+class MmapIpRangeIndex(BaseIpRangeIndex):
+    """
+    Ip range index read with mmap from a binary index file
+
+    The records have a fixed width, so the binary search reads them directly from the
+    mapped file without loading or copying the index.
+
+    Args:
+        filename: str or Path
+            The binary index file, as written by :func:`write_binary_index`
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        with open(self.filename, "rb") as stream:
+            self._mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_ipv4, self.n_ipv6, self.n_locations, self.n_strings = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != BINARY_INDEX_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{self.filename} is not a binary ip index of whereisip")
+        self._ipv4_offset = HEADER.size
+        self._ipv6_offset = self._ipv4_offset + self.n_ipv4 * IPV4_RECORD.size
+        self._locations_offset = self._ipv6_offset + self.n_ipv6 * IPV6_RECORD.size
+        self._strings_offset = (self._locations_offset
+                                + self.n_locations * LOCATION_RECORD.size)
+        self._blob_offset = (self._strings_offset
+                             + (self.n_strings + 1) * STRING_OFFSET.size)
+
+    def __len__(self):
+        return self.n_ipv4 + self.n_ipv6
+
+    def close(self):
+        """ Unmap the index file """
+        self._mmap.close()
+
+    def _ipv4_range(self, position):
+        return IPV4_RECORD.unpack_from(self._mmap,
+                                       self._ipv4_offset + position * IPV4_RECORD.size)
+
+    def _ipv6_range(self, position):
+        start_high, start_low, end_high, end_low, location_id = IPV6_RECORD.unpack_from(
+            self._mmap, self._ipv6_offset + position * IPV6_RECORD.size)
+        return (start_high << 64) | start_low, (end_high << 64) | end_low, location_id
+
+    def _string(self, string_id):
+        if string_id == NO_STRING:
+            return None
+        offset = self._strings_offset + string_id * STRING_OFFSET.size
+        start, = STRING_OFFSET.unpack_from(self._mmap, offset)
+        end, = STRING_OFFSET.unpack_from(self._mmap, offset + STRING_OFFSET.size)
+        blob = self._mmap[self._blob_offset + start:self._blob_offset + end]
+        return blob.decode("utf-8")
+
+    def location(self, location_id):
+        """ Get the (country, city, lat, lng) tuple of a location id """
+        country_id, city_id, lat, lng = LOCATION_RECORD.unpack_from(
+            self._mmap, self._locations_offset + location_id * LOCATION_RECORD.size)
+        return self._string(country_id), self._string(city_id), lat, lng
+
+    def find(self, address):
+        try:
+            address = ipaddr.ip_address(address)
+        except ValueError:
+            return None
+        if address.version == 4:
+            n_ranges, get_range = self.n_ipv4, self._ipv4_range
+        else:
+            n_ranges, get_range = self.n_ipv6, self._ipv6_range
+        number = int(address)
+
+        # find the last range starting at or before the address
+        low, high = 0, n_ranges
+        while low < high:
+            middle = (low + high) // 2
+            if get_range(middle)[0] <= number:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        start, end, location_id = get_range(low - 1)
+        if number > end:
+            return None
+        return self.location(location_id)
+
+
+def write_binary_index(index, filename):
+    """
+    Write an ip range index to a binary index file which can be read by
+    :class:`MmapIpRangeIndex`
+
+    Args:
+        index: IpRangeIndex
+            The index to write, e.g. as loaded by :func:`load_database`
+        filename: str or Path
+            The binary index file to write
+    """
+    strings = []
+    string_ids = dict()
+
+    def intern(string):
+        if string is None:
+            return NO_STRING
+        string_id = string_ids.get(string)
+        if string_id is None:
+            string_id = len(strings)
+            string_ids[string] = string_id
+            strings.append(string.encode("utf-8"))
+        return string_id
+
+    locations = [(intern(country), intern(city), lat, lng)
+                 for country, city, lat, lng in index.locations]
+    ipv4_ranges = list(index.ranges(4))
+    ipv6_ranges = list(index.ranges(6))
+
+    mask = (1 << 64) - 1
+    with open(filename, "wb") as stream:
+        stream.write(HEADER.pack(BINARY_INDEX_MAGIC, len(ipv4_ranges), len(ipv6_ranges),
+                                 len(locations), len(strings)))
+        for start, end, location_id in ipv4_ranges:
+            stream.write(IPV4_RECORD.pack(start, end, location_id))
+        for start, end, location_id in ipv6_ranges:
+            stream.write(IPV6_RECORD.pack(start >> 64, start & mask,
+                                          end >> 64, end & mask, location_id))
+        for location in locations:
+            stream.write(LOCATION_RECORD.pack(*location))
+        offset = 0
+        stream.write(STRING_OFFSET.pack(offset))
+        for string in strings:
+            offset += len(string)
+            stream.write(STRING_OFFSET.pack(offset))
+        for string in strings:
+            stream.write(string)
+
+
+def _get_column(row, name):
+    """ Get the value of a column of a csv row using the aliases of its name """
+    for alias in COLUMN_ALIASES[name]:
+        value = row.get(alias)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _read_csv_ranges(stream):
+    """ Yield the (first, last, location) tuples of the rows of a csv table """
+    for row in csv.DictReader(stream):
+        if row.get("network"):
+            network = ipaddr.ip_network(row["network"], strict=False)
+            first, last = network.network_address, network.broadcast_address
+        else:
+            first = ipaddr.ip_address(row["start_ip"])
+            last = ipaddr.ip_address(row["end_ip"])
+        lat = _get_column(row, "lat")
+        lng = _get_column(row, "lng")
+        if lat is None or lng is None:
+            continue
+        location = (_get_column(row, "country"), _get_column(row, "city"),
+                    float(lat), float(lng))
+        yield first, last, location
+
+
+def load_csv_database(filename):
+    """
+    Load a csv table of ip ranges
+
+    Args:
+        filename: str or Path
+            The csv file
+
+    Returns: IpRangeIndex
+        The index of the ip ranges
+    """
+    with open(filename, "r", newline="", encoding="utf-8") as stream:
+        return IpRangeIndex(_read_csv_ranges(stream))
+
+
+def _read_mmdb_ranges(reader):
+    """
+    Yield the (first, last, location) tuples of all networks in a MaxMind database
+    """
+    for network, record in reader:
+        location = record.get("location") or {}
+        lat = location.get("latitude")
+        lng = location.get("longitude")
+        if lat is None or lng is None:
+            continue
+        country = (record.get("country") or {}).get("iso_code")
+        city = (record.get("city") or {}).get("names", {}).get("en")
+        location = (country, city, lat, lng)
+        yield network.network_address, network.broadcast_address, location
+
+
+def load_mmdb_database(filename):
+    """
+    Load a MaxMind database
+
+    Args:
+        filename: str or Path
+            The mmdb file
+
+    Returns: IpRangeIndex
+        The index of the ip ranges
+    """
+    try:
+        import maxminddb
+    except ImportError:
+        raise ImportError("Reading a mmdb database requires the maxminddb package. "
+                          "Install it with 'pip install maxminddb'")
+    with maxminddb.open_database(str(filename)) as reader:
+        return IpRangeIndex(_read_mmdb_ranges(reader))
+
+
+def load_database(filename):
+    """
+    Load a database of ip ranges, the type is derived from the file extension
+
+    Args:
+        filename: str or Path
+            The database file, either a .mmdb, a .wipidx or a .csv file
+
+    Returns: BaseIpRangeIndex
+        The index of the ip ranges
+    """
+    filename = Path(filename)
+    _logger.debug(f"Loading ip database {filename}")
+    if filename.suffix == BINARY_INDEX_SUFFIX:
+        index = MmapIpRangeIndex(filename)
+    elif filename.suffix == ".mmdb":
+        index = load_mmdb_database(filename)
+    else:
+        index = load_csv_database(filename)
+    _logger.debug(f"Loaded {len(index)} ip ranges")
+    return index
@@ -0,0 +1,256 @@
+"""
+Enrich log files, e.g. nginx or Apache access logs, with the location of the ip
+addresses
+
+The log is processed as a stream of lines by a pipeline of generators: the lines are
+read in batches, the ip addresses are extracted with a regular expression, the new
+addresses of a batch are resolved in one go with
+:func:`whereisip.getgeolocation.resolve_geo_locations` (so the cache, the local database
+and the concurrent lookups are used), and each line is written with the locations of its
+addresses appended. The memory use does not depend on the size of the log.
+
+The locations of the most recently seen addresses are kept in a window, so an address
+which occurs many times in the log is only looked up once.
+
+A log which is still growing, e.g. ``tail -f access.log | whereisip --log_file -``, is
+not held back until a batch is full: with a *flush_interval* the lines read so far are
+processed as soon as no new line arrives within the interval.
+"""
+
+import ipaddress as ipaddr
+import logging
+import queue
+import re
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+from whereisip.getgeolocation import (ANNOTATION_FORMATS,
+                                      DEFAULT_DEDUP_WINDOW,
+                                      DEFAULT_WORKERS,
+                                      GeoRecord,
+                                      LocationReport,
+                                      resolve_geo_locations)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# IPv4 addresses and IPv6 addresses with at least two colons. An IPv6 address may end in
+# an IPv4 address, e.g. '::ffff:203.0.113.5'
+DEFAULT_IP_PATTERN = (r"(?<![\w.])(?:\d{1,3}\.){3}\d{1,3}(?![\w.])"
+                      r"|(?<![\w:])(?:[0-9a-fA-F]{0,4}:){2,7}"
+                      r"(?:(?:\d{1,3}\.){3}\d{1,3}(?!\w|\.\d)"
+                      r"|[0-9a-fA-F]{0,4}(?![\w:]|\.\d))")
+DEFAULT_BATCH_SIZE = 1000
+# seconds to wait for more lines of a growing log before processing the lines read so
+# far
+DEFAULT_FLUSH_INTERVAL = 0.2
+UNKNOWN_LOCATION = "unknown"
+
+
+def extract_ip_addresses(line, ip_regex=None):
+    """
+    Get the ip addresses from a line of text
+
+    Args:
+        line: str
+            The line to search
+        ip_regex: str or :obj:`re.Pattern`
+            Regular expression matching the ip addresses. If it has groups, the first
+            group is taken as the address. Defaults to DEFAULT_IP_PATTERN
+
+    Returns: list of str
+        The valid ip addresses in order of appearance, without duplicates
+    """
+    if ip_regex is None:
+        ip_regex = DEFAULT_IP_PATTERN
+    if isinstance(ip_regex, str):
+        ip_regex = re.compile(ip_regex)
+
+    addresses = []
+    for match in ip_regex.finditer(line):
+        address = match.group(1) if ip_regex.groups else match.group(0)
+        try:
+            ipaddr.ip_address(address)
+        except ValueError:
+            continue
+        if address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+def _read_lines_in_background(lines, max_lines):
+    """
+    Put (line, error) pairs in a queue from a separate thread, ending with (None, None)
+    """
+    lines_queue = queue.Queue(maxsize=max_lines)
+
+    def read():
+        try:
+            for line in lines:
+                lines_queue.put((line, None))
+        except Exception as err:
+            # raised again by the consumer of the queue
+            lines_queue.put((None, err))
+        lines_queue.put((None, None))
+
+    threading.Thread(target=read, daemon=True).start()
+    return lines_queue
+
+
+def read_lines_in_batches(lines, batch_size=DEFAULT_BATCH_SIZE, flush_interval=None):
+    """
+    Group a stream of lines in lists of at most batch_size lines
+
+    Args:
+        lines: iterable of str
+            The lines, e.g. an open file
+        batch_size: int
+            Maximum number of lines per batch
+        flush_interval: float
+            If given, a batch is also yielded when no new line arrives within this
+            number of seconds, such that the lines of a growing stream such as stdin are
+            not held back. None to always wait for a full batch
+
+    Yields: list of str
+        The batches of lines
+    """
+    if flush_interval is None:
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+            yield batch
+        return
+
+    lines_queue = _read_lines_in_background(lines, max_lines=batch_size)
+    batch = []
+    while True:
+        try:
+            # wait as long as needed for the first line of a batch
+            line, error = lines_queue.get(timeout=flush_interval if batch else None)
+        except queue.Empty:
+            yield batch
+            batch = []
+            continue
+        if error is not None:
+            raise error
+        if line is None:
+            break
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def annotate_line(line, annotations):
+    """
+    Append the location of the addresses to a line
+
+    Args:
+        line: str
+            The line, with or without trailing newline
+        annotations: list of tuple
+            The (address, location) pairs to append
+
+    Returns: str
+        The enriched line without trailing newline. The locations are separated from the
+        original line by a tab
+    """
+    line = line.rstrip("\r\n")
+    if not annotations:
+        return line
+    locations = "; ".join(f"{address}={location}" for address, location in annotations)
+    return f"{line}\t{locations}"
+
+
+def enrich_log_lines(lines, ip_regex=None, dedup_window=DEFAULT_DEDUP_WINDOW,
+                     batch_size=DEFAULT_BATCH_SIZE, annotation="human",
+                     n_digits_seconds=1, workers=DEFAULT_WORKERS, reset_cache=False,
+                     write_cache=True, cache=None, database=None, flush_interval=None):
+    """
+    Add the location of the ip addresses found in each line of a log
+
+    Args:
+        lines: iterable of str
+            The lines of the log, e.g. an open file or stdin
+        ip_regex: str or :obj:`re.Pattern`
+            Regular expression matching the ip addresses, see
+            :func:`extract_ip_addresses`
+        dedup_window: int
+            Number of most recently seen addresses of which the location is remembered
+        batch_size: int
+            Number of lines of which the addresses are resolved in one go
+        annotation: str
+            Notation of the locations appended to the lines, one of ANNOTATION_FORMATS
+        n_digits_seconds: int
+            Number of digits to use for the seconds in the d-m-s notation of the
+            location
+        workers: int
+            Maximum number of lookups running at the same time
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
+        flush_interval: float
+            Process the lines read so far when no new line arrives within this number of
+            seconds, see :func:`read_lines_in_batches`. None to always wait for a full
+            batch
+
+    Yields: str
+        The enriched lines without trailing newline
+    """
+    if annotation not in ANNOTATION_FORMATS:
+        raise ValueError(f"Annotation {annotation} not recognised. "
+                         f"Choose from {ANNOTATION_FORMATS}")
+    if ip_regex is None:
+        ip_regex = DEFAULT_IP_PATTERN
+    if isinstance(ip_regex, str):
+        ip_regex = re.compile(ip_regex)
+
+    # location per address of the most recently seen addresses
+    window = OrderedDict()
+
+    for batch in read_lines_in_batches(lines, batch_size=batch_size,
+                                       flush_interval=flush_interval):
+        addresses_per_line = [extract_ip_addresses(line, ip_regex) for line in batch]
+
+        new_addresses = []
+        for addresses in addresses_per_line:
+            for address in addresses:
+                if address in window:
+                    window.move_to_end(address)
+                elif address not in new_addresses:
+                    new_addresses.append(address)
+
+        if new_addresses:
+            _logger.debug(f"Resolving {len(new_addresses)} new addresses")
+            results = resolve_geo_locations(new_addresses, workers=workers,
+                                            reset_cache=reset_cache,
+                                            write_cache=write_cache, cache=cache,
+                                            database=database)
+            for result in results:
+                if result.error is None:
+                    record = GeoRecord.from_geo_info(result.geo_info, keep_raw=False)
+                    report = LocationReport(record, n_digits_seconds=n_digits_seconds)
+                    window[result.ipaddress] = report.render(output_format=annotation)
+                else:
+                    window[result.ipaddress] = UNKNOWN_LOCATION
+
+        for line, addresses in zip(batch, addresses_per_line):
+            locations = [(address, window[address]) for address in addresses]
+            yield annotate_line(line, locations)
+
+        # forget the least recently seen addresses once the batch is written
+        while len(window) > dedup_window:
+            window.popitem(last=False)
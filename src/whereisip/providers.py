@@ -0,0 +1,332 @@
+"""
+Providers of the location of ip addresses
+
+A provider looks up the location of an ip address, e.g. in a local database or with a
+request to a web service. The providers are tried in order by a :class:`ProviderChain`
+until one of them finds the location, so a local database can be used first with a web
+service as fallback.
+
+Each provider has a token bucket which limits the number of requests per second, such
+that the quota of a web service is not exceeded, and retries a failed request a number
+of times with an increasing wait in between.
+"""
+
+import logging
+import threading
+import time
+
+from whereisip.stats import get_stats
+from whereisip.utils import is_global_address
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# providers of geocoder which can locate an ip address
+GEOCODER_IP_PROVIDERS = ("ipinfo", "maxmind", "freegeoip")
+DATABASE_PROVIDER = "database"
+
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# http status codes after which the request is retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# http status codes of a missing or invalid token or an exhausted quota, after which the
+# next provider is tried without retrying
+AUTH_STATUS_CODES = {401, 402, 403}
+
+_stats = get_stats()
+
+
+class IpErrorNoLocationFound(Exception):
+    pass
+
+
+class IpErrorPrivateAddress(IpErrorNoLocationFound):
+    """ The address is private or reserved, so it has no location """
+    pass
+
+
+class IpErrorProviderFailed(IpErrorNoLocationFound):
+    """
+    The providers failed temporarily, so the address may be found when tried again
+    """
+    pass
+
+
+class ProviderError(Exception):
+    """
+    A temporary failure of a provider, e.g. a timeout or exceeding the rate limit
+    """
+    pass
+
+
+class ProviderAuthError(ProviderError):
+    """
+    The provider refused the request, e.g. for a missing token or an exhausted quota
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Limit the number of calls per second, shared by all threads
+
+    Args:
+        rate: float
+            Number of tokens added per second
+        capacity: float
+            Maximum number of tokens, i.e. the number of calls which can be made at once
+            after a quiet period. Defaults to one second of tokens
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"The rate must be positive. Got {rate}")
+        self.rate = rate
+        self.capacity = max(1.0, rate if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+
+        Returns: float
+            The time waited in seconds
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class Provider:
+    """
+    Base class of the providers
+
+    Derived classes implement :meth:`fetch`, which raises
+    :class:`IpErrorNoLocationFound` if the provider does not know the address and
+    :class:`ProviderError` if the request may succeed when it is tried again.
+
+    Args:
+        name: str
+            Name of the provider
+        rate_limit: float
+            Maximum number of requests per second. None for no limit
+        burst: float
+            Number of requests which can be made at once, see :class:`TokenBucket`
+        retries: int
+            Number of times a request is repeated after a :class:`ProviderError`
+        backoff: float
+            Seconds to wait before the first retry. The wait doubles for each next retry
+    """
+
+    def __init__(self, name, rate_limit=None, burst=None, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF):
+        if retries < 0:
+            raise ValueError(f"The number of retries can not be negative. "
+                             f"Got {retries}")
+        self.name = name
+        self.rate_limiter = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.retries = retries
+        self.backoff = backoff
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+    def check(self, ipaddress):
+        """
+        Check if the provider may know an ip address, before a request is made
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the local machine is requested
+
+        Raises:
+            IpErrorNoLocationFound: in case the provider does not know the address for
+                sure
+        """
+
+    def fetch(self, ipaddress):
+        """
+        Look up the location of an ip address once
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the local machine is requested
+
+        Returns: dict
+            The geo information in the same format as geocoder
+        """
+        raise NotImplementedError
+
+    def lookup(self, ipaddress):
+        """
+        Look up the location of an ip address within the rate limit, retrying temporary
+        failures
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the local machine is requested
+
+        Returns: dict
+            The geo information in the same format as geocoder
+
+        Raises:
+            IpErrorNoLocationFound: in case the provider does not know the address
+            ProviderError: in case the provider still fails after all retries, or
+                refuses the request
+        """
+        # an address which is known to fail does not use a token of the rate limiter
+        self.check(ipaddress)
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                with _stats.span("rate_limit"):
+                    self.rate_limiter.acquire()
+            try:
+                return self.fetch(ipaddress)
+            except ProviderError as err:
+                if attempt == self.retries or isinstance(err, ProviderAuthError):
+                    raise
+                wait = min(MAX_BACKOFF, self.backoff * 2 ** attempt)
+                _logger.debug(f"{self.name} failed for {ipaddress}: {err}. "
+                              f"Retry in {wait} s")
+                _stats.count("retry")
+                time.sleep(wait)
+
+
+class DatabaseProvider(Provider):
+    """
+    Look up the ip addresses in a local database
+
+    Args:
+        database: BaseIpRangeIndex
+            The database as loaded by :func:`whereisip.localdb.load_database`
+        **kwargs:
+            The settings of :class:`Provider`
+    """
+
+    def __init__(self, database, name=DATABASE_PROVIDER, **kwargs):
+        super().__init__(name, **kwargs)
+        self.database = database
+
+    def fetch(self, ipaddress):
+        # the public address of the local machine is not known beforehand
+        geo_info = None if ipaddress is None else self.database.lookup(ipaddress)
+        if geo_info is None:
+            raise IpErrorNoLocationFound(f"IP address {ipaddress} not found in the "
+                                         f"local database")
+        return geo_info
+
+
+class GeocoderProvider(Provider):
+    """
+    Look up the ip addresses with a web service of geocoder
+
+    Args:
+        name: str
+            Name of the geocoder provider, one of GEOCODER_IP_PROVIDERS
+        request: callable
+            Function making the request, called with the ip address (or 'me' for the
+            local machine), which returns the geocoder result
+        **kwargs:
+            The settings of :class:`Provider`
+    """
+
+    def __init__(self, name, request, **kwargs):
+        super().__init__(name, **kwargs)
+        self.request = request
+
+    def check(self, ipaddress):
+        if ipaddress is not None and not is_global_address(ipaddress):
+            # no need to ask the web service
+            raise IpErrorPrivateAddress(f"IP address {ipaddress} is a private or "
+                                        f"reserved address")
+
+    def fetch(self, ipaddress):
+        geocode = self.request("me" if ipaddress is None else ipaddress)
+        if not geocode.ok:
+            # geocoder sets the status code to 'Unknown' when no response was received
+            status_code = getattr(geocode, "status_code", None)
+            if status_code in AUTH_STATUS_CODES:
+                raise ProviderAuthError(f"Request for IP address {ipaddress} was "
+                                        f"refused with status {status_code}")
+            if status_code == "Unknown" or status_code in RETRY_STATUS_CODES:
+                raise ProviderError(f"Request for IP address {ipaddress} failed with "
+                                    f"status {status_code}")
+            raise IpErrorNoLocationFound(f"Failed to get a location for IP address "
+                                         f"{ipaddress}")
+
+        geo_info = geocode.geojson['features'][0]['properties']
+        if geo_info["status"] != "OK":
+            raise IpErrorNoLocationFound(f"Failed to get a location for IP address "
+                                         f"{ipaddress}")
+        return geo_info
+
+
+class ProviderChain:
+    """
+    Try a list of providers in order until one finds the location
+
+    Args:
+        providers: list of Provider
+            The providers in order of preference
+    """
+
+    def __init__(self, providers):
+        if not providers:
+            raise ValueError("At least one provider is needed")
+        self.providers = list(providers)
+
+    def __repr__(self):
+        return f"ProviderChain({self.providers!r})"
+
+    def lookup(self, ipaddress):
+        """
+        Look up the location of an ip address with the first provider which knows it
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the local machine is requested
+
+        Returns: dict
+            The geo information in the same format as geocoder
+
+        Raises:
+            IpErrorNoLocationFound: in case none of the providers found the location. It
+                is an IpErrorProviderFailed if a provider failed temporarily and an
+                IpErrorPrivateAddress if the address is not a global address
+        """
+        errors = []
+        for provider in self.providers:
+            try:
+                return provider.lookup(ipaddress)
+            except (IpErrorNoLocationFound, ProviderError) as err:
+                _logger.debug(f"{provider.name} has no location for {ipaddress}: {err}")
+                errors.append((provider.name, err))
+
+        if any(isinstance(err, ProviderError) for _, err in errors):
+            error_class = IpErrorProviderFailed
+        elif any(isinstance(err, IpErrorPrivateAddress) for _, err in errors):
+            error_class = IpErrorPrivateAddress
+        else:
+            error_class = IpErrorNoLocationFound
+        reasons = "; ".join(f"{name}: {err}" for name, err in errors)
+        raise error_class(f"Failed to get a location for IP address {ipaddress} "
+                          f"({reasons})")
@@ -0,0 +1,519 @@
+"""
+Lookup daemon and its client
+
+``whereisip serve`` starts a daemon which keeps the providers, the cache and the
+imported modules in memory and answers lookups over http, either on a localhost port or
+on a Unix socket::
+
+    whereisip serve --server 127.0.0.1:8765
+    whereisip serve --server unix:/run/whereisip.sock
+
+The daemon has the following endpoints:
+
+    GET  /health                  {"status": "ok"}
+    GET  /lookup?ip=<ip>          the location of the address as json, see
+                                  LocationReport.to_dict
+    POST /lookup {"ips": [...]}   {"results": [...]} with the location or the error
+                                  per address
+    POST /report                  the report of {"ip": <ip>} or {"ips": [...]} in the
+                                  output format given by "format", exactly as written
+                                  by the command line
+
+With ``--server`` the command line utility is a thin client which sends its lookups to
+the daemon instead of doing them itself::
+
+    whereisip --server 127.0.0.1:8765 --ip_address 8.8.8.8
+"""
+
+import http.client
+import io
+import ipaddress as ipaddr
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from whereisip.getgeolocation import (DEFAULT_WORKERS,
+                                      OUTPUT_FORMATS,
+                                      IpErrorNoLocationFound,
+                                      LocationReport,
+                                      add_device_location,
+                                      get_geo_location_ip,
+                                      resolve_geo_locations,
+                                      write_reports)
+from whereisip.session import get_session
+from whereisip.utils import get_distances, make_human_location
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SERVER_ADDRESS = "127.0.0.1:8765"
+DEFAULT_CLIENT_TIMEOUT = 60.0
+UNIX_PREFIX = "unix:"
+# maximum size of a request body, which allows batches of about a million addresses
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+class ServerError(Exception):
+    """ The daemon could not answer a request """
+    pass
+
+
+def parse_address(address):
+    """
+    Get the socket address of a daemon address
+
+    Args:
+        address: str
+            'unix:<path>' for a Unix socket, or '<host>:<port>' or
+            'http://<host>:<port>'
+
+    Returns: tuple
+        The address family, either 'unix' or 'tcp', and the path or the (host, port)
+        tuple
+    """
+    if address.startswith(UNIX_PREFIX):
+        return "unix", address[len(UNIX_PREFIX):]
+    if "://" not in address:
+        address = "http://" + address
+    parsed = urlparse(address)
+    if parsed.hostname is None or parsed.port is None:
+        raise ValueError(f"Address {address} must be given as <host>:<port> or "
+                         f"unix:<path>")
+    return "tcp", (parsed.hostname, parsed.port)
+
+
+class LookupService:
+    """
+    The lookups done by the daemon
+
+    Args:
+        my_device_latlon: dict
+            Location of the device as returned by :func:`get_geo_location_device`. If
+            given, the distance of each server to the device is added to the reports
+        my_location: str
+            Name of the device location, only used in the reports
+        n_digits_seconds: int
+            Number of digits to use for the seconds in the d-m-s notation of the
+            location
+        workers: int
+            Maximum number of lookups of a batch running at the same time
+        reset_cache: bool
+            Reset the cache
+        write_cache: bool
+            Write the cache
+        cache: CacheBackend
+            The cache to use. If None, the default cache is used
+        database: BaseIpRangeIndex
+            Local database to look up the ip addresses in instead of geocoder
+    """
+
+    def __init__(self, my_device_latlon=None, my_location=None, n_digits_seconds=1,
+                 workers=DEFAULT_WORKERS, reset_cache=False, write_cache=True,
+                 cache=None, database=None):
+        self.my_device_latlon = my_device_latlon
+        self.my_location = my_location
+        self.n_digits_seconds = n_digits_seconds
+        self.workers = workers
+        self.lookup_settings = dict(reset_cache=reset_cache, write_cache=write_cache,
+                                    cache=cache, database=database)
+
+    def warm_up(self):
+        """
+        Import the modules needed by the lookups and reports before the first request
+        """
+        get_session()
+        get_distances(0.0, 0.0, 0.0, 0.0)
+        make_human_location("NL", "Amsterdam")
+
+    def _make_report(self, geo_info):
+        geo_info = add_device_location(dict(geo_info), my_location=self.my_location,
+                                       my_device_latlon=self.my_device_latlon)
+        return LocationReport(geo_info, n_digits_seconds=self.n_digits_seconds)
+
+    def report(self, ipaddress=None):
+        """
+        Get the report of one ip address
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the machine of the daemon is
+                reported
+
+        Returns: LocationReport
+            The report
+
+        Raises:
+            IpErrorNoLocationFound: in case no location was found for the ip address
+        """
+        geo_info = get_geo_location_ip(ipaddress, **self.lookup_settings)
+        return self._make_report(geo_info)
+
+    def reports(self, ipaddresses):
+        """
+        Get the reports of many ip addresses, which are looked up concurrently
+
+        Args:
+            ipaddresses: list of str
+                The ip addresses
+
+        Returns: list of tuple
+            The (ip address, report, error) per address, where either report or error is
+            None
+        """
+        results = resolve_geo_locations(ipaddresses, workers=self.workers,
+                                        **self.lookup_settings)
+        return [(result.ipaddress,
+                 None if result.error is not None
+                 else self._make_report(result.geo_info),
+                 result.error)
+                for result in results]
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    """ Answers the http requests to the daemon with the LookupService of the server """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "whereisip"
+
+    def address_string(self):
+        # the client address of a Unix socket is not a (host, port) tuple
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        _logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body, ensure_ascii=False)
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError(f"Request of {length} bytes is too large")
+        body = self.rfile.read(length) if length else b"{}"
+        request = json.loads(body)
+        if not isinstance(request, dict):
+            raise ValueError("The request must be a json object")
+        return request
+
+    @staticmethod
+    def _result(ipaddress, report, error, output_format=None):
+        if error is not None:
+            return {"ip": ipaddress, "error": str(error)}
+        result = report.to_dict()
+        if output_format is not None:
+            result["report"] = report.render(output_format=output_format)
+        return result
+
+    @staticmethod
+    def _get_ip_address(ipaddress):
+        """ Check an address of a request. None refers to the machine of the daemon """
+        if ipaddress is None:
+            return None
+        if not isinstance(ipaddress, str):
+            raise ValueError(f"The ip address must be a string. Got {ipaddress!r}")
+        # raises a ValueError which tells what is wrong with the address
+        ipaddr.ip_address(ipaddress)
+        return ipaddress
+
+    @classmethod
+    def _get_ip_addresses(cls, ipaddresses):
+        """ Check the list of addresses of a request """
+        if not isinstance(ipaddresses, list):
+            raise ValueError(f"The ips must be a list of ip addresses. "
+                             f"Got {ipaddresses!r}")
+        if None in ipaddresses:
+            raise ValueError("The ips can not contain null")
+        return [cls._get_ip_address(ipaddress) for ipaddress in ipaddresses]
+
+    @staticmethod
+    def _get_format(output_format):
+        if output_format is not None and output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Format {output_format} not recognised. Choose from "
+                             f"{sorted(OUTPUT_FORMATS)}")
+        return output_format
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/health":
+                self._send(200, {"status": "ok"})
+            elif url.path == "/lookup":
+                output_format = self._get_format(query.get("format"))
+                ipaddress = self._get_ip_address(query.get("ip"))
+                try:
+                    report = service.report(ipaddress)
+                except IpErrorNoLocationFound as err:
+                    self._send(404, self._result(ipaddress, None, err))
+                else:
+                    self._send(200, self._result(ipaddress, report, None,
+                                                 output_format))
+            else:
+                self._send(404, {"error": f"Unknown path {url.path}"})
+        except ValueError as err:
+            self._send(400, {"error": str(err)})
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlparse(self.path).path
+        try:
+            request = self._read_json()
+            if path == "/lookup":
+                output_format = self._get_format(request.get("format"))
+                ipaddresses = self._get_ip_addresses(request.get("ips", []))
+                results = [self._result(*result, output_format=output_format)
+                           for result in service.reports(ipaddresses)]
+                self._send(200, {"results": results})
+            elif path == "/report":
+                output_format = self._get_format(request.get("format", "short"))
+                if "ips" in request:
+                    ipaddresses = self._get_ip_addresses(request["ips"])
+                    reports = []
+                    for ipaddress, report, error in service.reports(ipaddresses):
+                        if error is None:
+                            reports.append(report)
+                        else:
+                            _logger.warning(f"Failed to get a location for "
+                                            f"{ipaddress}: {error}")
+                    stream = io.StringIO()
+                    write_reports(reports, output_format=output_format, stream=stream)
+                    self._send(200, stream.getvalue(), content_type="text/plain")
+                else:
+                    ipaddress = self._get_ip_address(request.get("ip"))
+                    try:
+                        report = service.report(ipaddress)
+                    except IpErrorNoLocationFound as err:
+                        self._send(404, str(err), content_type="text/plain")
+                    else:
+                        text = report.render(output_format=output_format) + "\n"
+                        self._send(200, text, content_type="text/plain")
+            else:
+                self._send(404, {"error": f"Unknown path {path}"})
+        except ValueError as err:
+            self._send(400, {"error": str(err)})
+
+
+class LookupHTTPServer(ThreadingHTTPServer):
+    """ Daemon listening on a localhost port """
+
+    def __init__(self, server_address, service):
+        super().__init__(server_address, LookupRequestHandler)
+        self.service = service
+
+
+class LookupUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Daemon listening on a Unix socket """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        remove_stale_socket(socket_path)
+        super().__init__(socket_path, LookupRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket left behind by a daemon which was killed
+
+    Args:
+        socket_path: str
+            Path of the Unix socket
+
+    Raises:
+        ServerError: in case the path is not a socket or a daemon is still listening at
+            it
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ServerError(f"{socket_path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except ConnectionRefusedError:
+        _logger.debug(f"Removing the stale socket {socket_path}")
+        os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise ServerError(f"Another daemon is listening at {socket_path}")
+
+
+def make_server(address, service):
+    """
+    Make the daemon
+
+    Args:
+        address: str
+            Address to listen at, see :func:`parse_address`
+        service: LookupService
+            The lookups to do
+
+    Returns:
+        The server, which is started with its serve_forever method
+    """
+    family, socket_address = parse_address(address)
+    if family == "unix":
+        return LookupUnixServer(socket_address, service)
+    return LookupHTTPServer(socket_address, service)
+
+
+def serve(address, service):
+    """
+    Run the daemon until it is interrupted
+
+    Args:
+        address: str
+            Address to listen at, see :func:`parse_address`
+        service: LookupService
+            The lookups to do
+    """
+    server = make_server(address, service)
+    _logger.info(f"Serving lookups at {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        _logger.info("Stopping the daemon")
+    finally:
+        server.server_close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ http connection over a Unix socket """
+
+    def __init__(self, socket_path, timeout=DEFAULT_CLIENT_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class WhereisipClient:
+    """
+    Client of the lookup daemon
+
+    Args:
+        address: str
+            Address of the daemon, see :func:`parse_address`
+        timeout: float
+            Seconds to wait for the daemon
+    """
+
+    def __init__(self, address=DEFAULT_SERVER_ADDRESS, timeout=DEFAULT_CLIENT_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.family, self.socket_address = parse_address(address)
+
+    def _connect(self):
+        if self.family == "unix":
+            return UnixHTTPConnection(self.socket_address, timeout=self.timeout)
+        host, port = self.socket_address
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _request(self, method, path, request=None):
+        connection = self._connect()
+        try:
+            body = None if request is None else json.dumps(request)
+            headers = {} if request is None else {"Content-Type": "application/json"}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read().decode("utf-8")
+        except OSError as err:
+            raise ServerError(f"Failed to connect to whereisip daemon at "
+                              f"{self.address}: {err}")
+        finally:
+            connection.close()
+        if response.status == 404 and path.startswith(("/lookup", "/report")):
+            if response.getheader("Content-Type", "").startswith("application/json"):
+                raise IpErrorNoLocationFound(json.loads(data)["error"])
+            raise IpErrorNoLocationFound(data)
+        if response.status != 200:
+            raise ServerError(f"Daemon at {self.address} answered {response.status}: "
+                              f"{data}")
+        return data
+
+    def health(self):
+        """ Check that the daemon is running, returns {"status": "ok"} """
+        return json.loads(self._request("GET", "/health"))
+
+    def lookup(self, ipaddress=None):
+        """
+        Get the location of an ip address
+
+        Args:
+            ipaddress: str
+                Ip address. If None, the location of the machine of the daemon is
+                returned
+
+        Returns: dict
+            The location, see :meth:`LocationReport.to_dict`
+        """
+        query = "" if ipaddress is None else "?" + urlencode({"ip": ipaddress})
+        return json.loads(self._request("GET", "/lookup" + query))
+
+    def lookup_many(self, ipaddresses):
+        """
+        Get the locations of many ip addresses in one request
+
+        Args:
+            ipaddresses: iterable of str
+                The ip addresses
+
+        Returns: list of dict
+            The location per address, or a dict with the *ip* and the *error* if it
+            failed
+        """
+        return json.loads(self._request("POST", "/lookup",
+                                        {"ips": list(ipaddresses)}))["results"]
+
+    def report(self, ipaddress=None, ipaddresses=None, output_format="short"):
+        """
+        Get the report of one or many ip addresses as written by the command line
+        utility
+
+        Args:
+            ipaddress: str
+                Ip address to report. If None and no ipaddresses are given, the machine
+                of the daemon is reported
+            ipaddresses: iterable of str
+                Ip addresses to report in one go
+            output_format: str
+                The output format, one of OUTPUT_FORMATS
+
+        Returns: str
+            The report
+        """
+        if ipaddresses is not None:
+            request = {"ips": list(ipaddresses), "format": output_format}
+        else:
+            request = {"ip": ipaddress, "format": output_format}
+        return self._request("POST", "/report", request)
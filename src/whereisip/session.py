@@ -0,0 +1,105 @@
+"""
+Shared HTTP session for the requests to the geolocation providers
+
+Without a session, geocoder opens a new connection, including a new TLS handshake, for
+each request. All lookups of whereisip use one :obj:`requests.Session` instead, which
+keeps the connections to the provider open and shares them between calls and threads.
+The session is created on first use, so requests is only imported once a location is not
+in the cache.
+"""
+
+import logging
+import threading
+
+from whereisip.utils import LazyModule
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+requests = LazyModule("requests")
+requests_adapters = LazyModule("requests.adapters")
+
+# number of connections kept open per host, which should be at least the number of
+# workers
+DEFAULT_POOL_SIZE = 16
+# seconds to wait for a connection to be made and for the response
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10.0
+
+_lock = threading.Lock()
+_session = None
+_settings = {"pool_size": DEFAULT_POOL_SIZE,
+             "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+             "read_timeout": DEFAULT_READ_TIMEOUT}
+
+
+def configure_session(pool_size=None, connect_timeout=None, read_timeout=None):
+    """
+    Change the settings of the shared session
+
+    The current session is closed, so the next request uses a session with the new
+    settings
+
+    Args:
+        pool_size: int
+            Number of connections kept open per host
+        connect_timeout: float
+            Seconds to wait for a connection to be made
+        read_timeout: float
+            Seconds to wait for the response
+    """
+    global _session
+    with _lock:
+        if pool_size is not None:
+            _settings["pool_size"] = max(1, pool_size)
+        if connect_timeout is not None:
+            _settings["connect_timeout"] = connect_timeout
+        if read_timeout is not None:
+            _settings["read_timeout"] = read_timeout
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """
+    Get the session shared by all requests to the providers
+
+    Returns: :obj:`requests.Session`
+        The session with a connection pool of *pool_size* connections per host
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            pool_size = _settings["pool_size"]
+            _logger.debug(f"Creating http session with a pool of {pool_size} "
+                          f"connections")
+            session = requests.Session()
+            adapter = requests_adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def get_timeout():
+    """
+    Get the timeout of the requests to the providers
+
+    Returns: tuple
+        The connect and read timeout in seconds
+    """
+    return _settings["connect_timeout"], _settings["read_timeout"]
+
+
+def close_session():
+    """ Close the connections of the shared session """
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
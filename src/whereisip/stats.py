@@ -0,0 +1,211 @@
+"""
+Timing of the stages of a whereisip run
+
+The stages of a lookup, e.g. reading the cache, the request to the network and
+formatting the report, are timed with spans::
+
+    from whereisip.stats import get_stats
+
+    stats = get_stats()
+    stats.enable()
+    get_geo_location_ip("8.8.8.8")
+    print(stats.format_summary())
+
+The stats are disabled by default, in which case a span does not take any time
+measurement.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+# number of timings kept per stage to calculate the percentiles. Beyond this only the
+# count and the total time are updated, such that the memory use is bounded in long runs
+MAX_SAMPLES = 100000
+PERCENTILE = 95
+
+
+class _NoSpan:
+    """ Span used when the stats are disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    """ Measures the time between entering and leaving a with block """
+
+    __slots__ = ("stats", "stage", "start")
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Stats:
+    """
+    Counts and timings of the stages of a run
+
+    Args:
+        enabled: bool
+            Take the measurements. If False, spans and counts do nothing
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        """ Start taking measurements """
+        self.enabled = True
+
+    def disable(self):
+        """ Stop taking measurements """
+        self.enabled = False
+
+    def reset(self):
+        """ Remove all measurements """
+        with self._lock:
+            self.counts = Counter()
+            self.totals = defaultdict(float)
+            self.samples = defaultdict(list)
+
+    def span(self, stage):
+        """
+        Time a with block as a stage, e.g. ``with stats.span("fetch"): ...``
+
+        Args:
+            stage: str
+                Name of the stage
+
+        Returns:
+            The context manager
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, stage)
+
+    def record(self, stage, seconds):
+        """
+        Add the time of one run of a stage
+
+        Args:
+            stage: str
+                Name of the stage
+            seconds: float
+                Time the stage took
+        """
+        with self._lock:
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            samples = self.samples[stage]
+            if len(samples) < MAX_SAMPLES:
+                samples.append(seconds)
+
+    def count(self, event, n=1):
+        """
+        Count an event, e.g. a cache hit
+
+        Args:
+            event: str
+                Name of the event
+            n: int
+                Number of times the event occurred
+        """
+        if not self.enabled or n == 0:
+            return
+        with self._lock:
+            self.counts[event] += n
+
+    @property
+    def cache_hit_ratio(self):
+        """
+        Fraction of the cache reads which were a hit, nan if the cache was not read
+        """
+        hits = self.counts["cache_hit"]
+        total = hits + self.counts["cache_miss"]
+        return hits / total if total else math.nan
+
+    def summary(self):
+        """
+        Summarize the measurements
+
+        Returns: dict
+            The *counts* of all events and stages, the *cache_hit_ratio* and per stage
+            the *count*, *total* and *p95* time in seconds
+        """
+        with self._lock:
+            stages = dict()
+            for stage, samples in self.samples.items():
+                samples = sorted(samples)
+                rank = max(1, math.ceil(len(samples) * PERCENTILE / 100))
+                stages[stage] = {"count": self.counts[stage],
+                                 "total": self.totals[stage],
+                                 f"p{PERCENTILE}": samples[rank - 1]}
+            counts = dict(self.counts)
+        return {"counts": counts,
+                "cache_hit_ratio": self.cache_hit_ratio,
+                "stages": stages}
+
+    def format_summary(self):
+        """
+        Make a table of the measurements
+
+        Returns: str
+            The table with per stage the count, the total time and the p95 time and the
+            cache hit ratio below it
+        """
+        summary = self.summary()
+        header = (f"{'stage':<20}{'count':>8}{'total [ms]':>14}"
+                  f"{f'p{PERCENTILE} [ms]':>12}")
+        lines = [header, "-" * len(header)]
+        for stage, timing in sorted(summary["stages"].items(),
+                                    key=lambda item: -item[1]["total"]):
+            lines.append(f"{stage:<20}{timing['count']:>8d}"
+                         f"{timing['total'] * 1e3:>14.3f}"
+                         f"{timing[f'p{PERCENTILE}'] * 1e3:>12.3f}")
+        counts = summary["counts"]
+        hits = counts.get("cache_hit", 0)
+        misses = counts.get("cache_miss", 0)
+        if hits + misses:
+            lines.append(f"cache hit ratio: {summary['cache_hit_ratio']:.2f} "
+                         f"({hits} hits, {misses} misses)")
+        return "\n".join(lines)
+
+
+# the stats of the process, shared by all modules of whereisip
+_stats = Stats()
+
+
+def get_stats():
+    """
+    Get the stats object of whereisip
+
+    Returns: Stats
+        The stats shared by all lookups in this process
+    """
+    return _stats
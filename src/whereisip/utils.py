@@ -1,16 +1,59 @@
 """
 module with utilities used by whereisip
 """
+import importlib
+import ipaddress as ipaddr
+import json
 import logging
+import os
+import tempfile
 from pathlib import Path
 
 import appdirs
 
-from latloncalc import latlon as llc
-import country_converter as coco
+from whereisip.countries import COUNTRY_NAMES
 
 _logger = logging.getLogger(__name__)
 
+# country names which are not in COUNTRY_NAMES, as found by country_converter
+_converted_country_names = dict()
+
+
+class LazyModule:
+    """
+    Module which is only imported once one of its attributes is used
+
+    Importing country_converter, latloncalc, numpy and geocoder takes much longer than a
+    cached lookup, so they are only imported when they are needed.
+
+    Args:
+        name: str
+            Full name of the module
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            _logger.debug(f"Importing {self._name}")
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+llc = LazyModule("latloncalc.latlon")
+coco = LazyModule("country_converter")
+np = LazyModule("numpy")
+pyproj = LazyModule("pyproj")
+
+# mean radius of the earth in km used by the haversine formula
+EARTH_RADIUS = 6371.0
+DISTANCE_METHODS = {"geodesic", "haversine"}
+
+# well-known prefix of NAT64, of which the last 32 bits are the IPv4 address (RFC 6052)
+NAT64_NETWORK = ipaddr.ip_network("64:ff9b::/96")
+
 
 def deg_to_dms(degrees_decimal: float, n_digits_seconds: int = 1):
     """
@@ -95,15 +138,70 @@ def make_human_location(country_code: str, city: str):
     Returns: str
         Either city / country (country_code)  or city /country_code
     """
-    if coco is not None:
-        country_name = coco.convert(country_code, to="name_short")
-        country = country_name + f" ({country_code})"
-    else:
-        country = country_code
+    country_name = get_country_name(country_code)
+    country = country_name + f" ({country_code})"
     location = f"{city}/{country}"
     return location
 
 
+def convert_country_codes(country_codes):
+    """
+    Get the short country names of many country codes in one pass
+
+    The names are taken from the precomputed table in :mod:`whereisip.countries`. Only
+    the codes which are not in the table are converted by country_converter, all in one
+    call. The results of country_converter are remembered, so each unknown code is
+    converted only once.
+
+    Args:
+        country_codes: iterable of str
+            The country codes, e.g. ISO2 codes as returned by geocoder
+
+    Returns: dict
+        The short country name per unique country code
+    """
+    names = dict()
+    unknown_codes = []
+    for country_code in set(country_codes):
+        name = COUNTRY_NAMES.get(country_code)
+        if name is None:
+            name = _converted_country_names.get(country_code)
+        if name is None:
+            unknown_codes.append(country_code)
+        else:
+            names[country_code] = name
+
+    if unknown_codes:
+        _logger.debug(f"Converting unknown country codes {unknown_codes} with "
+                      f"country_converter")
+        converted = coco.convert(unknown_codes, to="name_short")
+        if isinstance(converted, str):
+            # country_converter does not return a list for a list with one code
+            converted = [converted]
+        for country_code, name in zip(unknown_codes, converted):
+            _converted_country_names[country_code] = name
+            names[country_code] = name
+
+    return names
+
+
+def get_country_name(country_code):
+    """
+    Get the short name of a country
+
+    Args:
+        country_code: str
+            The country code, e.g. NL
+
+    Returns: str
+        The short country name, e.g. Netherlands
+    """
+    name = COUNTRY_NAMES.get(country_code)
+    if name is None:
+        name = convert_country_codes([country_code])[country_code]
+    return name
+
+
 def query_yes_no(message):
     answer = input(f"{message}. Continue? [y/N]")
     if answer == "":
@@ -124,7 +222,91 @@ def query_yes_no(message):
     return positive
 
 
-def get_cache_file(ipaddress, write_cache=True) -> Path:
+def get_cache_dir(write_cache=True) -> Path:
+    """
+    Get the directory where whereisip stores its cache
+
+    Args:
+        write_cache: bool
+            Create the directory in case it does not exist yet
+
+    Returns:
+        Path object of the cache directory
+    """
+    cache_dir = Path(appdirs.user_cache_dir("whereisip"))
+
+    if write_cache:
+        cache_dir.mkdir(exist_ok=True, parents=True)
+
+    return cache_dir
+
+
+def get_cache_key(ipaddress) -> str:
+    """
+    Get the key under which the information of an ip address or location is cached
+
+    Args:
+        ipaddress: str
+            Ip address or location name. None refers to the local machine
+
+    Returns: str
+        The cache key
+    """
+    if ipaddress is None:
+        return "localhost"
+    return ipaddress
+
+
+def get_prefix_cache_key(ipaddress, ipv4_prefix=24, ipv6_prefix=48) -> str:
+    """
+    Get the key under which the information of the network of an ip address is cached
+
+    Args:
+        ipaddress: str
+            Ip address or location name. None refers to the local machine
+        ipv4_prefix: int
+            Prefix length of the network of an IPv4 address
+        ipv6_prefix: int
+            Prefix length of the network of an IPv6 address
+
+    Returns: str
+        The cache key of the network, e.g. 'net_192.0.2.0_24' for '192.0.2.17'. The
+        network of an IPv4-mapped or NAT64 address is the one of the embedded IPv4
+        address. For a location name or the local machine it is the key of
+        :func:`get_cache_key`
+    """
+    network = get_prefix_network(ipaddress, ipv4_prefix=ipv4_prefix,
+                                 ipv6_prefix=ipv6_prefix)
+    if network is None:
+        return get_cache_key(ipaddress)
+    # no '/' in the key, as the json backend uses it in the file name
+    return f"net_{network.network_address}_{network.prefixlen}"
+
+
+def get_prefix_network(ipaddress, ipv4_prefix=24, ipv6_prefix=48):
+    """
+    Get the network of an ip address used by the prefix aggregation
+
+    Args:
+        ipaddress: str
+            Ip address
+        ipv4_prefix: int
+            Prefix length of the network of an IPv4 address
+        ipv6_prefix: int
+            Prefix length of the network of an IPv6 address
+
+    Returns: :obj:`ipaddress.IPv4Network` or :obj:`ipaddress.IPv6Network`
+        The network, None if *ipaddress* is not an ip address
+    """
+    try:
+        address = ipaddr.ip_address(normalize_ip_address(ipaddress))
+    except ValueError:
+        return None
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return ipaddr.ip_network(f"{address}/{prefix}", strict=False)
+
+
+def get_cache_file(ipaddress, write_cache=True, cache_dir=None) -> Path:
     """
     Get the cache file name based on the ip address
 
@@ -133,6 +315,9 @@ def get_cache_file(ipaddress, write_cache=True) -> Path:
             Ip address of the cache file
         write_cache: bool
             Write the cache file
+        cache_dir: Path
+            Directory of the cache files. Defaults to the user cache directory of
+            whereisip
 
     Returns:
 
@@ -140,20 +325,135 @@ def get_cache_file(ipaddress, write_cache=True) -> Path:
 
     """
 
-    cache_dir = Path(appdirs.user_cache_dir("whereisip"))
+    if cache_dir is None:
+        cache_dir = get_cache_dir(write_cache=write_cache)
 
-    if write_cache:
-        cache_dir.mkdir(exist_ok=True, parents=True)
-
-    if ipaddress is None:
-        suffix = "localhost"
-    else:
-        suffix = ipaddress
+    suffix = get_cache_key(ipaddress)
 
     cache_file = cache_dir / Path("_".join(["resp", suffix]) + ".json")
     return cache_file
 
 
+def read_cache_file(cache_file):
+    """
+    Read the information stored in a cache file
+
+    Args:
+        cache_file: Path
+            The cache file to read
+
+    Returns: dict
+        The cached information or None if the cache file does not exist or is corrupt
+    """
+    try:
+        with open(cache_file, "r") as stream:
+            info = json.load(stream)
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        # a corrupt entry is looked up again and overwritten
+        _logger.warning(f"Ignoring corrupt cache file {cache_file}: {err}")
+        return None
+    if not isinstance(info, dict):
+        _logger.warning(f"Ignoring corrupt cache file {cache_file}: not a json object")
+        return None
+    return info
+
+
+def write_cache_file(cache_file, info):
+    """
+    Write information to a cache file
+
+    The information is written to a temporary file which replaces the cache file once it
+    is complete, so other processes never read a partially written cache file
+
+    Args:
+        cache_file: Path
+            The cache file to write
+        info: dict
+            The information to store
+    """
+    cache_file = Path(cache_file)
+    stream = tempfile.NamedTemporaryFile("w", dir=cache_file.parent,
+                                         prefix=f".{cache_file.name}.", suffix=".tmp",
+                                         delete=False)
+    try:
+        with stream:
+            json.dump(info, stream, indent=True)
+        os.replace(stream.name, cache_file)
+    except BaseException:
+        try:
+            os.unlink(stream.name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def read_ip_addresses(stream):
+    """
+    Read the ip addresses from a stream with one address per line
+
+    Args:
+        stream: iterable of str
+            Stream (file or stdin) to read the ip addresses from. Empty lines and lines
+            starting with a '#' are skipped
+
+    Yields: str
+        The ip addresses one by one
+    """
+    for line in stream:
+        ipaddress = line.strip()
+        if not ipaddress or ipaddress.startswith("#"):
+            continue
+        yield ipaddress
+
+
+def normalize_ip_address(ipaddress):
+    """
+    Get the IPv4 address embedded in an IPv4-mapped or NAT64 IPv6 address, e.g.
+    '1.1.1.1' for '::ffff:1.1.1.1' or '64:ff9b::1.1.1.1', such that all forms are looked
+    up and cached as one address
+
+    Args:
+        ipaddress: str
+            The ip address. None refers to the local machine
+
+    Returns: str
+        The embedded IPv4 address, otherwise the address as given
+    """
+    try:
+        address = ipaddr.ip_address(ipaddress)
+    except ValueError:
+        return ipaddress
+    if address.version == 4:
+        return ipaddress
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+    if address in NAT64_NETWORK:
+        return str(ipaddr.IPv4Address(int(address) & 0xFFFFFFFF))
+    return ipaddress
+
+
+def is_global_address(ipaddress):
+    """
+    Check if an ip address can have a location, i.e. is not private, loopback,
+    link-local, multicast or otherwise reserved
+
+    Args:
+        ipaddress: str
+            The ip address
+
+    Returns: bool
+        False for the non-global addresses. Strings which are not an ip address, e.g.
+        host names, are left to the provider and give True
+    """
+    try:
+        address = ipaddr.ip_address(ipaddress)
+    except ValueError:
+        return True
+    return address.is_global and not address.is_multicast
+
+
 def get_distance_to_server(geo_info):
     """
     Get the coordinates from the two locations stored in geo_info and calculate the distance
@@ -173,6 +473,88 @@ def get_distance_to_server(geo_info):
     return latlon_server.distance(latlon_device)
 
 
+def get_distances(latitudes, longitudes, other_latitudes, other_longitudes,
+                  method="geodesic"):
+    """
+    Calculate the distances between many pairs of locations at once
+
+    The coordinates are broadcast against each other with the numpy rules, so a single
+    location can be compared with an array of locations. Missing coordinates (None) give
+    a nan distance.
+
+    Args:
+        latitudes: float or array_like
+            Latitudes of the first locations in decimal degrees
+        longitudes: float or array_like
+            Longitudes of the first locations in decimal degrees
+        other_latitudes: float or array_like
+            Latitudes of the second locations in decimal degrees
+        other_longitudes: float or array_like
+            Longitudes of the second locations in decimal degrees
+        method: str
+            How to calculate the distance:
+
+                geodesic:   distance over the WGS84 ellipsoid, the same as
+                            :func:`get_distance_to_server`
+                haversine:  great circle distance over a sphere, which is faster but
+                            may differ up to 0.5% from the geodesic distance
+
+    Returns: :obj:`numpy.ndarray`
+        The distances in km
+    """
+    if method not in DISTANCE_METHODS:
+        raise ValueError(f"Distance method {method} not recognised. "
+                         f"Choose from {DISTANCE_METHODS}")
+
+    coordinates = [np.asarray(values, dtype=float)
+                   for values in (latitudes, longitudes,
+                                  other_latitudes, other_longitudes)]
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*coordinates)
+
+    if method == "geodesic":
+        geod = pyproj.Geod(ellps="WGS84")
+        shape = lat1.shape
+        _, _, distances = geod.inv(lon1.ravel(), lat1.ravel(),
+                                   lon2.ravel(), lat2.ravel())
+        distances = np.asarray(distances, dtype=float).reshape(shape) / 1000.0
+    else:
+        lat1, lon1, lat2, lon2 = (np.radians(values)
+                                  for values in (lat1, lon1, lat2, lon2))
+        half_chord = (np.sin((lat2 - lat1) / 2) ** 2 +
+                      np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(half_chord))
+
+    return distances
+
+
+def get_distance_matrix(latitudes, longitudes, other_latitudes, other_longitudes,
+                        method="geodesic"):
+    """
+    Calculate the distances between all N locations and all M other locations
+
+    Args:
+        latitudes: array_like
+            Latitudes of the N locations (e.g. servers) in decimal degrees
+        longitudes: array_like
+            Longitudes of the N locations in decimal degrees
+        other_latitudes: array_like
+            Latitudes of the M other locations (e.g. devices) in decimal degrees
+        other_longitudes: array_like
+            Longitudes of the M other locations in decimal degrees
+        method: str
+            How to calculate the distance, see :func:`get_distances`
+
+    Returns: :obj:`numpy.ndarray`
+        N x M matrix with the distances in km
+    """
+    latitudes = np.asarray(latitudes, dtype=float)[:, np.newaxis]
+    longitudes = np.asarray(longitudes, dtype=float)[:, np.newaxis]
+    other_latitudes = np.asarray(other_latitudes, dtype=float)[np.newaxis, :]
+    other_longitudes = np.asarray(other_longitudes, dtype=float)[np.newaxis, :]
+    return get_distances(latitudes, longitudes, other_latitudes, other_longitudes,
+                         method=method)
+
+
 def geoinfo2location(geo_info) -> dict:
     """
     Extract the relevant location information from the geo_info dictionary
@@ -1,10 +1,98 @@
 """
-    Dummy conftest.py for whereisip.
+    conftest.py for whereisip.
+
+    Provides fixtures to run the tests offline: a fake geocoder which answers from a
+    small table of known addresses and a temporary cache directory.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     - https://docs.pytest.org/en/stable/fixture.html
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
 
-# import pytest
+import pytest
+
+FAKE_LOCATIONS = {
+    "8.8.8.8": {"city": "Mountain View", "country": "US",
+                "lat": 37.4056, "lng": -122.0775},
+    "1.1.1.1": {"city": "Brisbane", "country": "AU", "lat": -27.4816, "lng": 153.0175},
+    "37.97.253.1": {"city": "Amsterdam", "country": "NL",
+                    "lat": 52.3740, "lng": 4.8897},
+}
+FAKE_PLACES = {
+    "Amsterdam,The Netherlands": (52.3727598, 4.8936041),
+    "Springfield,Illinois": (39.7817, -89.6501),
+}
+FAKE_MY_IP = "37.97.253.1"
+
+
+class FakeGeocode:
+    """ Mimics the result of geocoder.ip """
+
+    def __init__(self, ipaddress):
+        if ipaddress == "me":
+            ipaddress = FAKE_MY_IP
+        location = FAKE_LOCATIONS.get(ipaddress)
+        self.ok = location is not None
+        properties = {"ip": ipaddress,
+                      "status": "OK" if self.ok else "ERROR - No results found"}
+        if self.ok:
+            properties.update(location)
+        self.geojson = {"features": [{"properties": properties}]}
+
+
+class FakePlace:
+    """ Mimics the result of geocoder.get for a place name """
+
+    def __init__(self, place):
+        self.latlng = list(FAKE_PLACES.get(place, []))
+        self.ok = bool(self.latlng)
+
+
+class FakeLatLon:
+    """ Mimics the result of geocoder.location """
+
+    def __init__(self, place):
+        self.lat, self.lng = place.latlng
+
+
+class FakeGeocoder:
+    """ Replacement of the geocoder module which counts the number of requests """
+
+    def __init__(self):
+        self.n_requests = 0
+        # the http session of each request
+        self.sessions = []
+
+    def ip(self, ipaddress, session=None, **kwargs):
+        self.n_requests += 1
+        self.sessions.append(session)
+        return FakeGeocode(ipaddress)
+
+    def get(self, location, provider, session=None, timeout=None):
+        self.n_requests += 1
+        self.sessions.append(session)
+        if provider == "osm":
+            return FakePlace(location)
+        return FakeGeocode(location)
+
+    def location(self, place, **kwargs):
+        # reads the coordinates of a geocoder result without a request
+        return FakeLatLon(place)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """ Let appdirs put the cache files in a temporary directory """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    return tmp_path / "whereisip"
+
+
+@pytest.fixture
+def fake_geocoder(monkeypatch, cache_dir):
+    """ Replace the geocoder used by whereisip with an offline fake """
+    geocoder = FakeGeocoder()
+    monkeypatch.setattr("whereisip.getgeolocation.geocoder", geocoder)
+    # restore the module settings changed by main
+    monkeypatch.setattr("whereisip.getgeolocation._use_gazetteer", True)
+    monkeypatch.setattr("whereisip.getgeolocation._prefix_lengths", None)
+    return geocoder
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from whereisip.aiogeolocation import (AsyncGeoLocator, get_geo_location_device,
+                                      get_geo_location_ip)
+from whereisip.getgeolocation import IpErrorNoLocationFound
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+def test_get_geo_location_ip(fake_geocoder):
+    """
+    The async lookup gives the same result as the synchronous one and uses the cache
+    """
+    geo_info = asyncio.run(get_geo_location_ip("8.8.8.8"))
+    assert geo_info["city"] == "Mountain View"
+    geo_info = asyncio.run(get_geo_location_ip("8.8.8.8"))
+    assert geo_info["city"] == "Mountain View"
+    assert fake_geocoder.n_requests == 1
+
+
+def test_get_geo_location_device(fake_geocoder):
+    """ test the async device lookup """
+    location = asyncio.run(get_geo_location_device("Amsterdam,The Netherlands",
+                                                   write_cache=False))
+    assert location == {"my_location": "Amsterdam,The Netherlands",
+                        "my_lat": 52.3727598,
+                        "my_lng": 4.8936041}
+
+
+def test_coalesce_identical_requests(fake_geocoder):
+    """ A burst of identical requests only leads to one upstream request """
+
+    async def burst():
+        locator = AsyncGeoLocator(max_concurrency=2, write_cache=False)
+        requests = [locator.get_geo_location_ip(ip)
+                    for ip in ["1.1.1.1"] * 10 + ["8.8.8.8"]]
+        return await asyncio.gather(*requests)
+
+    results = asyncio.run(burst())
+    assert [geo_info["ip"] for geo_info in results] == ["1.1.1.1"] * 10 + ["8.8.8.8"]
+    assert fake_geocoder.n_requests == 2
+
+
+def test_exception(fake_geocoder):
+    """ The exception of a failing lookup is passed on """
+    with pytest.raises(IpErrorNoLocationFound):
+        asyncio.run(get_geo_location_ip("10.2.30.11", write_cache=False))
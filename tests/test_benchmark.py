@@ -0,0 +1,53 @@
+import json
+
+import whereisip.cache as cache
+import whereisip.getgeolocation as getgeolocation
+from whereisip.benchmark import get_percentile, main, run_benchmarks, stub_provider
+from whereisip.getgeolocation import OUTPUT_FORMATS
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+def test_get_percentile():
+    """ test the nearest rank percentiles """
+    values = list(range(1, 101))
+    assert get_percentile(values, 50) == 50
+    assert get_percentile(values, 99) == 99
+    assert get_percentile([3.0], 90) == 3.0
+
+
+def test_stub_provider(fake_geocoder):
+    """ test that the stub provider answers all addresses and is removed again """
+    with stub_provider() as stub:
+        geo_info = getgeolocation.get_geo_location_ip("45.0.0.1", write_cache=False)
+        assert geo_info["status"] == "OK"
+        assert stub.n_requests == 1
+    assert getgeolocation.geocoder is fake_geocoder
+
+
+def test_run_benchmarks(fake_geocoder):
+    """ test that all paths are benchmarked without requests to the provider """
+    n_caches = len(cache._caches)
+    results = {result.name: result for result in run_benchmarks(n_calls=5)}
+    assert fake_geocoder.n_requests == 0
+    # the cache in the temporary directory is not kept
+    assert len(cache._caches) == n_caches
+
+    expected = {"lookup_cold", "lookup_warm", "report_init",
+                "make_sexagesimal_location", "make_human_location",
+                "get_distance_to_server"}
+    expected.update(f"render_{output_format}" for output_format in OUTPUT_FORMATS)
+    assert set(results) == expected
+    for result in results.values():
+        assert result.n_calls == 5
+        assert result.percentiles[50] <= result.percentiles[99]
+
+
+def test_main_json(cache_dir, capsys):
+    """ test the selection of benchmarks and the json output """
+    main(["-n", "3", "--json", "render_j", "make_human"])
+    results = json.loads(capsys.readouterr().out)
+    names = [result["name"] for result in results]
+    assert names == ["render_json", "render_jsonl", "make_human_location"]
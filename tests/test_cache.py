@@ -0,0 +1,310 @@
+import json
+import multiprocessing
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from whereisip.cache import (LOCK_DIR, JsonFileCache, MemoryCache, SQLiteCache, fcntl,
+                             get_cache, lock_key)
+from whereisip.getgeolocation import get_geo_location_ip, resolve_geo_locations
+from whereisip.utils import get_cache_file, read_cache_file
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+@pytest.fixture(params=["sqlite", "json", "memory"])
+def cache(request, tmp_path):
+    # update the last use of the sqlite entries at each read, so the tests of the least
+    # recently used order do not have to wait
+    if request.param == "sqlite":
+        cache = SQLiteCache(tmp_path / "whereisip.sqlite", access_interval=0)
+    elif request.param == "json":
+        cache = JsonFileCache(tmp_path)
+    else:
+        backend = SQLiteCache(tmp_path / "whereisip.sqlite", access_interval=0)
+        cache = MemoryCache(backend, max_entries=2)
+    yield cache
+    cache.close()
+
+
+def test_get_set(cache):
+    """ test storing and retrieving entries """
+    assert cache.get("8.8.8.8") is None
+    cache.set("8.8.8.8", {"city": "Mountain View"})
+    assert cache.get("8.8.8.8") == {"city": "Mountain View"}
+    assert "8.8.8.8" in cache
+    cache.delete("8.8.8.8")
+    assert cache.get("8.8.8.8") is None
+
+
+def test_get_set_many(cache):
+    """ test storing and retrieving many entries at once """
+    entries = {f"10.0.{i // 256}.{i % 256}": {"index": i} for i in range(1200)}
+    cache.set_many(entries)
+    assert len(cache) == 1200
+    assert cache.get_many(list(entries) + ["1.1.1.1"]) == entries
+
+
+def test_sqlite_threads(tmp_path):
+    """ The sqlite cache can be shared by many threads """
+    cache = SQLiteCache(tmp_path / "whereisip.sqlite")
+
+    def store(index):
+        cache.set(f"key{index}", {"index": index})
+
+    threads = [threading.Thread(target=store, args=(index,)) for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache) == 20
+
+
+def test_migrate_json_files(tmp_path):
+    """ The cache files of the json backend are moved into the database """
+    (tmp_path / "resp_8.8.8.8.json").write_text(json.dumps({"city": "Mountain View"}))
+    (tmp_path / "resp_me.json").write_text(json.dumps({"my_lat": 52.4}))
+    cache = SQLiteCache(tmp_path / "whereisip.sqlite")
+    assert cache.get("8.8.8.8") == {"city": "Mountain View"}
+    assert cache.get("me") == {"my_lat": 52.4}
+    assert not list(tmp_path.glob("resp_*.json"))
+
+
+def test_migrate_removed_files(tmp_path, monkeypatch):
+    """
+    A cache file which is removed by another process during the migration is skipped
+    """
+    (tmp_path / "resp_8.8.8.8.json").write_text(json.dumps({"city": "Mountain View"}))
+    (tmp_path / "resp_1.1.1.1.json").write_text(json.dumps({"city": "Brisbane"}))
+
+    def read_and_remove(cache_file):
+        info = read_cache_file(cache_file)
+        if "1.1.1.1" in cache_file.name:
+            cache_file.unlink()
+        return info
+
+    monkeypatch.setattr("whereisip.cache.read_cache_file", read_and_remove)
+    cache = SQLiteCache(tmp_path / "whereisip.sqlite", migrate=False)
+    # the removed file was read completely, so it is migrated
+    assert cache.migrate_json_files(tmp_path) == 2
+    assert sorted(cache.keys()) == ["1.1.1.1", "8.8.8.8"]
+    cache.close()
+
+
+def test_get_cache(cache_dir):
+    """ The cache objects are shared """
+    assert get_cache() is get_cache("sqlite")
+    assert isinstance(get_cache("json").backend, JsonFileCache)
+    assert isinstance(get_cache("json", memory_entries=0), JsonFileCache)
+    with pytest.raises(ValueError):
+        get_cache("redis")
+
+
+def test_ttl(cache):
+    """ Expired entries are treated as missing and removed by prune """
+    cache.set("8.8.8.8", {"city": "Mountain View"})
+    cache.ttl = -1
+    assert cache.get("8.8.8.8") is None
+    assert cache.get_many(["8.8.8.8"]) == {}
+    assert cache.prune() == 1
+    assert len(cache) == 0
+
+
+def test_lru_eviction(cache):
+    """ The least recently used entries are evicted when the cache is full """
+    if isinstance(cache, MemoryCache):
+        pytest.skip("the size of the backend is not controlled by the memory cache")
+    cache.max_entries = 3
+    cache.set_many({"a": {"n": 1}, "b": {"n": 2}, "c": {"n": 3}})
+    time.sleep(0.01)
+    # use a, such that b is the least recently used entry
+    assert cache.get("a") == {"n": 1}
+    time.sleep(0.01)
+    cache.set_many({"d": {"n": 4}})
+    assert sorted(cache.keys()) == ["a", "c", "d"]
+
+
+def test_scan(cache):
+    """ Scanning the entries does not change the least recently used order """
+    cache.set_many({"a": {"n": 1}, "b": {"n": 2}, "c": {"n": 3}, "x": {"n": 0}})
+    cache.delete("x")
+    time.sleep(0.01)
+    # use b and c, such that a is the least recently used entry
+    cache.get_many(["b", "c"])
+    time.sleep(0.01)
+    assert sorted(cache.scan()) == [("a", {"n": 1}), ("b", {"n": 2}), ("c", {"n": 3})]
+    time.sleep(0.01)
+    backend = getattr(cache, "backend", cache)
+    backend.max_entries = 3
+    backend.set_many({"d": {"n": 4}})
+    assert sorted(cache.keys()) == ["b", "c", "d"]
+
+
+def test_sqlite_access_interval(tmp_path):
+    """ Reading an entry only writes its last use once the interval has passed """
+    cache = SQLiteCache(tmp_path / "whereisip.sqlite", access_interval=3600)
+    cache.set("a", {"n": 1})
+
+    def accessed():
+        query = "SELECT accessed FROM entries WHERE key = 'a'"
+        return cache._connection.execute(query).fetchone()[0]
+
+    stored = accessed()
+    assert cache.get("a") == {"n": 1}
+    assert accessed() == stored
+    with cache._connection:
+        cache._connection.execute("UPDATE entries SET accessed = accessed - 7200")
+    assert cache.get("a") == {"n": 1}
+    assert accessed() > stored - 1
+    assert cache._connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    cache.close()
+
+
+def test_sqlite_schema_upgrade(tmp_path):
+    """ A database without time stamps is upgraded """
+    cache_file = tmp_path / "whereisip.sqlite"
+    connection = sqlite3.connect(str(cache_file))
+    with connection:
+        connection.execute("CREATE TABLE entries "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("INSERT INTO entries "
+                           "VALUES ('8.8.8.8', '{\"city\": \"Mountain View\"}')")
+    connection.close()
+    cache = SQLiteCache(cache_file)
+    assert cache.get("8.8.8.8") == {"city": "Mountain View"}
+
+
+def test_memory_cache(tmp_path):
+    """ Entries found in memory do not access the backend """
+    backend = SQLiteCache(tmp_path / "whereisip.sqlite")
+    cache = MemoryCache(backend, max_entries=2)
+    cache.set("a", {"n": 1})
+    backend.delete("a")
+    assert cache.get("a") == {"n": 1}
+    assert cache.get("b") is None
+    backend.set("b", {"n": 2})
+    assert cache.get("b") == {"n": 2}
+    assert (cache.hits, cache.backend_hits, cache.misses) == (1, 1, 1)
+    # the returned entries are copies
+    cache.get("b")["n"] = 3
+    assert cache.get("b") == {"n": 2}
+    # a is the least recently used entry and is dropped from memory
+    cache.set("c", {"n": 3})
+    assert cache.get("a") is None
+
+
+@pytest.mark.parametrize("backend_name", ["sqlite", "json"])
+def test_memory_cache_ttl(tmp_path, monkeypatch, backend_name):
+    """
+    An entry read from the backend expires in memory when it expires in the backend
+    """
+    if backend_name == "sqlite":
+        backend = SQLiteCache(tmp_path / "whereisip.sqlite", ttl=100)
+    else:
+        backend = JsonFileCache(tmp_path, ttl=100)
+    start = time.time()
+    monkeypatch.setattr(time, "time", lambda: start)
+    backend.set("a", {"n": 1})
+    cache = MemoryCache(backend)
+    monkeypatch.setattr(time, "time", lambda: start + 60)
+    assert cache.get("a") == {"n": 1}
+    # the entry is stored in the backend 101 seconds ago, but read into memory 41
+    # seconds ago
+    monkeypatch.setattr(time, "time", lambda: start + 101)
+    assert cache.get("a") is None
+    assert (cache.hits, cache.backend_hits, cache.misses) == (0, 1, 1)
+
+
+def test_corrupt_entries(tmp_path):
+    """ Entries which can not be read are treated as missing """
+    json_cache = JsonFileCache(tmp_path / "json")
+    json_cache.set("8.8.8.8", {"city": "Mountain View"})
+    cache_file = get_cache_file("8.8.8.8", cache_dir=json_cache.cache_dir)
+    cache_file.write_text('{"city": "Moun')
+    assert json_cache.get("8.8.8.8") is None
+
+    sqlite_cache = SQLiteCache(tmp_path / "whereisip.sqlite", migrate=False)
+    sqlite_cache.set("8.8.8.8", {"city": "Mountain View"})
+    with sqlite_cache._connection:
+        sqlite_cache._connection.execute("UPDATE entries SET value = '[1, 2'")
+    assert sqlite_cache.get("8.8.8.8") is None
+    sqlite_cache.close()
+
+
+def test_atomic_write(tmp_path):
+    """ A failed write leaves the entry as it was and no temporary files """
+    cache = JsonFileCache(tmp_path)
+    cache.set("8.8.8.8", {"city": "Mountain View"})
+    with pytest.raises(TypeError):
+        cache.set("8.8.8.8", {"city": object()})
+    assert cache.get("8.8.8.8") == {"city": "Mountain View"}
+    files = [path.name for path in tmp_path.iterdir() if path.is_file()]
+    assert files == ["resp_8.8.8.8.json"]
+
+
+def test_single_flight(fake_geocoder, cache_dir):
+    """ Threads missing the same address wait for one lookup """
+    ip = fake_geocoder.ip
+
+    def slow_ip(ipaddress, **kwargs):
+        time.sleep(0.05)
+        return ip(ipaddress, **kwargs)
+
+    fake_geocoder.ip = slow_ip
+    threads = [threading.Thread(target=get_geo_location_ip, args=("8.8.8.8",))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fake_geocoder.n_requests == 1
+    assert (cache_dir / LOCK_DIR).is_dir()
+
+
+def test_single_flight_batches(fake_geocoder, cache_dir):
+    """ Concurrent batches missing the same addresses share the lookups """
+    ip = fake_geocoder.ip
+
+    def slow_ip(ipaddress, **kwargs):
+        time.sleep(0.05)
+        return ip(ipaddress, **kwargs)
+
+    fake_geocoder.ip = slow_ip
+    batches = [["8.8.8.8", "1.1.1.1"], ["1.1.1.1", "8.8.8.8"], ["8.8.8.8"]] * 2
+    results = []
+
+    def resolve(batch):
+        results.extend(resolve_geo_locations(batch))
+
+    threads = [threading.Thread(target=resolve, args=(batch,)) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fake_geocoder.n_requests == 2
+    assert len(results) == 10 and all(result.error is None for result in results)
+
+
+def _hold_lock(lock_dir, locked, seconds):
+    with lock_key("8.8.8.8", lock_dir=lock_dir):
+        locked.set()
+        time.sleep(seconds)
+
+
+@pytest.mark.skipif(fcntl is None, reason="no lock files on this platform")
+def test_lock_between_processes(tmp_path):
+    """ A process waits for the lock of a key held by another process """
+    context = multiprocessing.get_context("fork")
+    locked = context.Event()
+    process = context.Process(target=_hold_lock, args=(tmp_path, locked, 0.3))
+    process.start()
+    assert locked.wait(10)
+    start = time.monotonic()
+    with lock_key("8.8.8.8", lock_dir=tmp_path):
+        waited = time.monotonic() - start
+    process.join()
+    assert waited > 0.1
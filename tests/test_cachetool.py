@@ -0,0 +1,69 @@
+import io
+
+import pytest
+
+from whereisip.cache import get_cache, make_negative_entry
+from whereisip.cachetool import (expand_targets, get_cache_stats, prune_cache,
+                                 warm_cache)
+from whereisip.getgeolocation import main
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+def test_expand_targets(tmp_path):
+    """ Addresses, blocks and files are expanded to the addresses """
+    targets_file = tmp_path / "edges.txt"
+    targets_file.write_text("# edges\n1.1.1.1\n192.0.2.0/30\n")
+    assert list(expand_targets(["8.8.8.8", str(targets_file), "2001:db8::1/128"])) == [
+        "8.8.8.8", "1.1.1.1", "192.0.2.1", "192.0.2.2", "2001:db8::1"]
+    with pytest.raises(ValueError):
+        list(expand_targets(["2001:db8::/64"]))
+    with pytest.raises(ValueError):
+        list(expand_targets(["no_such_file.txt"]))
+
+
+def test_warm_cache(fake_geocoder, cache_dir):
+    """ Only the addresses which are not in the cache are looked up """
+    cache = get_cache()
+    progress = io.StringIO()
+    result = warm_cache(["8.8.8.8", "1.1.1.1", "8.8.8.8", "9.9.9.9"], cache=cache,
+                        rate_limit=None, progress=progress)
+    assert result == (3, 0, 2, 1)
+    assert progress.getvalue().endswith("warmed 3/3 addresses (1 failed)\n")
+    assert "8.8.8.8" in cache and "1.1.1.1" in cache
+
+    result = warm_cache(["8.8.8.8", "1.1.1.1", "9.9.9.9", "37.97.253.1"], cache=cache)
+    assert result == (4, 3, 1, 0)
+    assert fake_geocoder.n_requests == 4
+
+
+def test_stats_and_prune(fake_geocoder, cache_dir):
+    """ The stats count the entries and prune removes the expired failures """
+    cache = get_cache()
+    warm_cache(["8.8.8.8", "1.1.1.1"], cache=cache, rate_limit=None)
+    cache.set("9.9.9.9", make_negative_entry("not found", ttl=-1))
+    cache.clear_memory()
+    stats = get_cache_stats(cache, cache_dir)
+    assert (stats["entries"], stats["fresh"], stats["negative"]) == (3, 2, 1)
+    assert stats["size"] > 0
+
+    # the stats do not load the entries into memory
+    assert cache.hits + cache.backend_hits + cache.misses == 0
+
+    assert prune_cache(cache) == 1
+    assert get_cache_stats(cache, cache_dir)["entries"] == 2
+
+
+def test_main_cache(fake_geocoder, cache_dir, capsys):
+    """ The cache subcommands of the command line """
+    main(["cache", "warm", "8.8.8.8", "1.1.1.1", "--rate_limit", "1000"])
+    expected = "2 addresses: 0 in the cache already, 2 added, 0 failed"
+    assert expected in capsys.readouterr().out
+    main(["cache", "stats"])
+    assert "entries     : 2" in capsys.readouterr().out
+    main(["cache", "prune"])
+    assert "Removed 0 cache entries" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main(["cache", "warm"])
@@ -0,0 +1,53 @@
+import pytest
+
+from whereisip.gazetteer import (GAZETTEER, PLACE_KEYS, lookup_place, normalize_place,
+                                 search_places)
+from whereisip.getgeolocation import get_device_cache_key, get_geo_location_device
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+@pytest.mark.parametrize("place", ["Amsterdam,The Netherlands", "Amsterdam, NL",
+                                   "amsterdam,the netherlands",
+                                   " AMSTERDAM ,  Holland"])
+def test_normalize_place(place):
+    """ Different spellings of a place give the same key """
+    assert normalize_place(place) == "amsterdam,nl"
+    assert get_device_cache_key(place) == "amsterdam,nl"
+
+
+def test_gazetteer_sorted():
+    """ The binary search needs the table sorted on unique normalized names """
+    assert list(PLACE_KEYS) == sorted(set(PLACE_KEYS))
+    for key, city, country, _, _ in GAZETTEER:
+        assert normalize_place(f"{city},{country}") == key
+
+
+def test_lookup_place():
+    """ Places are found by city and country, or by a city name which is unique """
+    assert lookup_place("São Paulo, Brazil").city == "Sao Paulo"
+    assert lookup_place("Mountain View, CA, USA").country == "US"
+    assert lookup_place("tokyo").country == "JP"
+    assert lookup_place("Amsterdam, US") is None
+    assert lookup_place("8.8.8.8") is None
+    assert [place.city for place in search_places("san")] == [
+        "San Antonio", "San Diego", "San Francisco", "San Jose", "Santiago"]
+    assert len(search_places("", limit=3)) == 3
+
+
+def test_device_from_gazetteer(fake_geocoder, cache_dir):
+    """
+    A place in the gazetteer is located without a request and other places are cached
+    once
+    """
+    location = get_geo_location_device("Amsterdam, NL")
+    assert location == {"my_location": "Amsterdam, NL", "my_lat": 52.3727598,
+                        "my_lng": 4.8936041}
+    assert fake_geocoder.n_requests == 0
+
+    # the second spelling is read from the cache entry of the first
+    for place in ("Springfield,Illinois", "springfield, illinois"):
+        assert get_geo_location_device(place)["my_lat"] == 39.7817
+    assert fake_geocoder.n_requests == 1
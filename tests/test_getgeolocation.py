@@ -1,7 +1,18 @@
+import csv
+import io
+import json
 import unittest
 
+import pytest
+
 from whereisip.getgeolocation import IpErrorNoLocationFound
-from whereisip.getgeolocation import (get_geo_location_ip)
+from whereisip.cache import get_cache, make_negative_entry
+from whereisip.getgeolocation import (CSV_FIELDS, GeoRecord, LocationReport,
+                                      get_geo_location_ip, get_geo_location_ips,
+                                      make_failure_entry, read_cache_entry,
+                                      resolve_geo_locations, set_prefix_aggregation,
+                                      share_geo_info, write_reports)
+from whereisip.providers import IpErrorPrivateAddress, IpErrorProviderFailed
 
 __author__ = "Eelco van Vliet"
 __copyright__ = "Eelco van Vliet"
@@ -9,7 +20,6 @@ __license__ = "MIT"
 
 
 class TestGetGeoLocation(unittest.TestCase):
-    geo_info = get_geo_location_ip("8.8.8.8", write_cache=False, reset_cache=True)
     expected = {'address': 'Mountain View, California, US',
                 'city': 'Mountain View',
                 'country': 'US',
@@ -35,6 +45,13 @@ class TestGetGeoLocation(unittest.TestCase):
                 'status': 'OK'
                 }
 
+    @classmethod
+    def setUpClass(cls):
+        # looked up when the tests run instead of when they are collected, as it needs
+        # the network
+        cls.geo_info = get_geo_location_ip("8.8.8.8", write_cache=False,
+                                           reset_cache=True)
+
     def test_geo_location_equal(self):
         self.assertDictEqual(self.geo_info, self.expected)
 
@@ -43,3 +60,158 @@ class TestGetGeoLocationException(unittest.TestCase):
     def test_geo_location_exception(self):
         with self.assertRaises(IpErrorNoLocationFound):
             geo_info = get_geo_location_ip("10.2.30.11", write_cache=False, reset_cache=True)
+
+
+def test_get_geo_location_ips(fake_geocoder):
+    """ All addresses are reported in order of the input """
+    reports = get_geo_location_ips(["8.8.8.8", "1.1.1.1", "8.8.8.8"])
+    ip_addresses = [report.ip_address for report in reports]
+    assert ip_addresses == ["8.8.8.8", "1.1.1.1", "8.8.8.8"]
+    # the second request for 8.8.8.8 is read from the cache
+    assert fake_geocoder.n_requests == 2
+
+
+def test_resolve_geo_locations(fake_geocoder):
+    """ Failures are reported per address and the order of the input is kept """
+    ipaddresses = ["1.1.1.1", "10.2.30.11", "8.8.8.8", "1.1.1.1"]
+    results = resolve_geo_locations(ipaddresses, workers=4, write_cache=False)
+    assert [result.ipaddress for result in results] == ipaddresses
+    assert isinstance(results[1].error, IpErrorNoLocationFound)
+    assert results[1].geo_info is None
+    assert results[2].geo_info["city"] == "Mountain View"
+    assert results[0].error is None and results[3].error is None
+    # duplicated addresses are only looked up once and private addresses not at all
+    assert fake_geocoder.n_requests == 2
+
+
+GEO_INFO = {"ip": "8.8.8.8", "lat": 37.4056, "lng": -122.0775, "country": "US",
+            "city": "Mountain View", "status": "OK"}
+
+
+def test_render():
+    """ The reports are returned as strings """
+    report = LocationReport(dict(GEO_INFO))
+    assert report.render("decimal") == "37.41, -122.08"
+    assert report.render("human") == "Mountain View/United States (US)"
+    assert report.render("full").splitlines()[0] == "Location of server 8.8.8.8:"
+    assert json.loads(report.render("json")) == json.loads(report.render("jsonl"))
+    sexagesimal = "37° 24′ 20.2″ N, 122° 4′ 39.0″ W"
+    assert report.to_dict()["sexagesimal"] == sexagesimal
+    header, row = report.render("csv").splitlines()
+    assert header == ",".join(CSV_FIELDS)
+    assert row.startswith("8.8.8.8,37.4056,-122.0775,Mountain View,US,")
+    with pytest.raises(ValueError):
+        report.render("xml")
+
+
+def test_geo_record():
+    """
+    A report of a record gives the same output as a report of the geo information
+    """
+    record = GeoRecord.from_geo_info(GEO_INFO, keep_raw=False)
+    assert record == ("8.8.8.8", 37.4056, -122.0775, "US", "Mountain View", None)
+    with pytest.raises(AttributeError):
+        record.city = "Amsterdam"
+    with pytest.raises(AttributeError):
+        record.__dict__
+
+    report = LocationReport(record, my_lat=52.3740, my_lng=4.8897, distance=8816.0)
+    from_dict = LocationReport(dict(GEO_INFO, my_location=None, my_lat=52.3740,
+                                    my_lng=4.8897, distance=8816.0))
+    for output_format in ("short", "full", "json", "csv"):
+        assert report.render(output_format) == from_dict.render(output_format)
+    # without the raw payload, the raw report only has the fields of the record
+    assert "status" not in report.geo_info and report.geo_info["distance"] == 8816.0
+    assert from_dict.geo_info["status"] == "OK"
+
+
+def test_write_reports():
+    """ Many reports are written to one stream """
+    reports = [LocationReport(dict(GEO_INFO)),
+               LocationReport(dict(GEO_INFO, ip="8.8.4.4"))]
+    stream = io.StringIO()
+    assert write_reports(reports, "json", stream) == 2
+    records = json.loads(stream.getvalue())
+    assert [record["ip"] for record in records] == ["8.8.8.8", "8.8.4.4"]
+
+    stream = io.StringIO()
+    write_reports(reports, "jsonl", stream)
+    ips = [json.loads(line)["ip"] for line in stream.getvalue().splitlines()]
+    assert ips == ["8.8.8.8", "8.8.4.4"]
+    stream = io.StringIO()
+    write_reports(reports, "csv", stream)
+    rows = list(csv.DictReader(io.StringIO(stream.getvalue())))
+    assert [row["ip"] for row in rows] == ["8.8.8.8", "8.8.4.4"]
+
+    stream = io.StringIO()
+    write_reports(iter([]), "json", stream)
+    assert json.loads(stream.getvalue()) == []
+
+
+def test_private_addresses(fake_geocoder):
+    """
+    Private and reserved addresses are rejected without a request and are not cached
+    """
+    for ipaddress in ("192.168.1.1", "127.0.0.1", "169.254.0.1", "fe80::1",
+                      "240.0.0.1"):
+        with pytest.raises(IpErrorPrivateAddress):
+            get_geo_location_ip(ipaddress)
+        assert ipaddress not in get_cache()
+    assert fake_geocoder.n_requests == 0
+
+
+def test_negative_cache(fake_geocoder):
+    """ A failed lookup is cached, so the provider is only asked once """
+    for _ in range(2):
+        with pytest.raises(IpErrorNoLocationFound):
+            get_geo_location_ip("9.9.9.9")
+    results = resolve_geo_locations(["9.9.9.9", "8.8.8.8"])
+    assert isinstance(results[0].error, IpErrorNoLocationFound)
+    assert fake_geocoder.n_requests == 2
+
+    # the failure is looked up again when it expires or the cache is reset
+    assert read_cache_entry(make_negative_entry("not found", ttl=10, now=0)) is None
+    with pytest.raises(IpErrorNoLocationFound):
+        get_geo_location_ip("9.9.9.9", reset_cache=True)
+    assert fake_geocoder.n_requests == 3
+
+
+def test_failure_entry():
+    """ Only the failures of unknown addresses are cached """
+    assert make_failure_entry(IpErrorNoLocationFound("unknown")) is not None
+    assert make_failure_entry(IpErrorProviderFailed("timeout")) is None
+    assert make_failure_entry(IpErrorPrivateAddress("private")) is None
+    assert make_failure_entry(ValueError("bug")) is None
+
+
+def test_prefix_aggregation(fake_geocoder):
+    """
+    The addresses of one network share the cache entry of the first one looked up
+    """
+    set_prefix_aggregation(True)
+    assert get_geo_location_ip("8.8.8.8")["ip"] == "8.8.8.8"
+    geo_info = get_geo_location_ip("8.8.8.200")
+    assert (geo_info["ip"], geo_info["city"]) == ("8.8.8.200", "Mountain View")
+    assert geo_info["network"] == "8.8.8.0/24"
+    # the fields of the address looked up are not shared
+    neighbour = {"ip": "8.8.8.8", "city": "Mountain View", "hostname": "dns.google",
+                 "raw": {"ip": "8.8.8.8"}}
+    assert share_geo_info(neighbour, "8.8.8.200") == {"ip": "8.8.8.200",
+                                                      "city": "Mountain View",
+                                                      "network": "8.8.8.0/24"}
+    assert share_geo_info(neighbour, "::ffff:8.8.8.8")["hostname"] == "dns.google"
+    assert "net_8.8.8.0_24" in get_cache()
+    assert fake_geocoder.n_requests == 1
+
+    results = resolve_geo_locations(["1.1.1.1", "1.1.1.2", "8.8.8.9", "1.1.2.1"])
+    ipaddresses = [result.geo_info["ip"] for result in results[:3]]
+    assert ipaddresses == ["1.1.1.1", "1.1.1.2", "8.8.8.9"]
+    assert results[3].error is not None
+    assert fake_geocoder.n_requests == 3
+
+    set_prefix_aggregation(True, ipv4_prefix=16)
+    get_geo_location_ip("1.1.1.1")
+    assert get_geo_location_ip("1.1.2.2")["city"] == "Brisbane"
+    assert fake_geocoder.n_requests == 4
+    with pytest.raises(ValueError):
+        set_prefix_aggregation(True, ipv6_prefix=129)
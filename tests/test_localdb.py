@@ -0,0 +1,92 @@
+import pytest
+
+from whereisip.getgeolocation import (IpErrorNoLocationFound, LocationReport,
+                                      get_geo_location_ip, resolve_geo_locations)
+from whereisip.localdb import (IpRangeIndex, MmapIpRangeIndex, load_database,
+                               write_binary_index)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+CSV_DATABASE = """network,country,city,lat,lng
+8.8.8.0/24,US,Mountain View,37.4056,-122.0775
+1.1.1.0/24,AU,Brisbane,-27.4816,153.0175
+2001:4860::/32,US,Mountain View,37.4056,-122.0775
+"""
+
+
+@pytest.fixture
+def database(tmp_path):
+    database_file = tmp_path / "ranges.csv"
+    database_file.write_text(CSV_DATABASE)
+    return load_database(database_file)
+
+
+def test_lookup(database):
+    """ test finding addresses in and outside the ranges """
+    assert len(database) == 3
+    geo_info = database.lookup("8.8.8.8")
+    assert geo_info == {"ip": "8.8.8.8", "lat": 37.4056, "lng": -122.0775,
+                        "country": "US", "city": "Mountain View", "status": "OK"}
+    assert database.lookup("2001:4860:4860::8888")["city"] == "Mountain View"
+    assert database.lookup("1.1.1.255")["country"] == "AU"
+    assert database.lookup("1.1.2.0") is None
+    assert database.lookup("0.0.0.1") is None
+    assert database.lookup("not an ip") is None
+    # the ranges with the same location share the location
+    assert len(database.locations) == 2
+
+
+def test_start_end_columns(tmp_path):
+    """ The ranges can be given by start and end address as well """
+    database_file = tmp_path / "ranges.csv"
+    database_file.write_text("start_ip,end_ip,country_code,city_name,"
+                             "latitude,longitude\n"
+                             "10.0.0.0,10.0.0.9,NL,Amsterdam,52.37,4.89\n")
+    database = load_database(database_file)
+    assert database.find("10.0.0.9") == ("NL", "Amsterdam", 52.37, 4.89)
+    assert database.find("10.0.0.10") is None
+
+
+def test_report(database):
+    """ The result of the database can be reported """
+    report = LocationReport(get_geo_location_ip("1.1.1.1", database=database))
+    assert report.location_human == "Brisbane/Australia (AU)"
+
+
+def test_get_geo_location_ip(database, fake_geocoder):
+    """ The database is used instead of geocoder """
+    with pytest.raises(IpErrorNoLocationFound):
+        get_geo_location_ip("37.97.253.1", database=database)
+    results = resolve_geo_locations(["8.8.8.8", "37.97.253.1"], database=database)
+    assert results[0].geo_info["city"] == "Mountain View"
+    assert isinstance(results[1].error, IpErrorNoLocationFound)
+    assert fake_geocoder.n_requests == 0
+
+
+def test_empty_index():
+    """ An empty index finds nothing """
+    assert IpRangeIndex().lookup("8.8.8.8") is None
+
+
+def test_binary_index(database, tmp_path):
+    """ The binary index gives the same results as the index it was written from """
+    index_file = tmp_path / "ranges.wipidx"
+    write_binary_index(database, index_file)
+    binary_index = load_database(index_file)
+    assert isinstance(binary_index, MmapIpRangeIndex)
+    assert len(binary_index) == len(database)
+    for address in ["8.8.8.8", "8.8.7.255", "1.1.1.0", "1.1.1.255", "1.1.2.0",
+                    "0.0.0.0", "255.255.255.255", "2001:4860:4860::8888", "2001:4861::",
+                    "::1"]:
+        assert binary_index.lookup(address) == database.lookup(address)
+    binary_index.close()
+
+
+def test_binary_index_invalid(tmp_path):
+    """ Other files are not accepted as binary index """
+    index_file = tmp_path / "ranges.wipidx"
+    index_file.write_bytes(b"not an index" * 10)
+    with pytest.raises(ValueError):
+        MmapIpRangeIndex(index_file)
@@ -0,0 +1,114 @@
+import io
+import json
+import queue
+import threading
+
+import pytest
+
+from whereisip.getgeolocation import main
+from whereisip.logenrich import (enrich_log_lines, extract_ip_addresses,
+                                 read_lines_in_batches)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+ACCESS_LOG = [
+    '8.8.8.8 - - [10/Oct/2023:13:55:36 +0000] "GET / HTTP/1.1" 200 2326\n',
+    '1.1.1.1 - - [10/Oct/2023:13:55:37 +0000] "GET /about HTTP/1.1" 200 512\n',
+    '8.8.8.8 - - [10/Oct/2023:13:55:38 +0000] "GET /favicon.ico HTTP/1.1" 404 0\n',
+    'no address on this line, only version 1.2.3\n',
+]
+
+
+def test_extract_ip_addresses():
+    """ test finding the ip addresses in a line """
+    line = ("from 8.8.8.8 to 2001:db8::1 via 8.8.8.8, not 999.1.1.1 or 1.2.3.4.5 "
+            "at 12:30:00")
+    assert extract_ip_addresses(line) == ["8.8.8.8", "2001:db8::1"]
+    assert extract_ip_addresses("client=1.1.1.1 server=8.8.8.8",
+                                ip_regex=r"client=(\S+)") == ["1.1.1.1"]
+    # an IPv4 address mapped to IPv6
+    line = ("client ::ffff:203.0.113.5 - GET / from 64:ff9b::8.8.8.8. "
+            "End at 2001:db8::1.")
+    assert extract_ip_addresses(line) == ["::ffff:203.0.113.5", "64:ff9b::8.8.8.8",
+                                          "2001:db8::1"]
+
+
+def test_read_lines_in_batches():
+    """
+    test that the lines of a growing stream are not held back until a batch is full
+    """
+    expected = [["a", "b"], ["c", "d"], ["e"]]
+    assert list(read_lines_in_batches(iter("abcde"), batch_size=2)) == expected
+    batches = read_lines_in_batches(iter("abcde"), batch_size=2, flush_interval=0.1)
+    assert list(batches) == expected
+
+    lines_queue = queue.Queue()
+    stream = iter(lines_queue.get, None)
+    batches = read_lines_in_batches(stream, batch_size=1000, flush_interval=0.05)
+    lines_queue.put("a\n")
+    lines_queue.put("b\n")
+    # the stream stays open, but the lines read so far are yielded
+    assert next(batches) == ["a\n", "b\n"]
+    threading.Timer(0.1, lines_queue.put, args=("c\n",)).start()
+    assert next(batches) == ["c\n"]
+    lines_queue.put(None)
+    assert list(batches) == []
+
+
+def test_enrich_log_lines(fake_geocoder):
+    """
+    test that each line gets the location of its addresses and each address is fetched
+    once
+    """
+    lines = list(enrich_log_lines(ACCESS_LOG, batch_size=2, annotation="human"))
+    assert len(lines) == len(ACCESS_LOG)
+    assert lines[0].endswith("\t8.8.8.8=Mountain View/United States (US)")
+    assert lines[1].endswith("\t1.1.1.1=Brisbane/Australia (AU)")
+    assert lines[2].startswith(ACCESS_LOG[2].rstrip())
+    assert lines[3] == ACCESS_LOG[3].rstrip()
+    assert fake_geocoder.n_requests == 2
+
+
+def test_enrich_log_lines_mapped_addresses(fake_geocoder):
+    """ test that an IPv4-mapped address shares the lookup of its IPv4 address """
+    lines = ["1.1.1.1 - GET /\n", "::ffff:1.1.1.1 - GET /\n"]
+    enriched = list(enrich_log_lines(lines, batch_size=1, annotation="human"))
+    assert enriched[1].endswith("\t::ffff:1.1.1.1=Brisbane/Australia (AU)")
+    assert fake_geocoder.n_requests == 1
+
+
+def test_enrich_log_lines_dedup_window(fake_geocoder):
+    """
+    test that the addresses are looked up again from cache once they leave the window
+    """
+    lines = ["8.8.8.8\n", "1.1.1.1\n", "8.8.8.8\n"]
+    enriched = list(enrich_log_lines(lines, batch_size=1, dedup_window=1,
+                                     write_cache=False, reset_cache=True,
+                                     annotation="jsonl"))
+    assert json.loads(enriched[2].split("=", 1)[1])["city"] == "Mountain View"
+    assert fake_geocoder.n_requests == 3
+
+
+def test_enrich_log_lines_unknown(fake_geocoder):
+    """ test that addresses without a location are marked as unknown """
+    assert list(enrich_log_lines(["9.9.9.9\n"])) == ["9.9.9.9\t9.9.9.9=unknown"]
+    with pytest.raises(ValueError):
+        list(enrich_log_lines(["9.9.9.9\n"], annotation="full"))
+
+
+def test_main_log_file(fake_geocoder, tmp_path, capsys, monkeypatch):
+    """ test enriching a log file and stdin from the command line """
+    log_file = tmp_path / "access.log"
+    log_file.write_text("".join(ACCESS_LOG))
+    main(["--log_file", str(log_file), "--annotation", "decimal"])
+    from_file = capsys.readouterr().out
+
+    monkeypatch.setattr("sys.stdin", io.StringIO("".join(ACCESS_LOG)))
+    main(["--log_file", "-", "--annotation", "decimal"])
+    from_stdin = capsys.readouterr().out
+
+    assert from_file == from_stdin
+    assert len(from_file.splitlines()) == len(ACCESS_LOG)
+    assert "\t8.8.8.8=" in from_file
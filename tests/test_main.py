@@ -1,3 +1,7 @@
+import csv
+import io
+import logging
+
 import pytest
 
 from whereisip.getgeolocation import (main)
@@ -113,3 +117,60 @@ def test_main_raw(capsys):
                 " 'status': 'OK'}\n")
 
     assert expected == captured.out
+
+
+def test_main_ip_file(capsys, tmp_path, fake_geocoder):
+    """CLI Tests"""
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("# servers\n8.8.8.8\n\n1.1.1.1\n")
+    main(["--ip_file", str(ip_file),
+          "--format", "human"])
+    captured = capsys.readouterr()
+    expected = "Mountain View/United States (US)\n" \
+               "Brisbane/Australia (AU)\n"
+    assert expected == captured.out
+
+
+def test_main_ip_file_distance(capsys, tmp_path, fake_geocoder):
+    """CLI Tests"""
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("8.8.8.8\n")
+    main(["--ip_file", str(ip_file),
+          "--my_location", "Amsterdam,The Netherlands",
+          "--format", "full"])
+    captured = capsys.readouterr()
+    assert "Distance from device @ Amsterdam,The Netherlands: 8816 km\n" in captured.out
+
+
+def test_main_ip_file_csv_logging(capsys, tmp_path, fake_geocoder, monkeypatch):
+    """ The log messages do not end up in the machine readable output """
+    # let main configure the logging as it does outside of pytest
+    monkeypatch.setattr(logging.getLogger(), "handlers", [])
+    monkeypatch.setattr(logging.getLogger(), "level", logging.getLogger().level)
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("8.8.8.8\n9.9.9.9\n")
+    main(["--ip_file", str(ip_file), "--format", "csv", "-v"])
+    captured = capsys.readouterr()
+    rows = list(csv.DictReader(io.StringIO(captured.out)))
+    assert [row["ip"] for row in rows] == ["8.8.8.8"]
+    assert "Failed to get a location for 9.9.9.9" in captured.err
+
+
+@pytest.mark.parametrize("options, n_requests", [
+    ([], 1),
+    (["--ip_address", "8.8.8.8", "--format", "decimal"], 1),
+    (["--ip_address", "8.8.8.8", "--format", "raw"], 1),
+    (["--ip_address", "8.8.8.8"], 2),
+    (["--my_location", "Amsterdam,The Netherlands"], 1),
+    (["--my_location", "Amsterdam,The Netherlands", "--skip_gazetteer"], 2),
+])
+def test_main_lookup_plan(capsys, fake_geocoder, options, n_requests):
+    """
+    The device is only looked up when the distance is shown and not the same as the
+    server or in the gazetteer
+    """
+    main(["--skip_cache"] + options)
+    assert fake_geocoder.n_requests == n_requests
+    if not options:
+        # the server is the device itself, so there is no distance to report
+        assert "Distance" not in capsys.readouterr().out
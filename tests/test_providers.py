@@ -0,0 +1,190 @@
+import ipaddress
+import time
+
+import pytest
+
+from whereisip.getgeolocation import (get_geo_location_ip, get_providers, main,
+                                      make_providers, set_providers)
+from whereisip.localdb import IpRangeIndex
+from whereisip.providers import (DatabaseProvider, GeocoderProvider,
+                                 IpErrorNoLocationFound, IpErrorPrivateAddress,
+                                 IpErrorProviderFailed, Provider, ProviderAuthError,
+                                 ProviderChain, ProviderError, TokenBucket)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+class StubProvider(Provider):
+    """
+    Provider which fails temporarily a number of times and knows a fixed set of
+    addresses
+    """
+
+    def __init__(self, name, locations, n_failures=0, **kwargs):
+        super().__init__(name, **kwargs)
+        self.locations = locations
+        self.n_failures = n_failures
+        self.n_requests = 0
+
+    def fetch(self, ipaddress):
+        self.n_requests += 1
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            raise ProviderError("rate limit exceeded")
+        if ipaddress not in self.locations:
+            raise IpErrorNoLocationFound(f"{ipaddress} unknown to {self.name}")
+        return dict(self.locations[ipaddress], ip=ipaddress, status="OK")
+
+
+class StubGeocode:
+    """ Mimics a failed geocoder result """
+
+    ok = False
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.fixture
+def default_providers():
+    """ Restore the default providers after the test """
+    yield
+    set_providers(None)
+
+
+def test_token_bucket():
+    """ test that the calls beyond the capacity wait for new tokens """
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    waited = sum(bucket.acquire() for _ in range(7))
+    elapsed = time.monotonic() - start
+    # the first two calls are free, the next five wait about 1 / 50 s each
+    assert elapsed >= 0.07
+    assert waited >= 0.07
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_retry_with_backoff():
+    """ test that temporary failures are retried until the retries run out """
+    provider = StubProvider("stub", {"8.8.8.8": {"city": "Mountain View"}},
+                            n_failures=2, retries=2, backoff=0.001)
+    assert provider.lookup("8.8.8.8")["city"] == "Mountain View"
+    assert provider.n_requests == 3
+
+    provider = StubProvider("stub", {"8.8.8.8": {}}, n_failures=3, retries=2,
+                            backoff=0.001)
+    with pytest.raises(ProviderError):
+        provider.lookup("8.8.8.8")
+    assert provider.n_requests == 3
+
+    # an unknown address is not retried
+    provider = StubProvider("stub", {}, retries=2, backoff=0.001)
+    with pytest.raises(IpErrorNoLocationFound):
+        provider.lookup("8.8.8.8")
+    assert provider.n_requests == 1
+
+
+def test_fallback_chain():
+    """ test that the providers are tried in order until one knows the address """
+    network = ipaddress.ip_network("8.8.8.0/24")
+    location = ("US", "Mountain View", 37.4, -122.1)
+    database = DatabaseProvider(IpRangeIndex([(network[0], network[-1], location)]))
+    failing = StubProvider("failing", {"1.1.1.1": {"city": "Sydney"}}, n_failures=10,
+                           retries=1, backoff=0.001)
+    fallback = StubProvider("fallback", {"1.1.1.1": {"city": "Brisbane"}})
+    chain = ProviderChain([database, failing, fallback])
+
+    assert chain.lookup("8.8.8.8")["city"] == "Mountain View"
+    assert failing.n_requests == 0
+    assert chain.lookup("1.1.1.1")["city"] == "Brisbane"
+    assert failing.n_requests == 2
+    with pytest.raises(IpErrorNoLocationFound, match="database.*failing.*fallback"):
+        chain.lookup("9.9.9.9")
+
+
+def test_geocoder_provider_errors():
+    """ test that only the failures which may pass are retried """
+    for status_code in (429, 503, "Unknown"):
+        provider = GeocoderProvider("ipinfo",
+                                    request=lambda ip: StubGeocode(status_code))
+        with pytest.raises(ProviderError):
+            provider.fetch("8.8.8.8")
+    provider = GeocoderProvider("ipinfo", request=lambda ip: StubGeocode(404))
+    with pytest.raises(IpErrorNoLocationFound):
+        provider.fetch("8.8.8.8")
+
+
+def test_refused_requests():
+    """ test that a refused request is not retried and the next provider is tried """
+    n_requests = []
+
+    def refuse(ipaddress):
+        n_requests.append(ipaddress)
+        return StubGeocode(403)
+
+    provider = GeocoderProvider("ipinfo", request=refuse, retries=2, backoff=0.001)
+    with pytest.raises(ProviderAuthError):
+        provider.lookup("8.8.8.8")
+    assert len(n_requests) == 1
+
+    fallback = StubProvider("fallback", {"1.1.1.1": {"city": "Brisbane"}})
+    chain = ProviderChain([provider, fallback])
+    assert chain.lookup("1.1.1.1")["city"] == "Brisbane"
+    # a refusal is not a missing location, so it is not cached as a failure
+    with pytest.raises(IpErrorProviderFailed):
+        chain.lookup("8.8.8.8")
+
+
+def test_negative_retries(capsys):
+    """ test that a negative number of retries is rejected """
+    with pytest.raises(ValueError):
+        StubProvider("stub", {}, retries=-1)
+    with pytest.raises(SystemExit):
+        main(["--retries", "-1"])
+    assert "--retries can not be negative" in capsys.readouterr().err
+
+
+def test_private_addresses_rate_limit():
+    """ test that private addresses do not use the tokens of the rate limiter """
+    provider = GeocoderProvider("ipinfo", request=lambda ip: StubGeocode(404),
+                                rate_limit=2, burst=1)
+    start = time.monotonic()
+    for address in ("10.0.0.1", "192.168.1.1", "127.0.0.1", "fe80::1"):
+        with pytest.raises(IpErrorPrivateAddress):
+            provider.lookup(address)
+    assert time.monotonic() - start < 0.25
+    assert provider.rate_limiter.tokens == 1
+
+
+def test_lookup_with_providers(fake_geocoder, default_providers):
+    """ test that the lookups use the providers which are set """
+    stub = StubProvider("stub", {"9.9.9.9": {"city": "Zurich", "country": "CH",
+                                             "lat": 47.4, "lng": 8.5}})
+    set_providers(ProviderChain([stub, get_providers().providers[0]]))
+    assert get_geo_location_ip("9.9.9.9")["city"] == "Zurich"
+    assert get_geo_location_ip("8.8.8.8")["city"] == "Mountain View"
+    assert fake_geocoder.n_requests == 1
+
+    with pytest.raises(ValueError):
+        make_providers(["database"])
+    with pytest.raises(ValueError):
+        make_providers(["nonsense"])
+
+
+def test_main_providers(fake_geocoder, default_providers, tmp_path, capsys):
+    """ test the database and ipinfo fallback chain on the command line """
+    database = tmp_path / "ranges.csv"
+    database.write_text("network,country,city,lat,lng\n9.9.9.0/24,CH,Zurich,47.4,8.5\n")
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("9.9.9.9\n8.8.8.8\n")
+    main(["--ip_file", str(ip_file), "--database", str(database), "--providers",
+          "database,ipinfo", "--format", "human"])
+    assert capsys.readouterr().out.splitlines() == ["Zurich/Switzerland (CH)",
+                                                    "Mountain View/United States (US)"]
+    with pytest.raises(SystemExit):
+        main(["--providers", "database"])
+    with pytest.raises(SystemExit):
+        main(["--providers", "ipinfo,nonsense"])
@@ -0,0 +1,136 @@
+import threading
+
+import pytest
+
+from whereisip.getgeolocation import IpErrorNoLocationFound, main
+from whereisip.server import (LookupService, ServerError, WhereisipClient, make_server,
+                              parse_address)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+MY_DEVICE = {"my_location": "Amsterdam,The Netherlands", "my_lat": 52.3727598,
+             "my_lng": 4.8936041}
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def server_address(request, fake_geocoder, tmp_path):
+    """ Run the daemon in a thread and return its address """
+    if request.param == "unix":
+        address = f"unix:{tmp_path / 'whereisip.sock'}"
+    else:
+        address = "127.0.0.1:0"
+    service = LookupService(my_device_latlon=MY_DEVICE,
+                            my_location="Amsterdam,The Netherlands")
+    server = make_server(address, service)
+    if request.param == "tcp":
+        address = f"127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield address
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_address():
+    """ test the notations of the daemon address """
+    assert parse_address("unix:/run/whereisip.sock") == ("unix", "/run/whereisip.sock")
+    assert parse_address("localhost:8765") == ("tcp", ("localhost", 8765))
+    assert parse_address("http://127.0.0.1:80") == ("tcp", ("127.0.0.1", 80))
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+
+
+def test_lookup(server_address, fake_geocoder):
+    """ test single and batch lookups, which are cached by the daemon """
+    client = WhereisipClient(server_address)
+    assert client.health() == {"status": "ok"}
+
+    location = client.lookup("8.8.8.8")
+    assert location["city"] == "Mountain View"
+    assert location["distance"] == pytest.approx(8816, abs=1)
+    with pytest.raises(IpErrorNoLocationFound):
+        client.lookup("9.9.9.9")
+
+    results = client.lookup_many(["8.8.8.8", "1.1.1.1", "9.9.9.9"])
+    assert [result["ip"] for result in results] == ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
+    assert results[1]["city"] == "Brisbane"
+    assert "error" in results[2]
+    # 8.8.8.8 is only fetched once and the failed lookup of 9.9.9.9 is cached
+    assert fake_geocoder.n_requests == 3
+
+
+def test_report(server_address):
+    """ test that the reports are formatted as on the command line """
+    client = WhereisipClient(server_address)
+    assert client.report("8.8.8.8", output_format="human") == \
+        "Mountain View/United States (US)\n"
+    assert client.report(ipaddresses=["8.8.8.8", "9.9.9.9", "1.1.1.1"],
+                         output_format="csv").splitlines()[0].startswith("ip,lat,lng")
+    with pytest.raises(IpErrorNoLocationFound):
+        client.report("9.9.9.9")
+    with pytest.raises(ServerError):
+        client.report("8.8.8.8", output_format="nonsense")
+
+
+@pytest.mark.parametrize("request_body", [{"ips": "8.8.8.8"}, {"ips": None},
+                                          {"ips": [1, 2]}, {"ips": ["8.8.8.8", None]},
+                                          {"ips": ["8", "."]}])
+def test_invalid_addresses(server_address, fake_geocoder, request_body):
+    """ test that a request with invalid addresses is refused without lookups """
+    client = WhereisipClient(server_address)
+    for path in ("/lookup", "/report"):
+        with pytest.raises(ServerError, match="answered 400"):
+            client._request("POST", path, request_body)
+    with pytest.raises(ServerError, match="answered 400"):
+        client._request("POST", "/report", {"ip": "8"})
+    with pytest.raises(ServerError, match="answered 400"):
+        client.lookup("8")
+    assert fake_geocoder.n_requests == 0
+
+
+def test_unix_socket_path(fake_geocoder, tmp_path):
+    """ test that only the socket of a daemon which is gone is replaced """
+    service = LookupService(my_device_latlon=MY_DEVICE)
+    precious = tmp_path / "precious.txt"
+    precious.write_text("keep me")
+    with pytest.raises(ServerError, match="not a socket"):
+        make_server(f"unix:{precious}", service)
+    assert precious.read_text() == "keep me"
+
+    socket_path = str(tmp_path / "whereisip.sock")
+    server = make_server(f"unix:{socket_path}", service)
+    with pytest.raises(ServerError, match="Another daemon"):
+        make_server(f"unix:{socket_path}", service)
+    # a socket without a daemon listening is left behind by a daemon which was killed
+    server.socket.close()
+    server = make_server(f"unix:{socket_path}", service)
+    server.server_close()
+
+
+def test_main_client(server_address, tmp_path, capsys):
+    """ test the thin client mode of the command line utility """
+    main(["--server", server_address, "--ip_address", "1.1.1.1", "--format", "decimal"])
+    assert capsys.readouterr().out == "-27.48, 153.02\n"
+
+    ip_file = tmp_path / "ips.txt"
+    ip_file.write_text("8.8.8.8\n1.1.1.1\n")
+    main(["--server", server_address, "--ip_file", str(ip_file), "--format", "human"])
+    assert capsys.readouterr().out.splitlines() == ["Mountain View/United States (US)",
+                                                    "Brisbane/Australia (AU)"]
+
+
+def test_main_client_unsupported_options(tmp_path, capsys):
+    """ test that the options which the daemon does not support are rejected """
+    for option in (["--log_file", "-"], ["--my_location", "Amsterdam,The Netherlands"]):
+        with pytest.raises(SystemExit):
+            main(["--server", f"unix:{tmp_path / 'missing.sock'}"] + option)
+        message = f"{option[0]} option can not be used with --server"
+        assert message in capsys.readouterr().err
+
+
+def test_main_client_no_server(tmp_path):
+    """ test the error when the daemon is not running """
+    with pytest.raises(SystemExit, match="Failed to connect"):
+        main(["--server", f"unix:{tmp_path / 'missing.sock'}"])
@@ -0,0 +1,107 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import geocoder
+import pytest
+
+from whereisip import session
+from whereisip.getgeolocation import (fetch_geo_info_ip, fetch_geo_location_device,
+                                      resolve_geo_locations)
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+class StubIpinfoHandler(BaseHTTPRequestHandler):
+    """
+    Answers the ipinfo requests, which arrive as proxy requests with the full url
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.n_connections += 1
+
+    def do_GET(self):
+        ipaddress = self.path.split("ipinfo.io/")[-1].split("/")[0]
+        body = json.dumps({"ip": ipaddress, "city": "Mountain View",
+                           "region": "California", "country": "US",
+                           "loc": "37.4056,-122.0775"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.n_requests += 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    """ Run a local ipinfo stub and let the requests of geocoder go to it """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubIpinfoHandler)
+    server.n_connections = 0
+    server.n_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    for name in ("http_proxy", "HTTP_PROXY"):
+        monkeypatch.setenv(name, f"http://127.0.0.1:{server.server_address[1]}")
+    for name in ("no_proxy", "NO_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr("whereisip.getgeolocation.geocoder", geocoder)
+    session.close_session()
+    yield server
+    session.close_session()
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_is_shared():
+    """ test that the same session is returned until it is closed or reconfigured """
+    first = session.get_session()
+    assert session.get_session() is first
+    session.configure_session(connect_timeout=1.0, read_timeout=2.0)
+    assert session.get_timeout() == (1.0, 2.0)
+    assert session.get_session() is not first
+    session.configure_session(connect_timeout=session.DEFAULT_CONNECT_TIMEOUT,
+                              read_timeout=session.DEFAULT_READ_TIMEOUT)
+
+
+def test_connection_reuse(stub_server):
+    """ test that consecutive lookups use one connection """
+    for ipaddress in ("8.8.8.8", "8.8.4.4", "1.1.1.1"):
+        geo_info = fetch_geo_info_ip(ipaddress)
+        assert geo_info["ip"] == ipaddress
+        assert geo_info["city"] == "Mountain View"
+    assert stub_server.n_requests == 3
+    assert stub_server.n_connections == 1
+
+
+def test_connection_pool(stub_server):
+    """
+    test that the concurrent lookups share a pool of at most pool_size connections
+    """
+    session.configure_session(pool_size=2)
+    try:
+        addresses = [f"45.0.0.{i}" for i in range(1, 41)]
+        for _ in range(2):
+            results = resolve_geo_locations(addresses, workers=4, reset_cache=True,
+                                            write_cache=False)
+            assert all(result.error is None for result in results)
+    finally:
+        session.configure_session(pool_size=session.DEFAULT_POOL_SIZE)
+    assert stub_server.n_requests == 80
+    # connections beyond the pool size are closed after use instead of being kept open
+    assert stub_server.n_connections < 80
+
+
+def test_device_location_session(fake_geocoder):
+    """ The place of the device is requested over the shared session as well """
+    location = fetch_geo_location_device("Amsterdam,The Netherlands")
+    assert (location["my_lat"], location["my_lng"]) == (52.3727598, 4.8936041)
+    assert fake_geocoder.sessions == [session.get_session()]
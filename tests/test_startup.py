@@ -0,0 +1,55 @@
+"""
+Startup benchmark of the command line utility
+
+The heavy dependencies must not be imported when the modules of whereisip are loaded, as
+importing them takes much longer than a cached lookup.
+"""
+import subprocess
+import sys
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+HEAVY_MODULES = {"geocoder", "requests", "country_converter", "pandas", "latloncalc",
+                 "pyproj", "numpy", "maxminddb"}
+
+
+def import_times(statement):
+    """
+    Run a statement in a fresh interpreter with -X importtime
+
+    Returns: dict
+        Cumulative import time in microseconds per imported module
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    times = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_does_not_load_heavy_modules():
+    """ Importing the command line utility only loads light modules """
+    times = import_times("import whereisip.getgeolocation, whereisip.aiogeolocation")
+    heavy = HEAVY_MODULES.intersection(name.split(".")[0] for name in times)
+    total = times["whereisip.getgeolocation"] / 1000
+    assert not heavy, f"Heavy modules imported at startup ({total:.0f} ms): {heavy}"
+
+
+def test_version_does_not_load_heavy_modules():
+    """ Showing the version only loads light modules """
+    statement = ("import sys\n"
+                 "from whereisip.getgeolocation import main\n"
+                 "try:\n"
+                 "    main(['--version'])\n"
+                 "except SystemExit:\n"
+                 "    pass\n"
+                 "assert not {modules}.intersection(sys.modules), "
+                 "{modules}.intersection(sys.modules)\n").format(modules=HEAVY_MODULES)
+    import_times(statement)
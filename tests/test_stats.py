@@ -0,0 +1,70 @@
+import math
+
+import pytest
+
+from whereisip.getgeolocation import LocationReport, get_geo_location_ip, main
+from whereisip.stats import Stats, get_stats
+
+__author__ = "Eelco van Vliet"
+__copyright__ = "Eelco van Vliet"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def stats():
+    stats = get_stats()
+    stats.reset()
+    stats.enable()
+    yield stats
+    stats.disable()
+    stats.reset()
+
+
+def test_disabled_stats():
+    """ test that nothing is measured when the stats are disabled """
+    stats = Stats()
+    with stats.span("fetch"):
+        pass
+    stats.count("cache_hit")
+    assert stats.summary()["stages"] == {}
+    assert math.isnan(stats.cache_hit_ratio)
+
+
+def test_summary():
+    """ test the count, total and p95 per stage """
+    stats = Stats(enabled=True)
+    for milliseconds in range(1, 21):
+        stats.record("fetch", milliseconds / 1000)
+    stats.count("cache_hit", 3)
+    stats.count("cache_miss")
+    summary = stats.summary()
+    assert summary["stages"]["fetch"]["count"] == 20
+    assert summary["stages"]["fetch"]["total"] == pytest.approx(0.21)
+    assert summary["stages"]["fetch"]["p95"] == pytest.approx(0.019)
+    assert summary["cache_hit_ratio"] == 0.75
+    assert "cache hit ratio: 0.75 (3 hits, 1 misses)" in stats.format_summary()
+
+
+def test_lookup_stages(fake_geocoder, stats):
+    """ test that the stages of a lookup are timed and the cache hits are counted """
+    get_geo_location_ip("8.8.8.8")
+    geo_info = get_geo_location_ip("8.8.8.8")
+    LocationReport(geo_info).render("human")
+    summary = stats.summary()
+    assert summary["stages"]["fetch"]["count"] == 1
+    assert summary["stages"]["cache_read"]["count"] == 2
+    for stage in ("cache_write", "report", "format", "country_conversion"):
+        assert summary["stages"][stage]["count"] == 1
+    assert summary["cache_hit_ratio"] == 0.5
+
+
+def test_main_stats_profile(fake_geocoder, tmp_path, capsys):
+    """ test the --stats and --profile options """
+    profile_file = tmp_path / "whereisip.prof"
+    main(["--ip_address", "8.8.8.8", "--stats", "--profile", str(profile_file)])
+    captured = capsys.readouterr()
+    assert "Mountain View" in captured.out
+    assert "device_lookup" in captured.err
+    assert "cache hit ratio" in captured.err
+    assert profile_file.exists()
+    assert not get_stats().enabled
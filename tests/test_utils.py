@@ -1,7 +1,13 @@
 import pytest
 
+import numpy as np
+
 from whereisip.utils import (deg_to_dms, get_distance_to_server, get_cache_file,
-                             make_human_location, make_decimal_location, make_sexagesimal_location)
+                             get_distance_matrix, get_distances,
+                             make_human_location, make_decimal_location,
+                             make_sexagesimal_location, read_ip_addresses,
+                             convert_country_codes, get_country_name, is_global_address,
+                             get_prefix_cache_key, normalize_ip_address)
 
 __author__ = "eelco"
 __copyright__ = "eelco"
@@ -38,3 +44,78 @@ def test_make_human_location():
     assert make_human_location(country_code="NL", city="Amsterdam") == "Amsterdam/Netherlands (NL)"
     assert make_human_location(country_code="US",
                                city="Mountain View") == "Mountain View/United States (US)"
+
+
+def test_get_country_name():
+    """ test the precomputed country names and the fallback on country_converter """
+    assert get_country_name("GB") == "United Kingdom"
+    assert get_country_name("UK") == "United Kingdom"
+    assert get_country_name("ZZ") == "not found"
+    names = convert_country_codes(["NL", "US", "NL", "ZZ", "XX"])
+    assert names == {"NL": "Netherlands", "US": "United States", "ZZ": "not found",
+                     "XX": "not found"}
+
+
+def test_read_ip_addresses():
+    """ test reading ip addresses from a stream """
+    lines = ["8.8.8.8\n", "\n", "# comment\n", "  1.1.1.1  \n"]
+    assert list(read_ip_addresses(lines)) == ["8.8.8.8", "1.1.1.1"]
+
+
+def test_get_distances():
+    """ The vectorized distances are equal to the distance of get_distance_to_server """
+    geo_info = {"lat": 37.4056, "lng": -122.0775,
+                "my_lat": 52.3727598, "my_lng": 4.8936041}
+    distances = get_distances([37.4056, -27.4816, None], [-122.0775, 153.0175, 1.0],
+                              52.3727598, 4.8936041)
+    assert distances[0] == pytest.approx(get_distance_to_server(geo_info))
+    assert distances[1] == pytest.approx(16189.4, abs=1)
+    assert np.isnan(distances[2])
+    haversine = get_distances(37.4056, -122.0775, 52.3727598, 4.8936041,
+                              method="haversine")
+    assert haversine == pytest.approx(distances[0], rel=5e-3)
+    with pytest.raises(ValueError):
+        get_distances(0, 0, 0, 0, method="flat")
+
+
+def test_get_distance_matrix():
+    """ test the distances between all servers and all devices """
+    matrix = get_distance_matrix([0, 0, 10], [0, 10, 0], [0, 10], [0, 0],
+                                 method="haversine")
+    assert matrix.shape == (3, 2)
+    assert matrix[0, 0] == 0
+    assert matrix[2, 1] == 0
+    assert matrix[0, 1] == pytest.approx(1111.95, abs=0.01)
+
+
+def test_is_global_address():
+    assert is_global_address("8.8.8.8")
+    assert is_global_address("2001:4860:4860::8888")
+    assert is_global_address("example.com")
+    for ipaddress in ("10.2.30.11", "172.16.0.1", "192.168.1.1", "127.0.0.1",
+                      "169.254.1.1", "100.64.0.1", "224.0.0.1", "255.255.255.255",
+                      "::1", "fe80::1", "fc00::1"):
+        assert not is_global_address(ipaddress), ipaddress
+
+
+def test_normalize_ip_address():
+    """ An IPv4-mapped IPv6 address is replaced by its IPv4 address """
+    assert normalize_ip_address("::ffff:1.1.1.1") == "1.1.1.1"
+    assert normalize_ip_address("::ffff:101:101") == "1.1.1.1"
+    assert normalize_ip_address("64:ff9b::1.1.1.1") == "1.1.1.1"
+    for ipaddress in ("1.1.1.1", "2001:db8::1", "example.com", None):
+        assert normalize_ip_address(ipaddress) == ipaddress
+
+
+def test_get_prefix_cache_key():
+    """
+    The addresses of one network have the same cache key, which can be a file name
+    """
+    assert get_prefix_cache_key("192.0.2.17") == get_prefix_cache_key("192.0.2.200")
+    assert get_prefix_cache_key("192.0.2.17") == "net_192.0.2.0_24"
+    assert get_prefix_cache_key("192.0.2.17", ipv4_prefix=32) == "net_192.0.2.17_32"
+    assert get_prefix_cache_key("2001:db8:1:2::5") == "net_2001:db8:1::_48"
+    assert get_prefix_cache_key(None) == "localhost"
+    # the embedded IPv4 address gives the network
+    assert get_prefix_cache_key("::ffff:192.0.2.17") == "net_192.0.2.0_24"
+    assert get_prefix_cache_key("64:ff9b::198.51.100.1") == "net_198.51.100.0_24"